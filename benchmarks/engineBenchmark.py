@@ -0,0 +1,254 @@
+"""Measures the operations per second and the memory allocated per operation of the match engine and the statistics formatters, on seeded synthetic inputs.
+The results are compared with the baselines in engineBaselines.json, and the script exits with an error if any operation got slower or allocates more than the tolerance allows.
+Operations per second depend on the machine, so the baselines are never committed: the first run on a machine records them, as does --save, e.g. on the commit to compare against.
+
+Usage: python benchmarks/engineBenchmark.py [--save] [--filter setupRound] [--time 0.5] [--speed-tolerance 0.25] [--memory-tolerance 0.1]
+"""
+import argparse
+import gc
+import json
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import time
+import tracemalloc
+import types
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from cogs.statistics import Statistics
+from matchCodecBenchmark import simulateMatch
+from migrations import migrate
+from rainbow import RainbowData, RainbowMatch
+from sqliteStorage import SqliteStorage
+from storage import PLAYER_STATISTICS_QUERIES, getCompletedMatchRows
+from storageCheck import PLAYER_IDS, generateMatches
+
+BASELINES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'engineBaselines.json')
+# Number of inputs prepared at once, the timing only covers the operations themselves
+BATCH_SIZE = 1000
+# Fast operations stop after this many batches even if they took less than the minimum time, as preparing their inputs takes much longer than running them
+MAX_BATCHES = 20
+# Number of single operations traced to find the memory allocated per operation
+TRACED_OPERATIONS = 100
+# A benchmark that looks slower than its baseline is measured this many more times before it counts as a regression, as other processes on the machine can slow down single measurements
+SPEED_RETRIES = 2
+# Allocations may always grow by this many bytes, so tiny operations do not fail on a single extra object
+MEMORY_SLACK = 128
+
+def _simulateMatch(rng: random.Random):
+    """Returns the states of a random match, skipping matches that run out of sites to defend, which the engine does not handle on maps with fewer than four sites."""
+    while True:
+        try:
+            return simulateMatch(rng)
+        except IndexError:
+            continue
+
+def _simulatedStates(rng: random.Random, count: int):
+    """Returns at least count states of randomly played matches, as saved by the bot."""
+    states = []
+    while len(states) < count:
+        states += _simulateMatch(rng)
+    rng.shuffle(states)
+    return states[:count]
+
+def _matchesBefore(rng: random.Random, count: int, step: str):
+    """Returns count matches in the state right before the given step of a round, 'setupRound' or 'resolveRound'."""
+    matches = []
+    while len(matches) < count:
+        for state in _simulateMatch(rng):
+            match = RainbowMatch(state)
+            if match.isMatchFinished():
+                continue
+            lastRoundOpen = len(match.rounds) > 0 and match.rounds[-1]['result'] is None
+            if match.playingOnSide is not None and lastRoundOpen == (step == 'resolveRound'):
+                matches.append(match)
+    rng.shuffle(matches)
+    return matches[:count]
+
+def prepareFromJson(rng: random.Random, count: int):
+    return [(json.dumps(state),) for state in _simulatedStates(rng, count)]
+
+def runFromJson(data: str):
+    RainbowMatch(json.loads(data))
+
+def prepareSetupRound(rng: random.Random, count: int):
+    return [(match,) for match in _matchesBefore(rng, count, 'setupRound')]
+
+def runSetupRound(match: RainbowMatch):
+    match.setupRound()
+
+def prepareResolveRound(rng: random.Random, count: int):
+    return [(match, rng.choice(['won', 'lost']), rng.choice(['attack', 'defense'])) for match in _matchesBefore(rng, count, 'resolveRound')]
+
+def runResolveRound(match: RainbowMatch, result: str, overtimeSide: str):
+    match.resolveRound(result, overtimeSide)
+
+def prepareBanOperators(rng: random.Random, count: int):
+    inputs = []
+    for _ in range(count):
+        names = rng.sample(RainbowData.attackers, 2) + rng.sample(RainbowData.defenders, 2)
+        # Players type names in any case and often misspell them
+        names = [name.lower() if rng.random() < 0.5 else name[:-1] if rng.random() < 0.2 and len(name) > 4 else name for name in names]
+        inputs.append((RainbowMatch(), ' '.join(names)))
+    return inputs
+
+def runBanOperators(match: RainbowMatch, inputString: str):
+    match.banOperators(inputString)
+
+def prepareSetMap(rng: random.Random, count: int):
+    mapNames = list(RainbowData.maps.keys())[:-1]
+    return [(RainbowMatch(), rng.choice([name, name.lower(), name.upper(), name[:-1], 'not a map'])) for name in (rng.choice(mapNames) for _ in range(count))]
+
+def runSetMap(match: RainbowMatch, map: str):
+    match.setMap(map)
+
+def prepareSwapOperator(rng: random.Random, count: int):
+    inputs = []
+    for match in _matchesBefore(rng, count, 'resolveRound'):
+        player = types.SimpleNamespace(id=rng.choice(match.players)['id'])
+        available = RainbowData.getOperatorIdsInMask((RainbowData.attackerMask if match.playingOnSide == 'attack' else RainbowData.defenderMask) & ~match.bannedMask)
+        inputs.append((match, player, rng.choice(available)))
+    return inputs
+
+def runSwapOperator(match: RainbowMatch, player, newOperatorId: int):
+    match.swapOperator(player, newOperatorId)
+
+_playerStatistics = {}
+def _getPlayerStatistics(numMatches: int, statType: str):
+    """Returns the rows the statistics query returns for a player after numMatches random matches, computed once per history size."""
+    if numMatches not in _playerStatistics:
+        conn = sqlite3.connect(':memory:')
+        migrate(conn)
+        SqliteStorage._writeCompletedMatches(conn, getCompletedMatchRows(generateMatches(random.Random(numMatches), numMatches)))
+        _playerStatistics[numMatches] = {key: conn.execute(query, (PLAYER_IDS[0],)).fetchall() for key, query in PLAYER_STATISTICS_QUERIES.items()}
+        conn.close()
+    return _playerStatistics[numMatches][statType]
+
+_statisticsCog = Statistics(None)
+
+def createMapStatisticsBenchmark(numMatches: int):
+    return (lambda rng, count: [(_getPlayerStatistics(numMatches, 'maps'),)] * count, _statisticsCog._createMapStatisticsString)
+
+def createOperatorStatisticsBenchmark(numMatches: int):
+    return (lambda rng, count: [(_getPlayerStatistics(numMatches, 'operators'),)] * count, _statisticsCog._createOperatorStatisticsString)
+
+def prepareMatchRecap(rng: random.Random, count: int):
+    matches = []
+    while len(matches) < count:
+        matches.append((RainbowMatch(_simulateMatch(rng)[-1]),))
+    return matches
+
+# Name -> (prepare, run): prepare(rng, count) returns count argument tuples, each of which is passed to run once
+BENCHMARKS = {
+    'RainbowMatch from JSON': (prepareFromJson, runFromJson),
+    'setupRound': (prepareSetupRound, runSetupRound),
+    'resolveRound': (prepareResolveRound, runResolveRound),
+    'banOperators': (prepareBanOperators, runBanOperators),
+    'setMap': (prepareSetMap, runSetMap),
+    'swapOperator': (prepareSwapOperator, runSwapOperator),
+    **{f'_createMapStatisticsString ({n} matches)': createMapStatisticsBenchmark(n) for n in [10, 100, 1000]},
+    **{f'_createOperatorStatisticsString ({n} matches)': createOperatorStatisticsBenchmark(n) for n in [10, 100, 1000]},
+    'createMatchRecapStringFromMatch': (prepareMatchRecap, _statisticsCog.createMatchRecapStringFromMatch)
+}
+
+def measureSpeed(prepare, run, minTime: float, seed: int):
+    """Returns the median operations per second of the batches, running batches for at least minTime seconds or MAX_BATCHES batches."""
+    rates = []
+    elapsed = 0
+    batch = 0
+    while (elapsed < minTime and batch < MAX_BATCHES) or batch < 3:
+        # Every batch runs the same operations, so their rates only differ by how much the rest of the machine disturbed them
+        inputs = prepare(random.Random(seed), BATCH_SIZE)
+        # The match engine draws from the global random generator
+        random.seed(seed)
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            for args in inputs:
+                run(*args)
+            duration = time.perf_counter() - start
+        finally:
+            gc.enable()
+        rates.append(len(inputs) / duration)
+        elapsed += duration
+        batch += 1
+    return statistics.median(rates)
+
+def measureMemory(prepare, run, seed: int):
+    """Returns the median of the peak memory allocated by single operations, in bytes."""
+    inputs = prepare(random.Random(seed), TRACED_OPERATIONS)
+    random.seed(seed)
+    peaks = []
+    tracemalloc.start()
+    try:
+        for args in inputs:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            run(*args)
+            peaks.append(tracemalloc.get_traced_memory()[1] - before)
+    finally:
+        tracemalloc.stop()
+    return statistics.median(peaks)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--save', action='store_true', help='Store the results as the new baselines instead of comparing with them')
+    parser.add_argument('--filter', default='', help='Only run the benchmarks whose name contains this text')
+    parser.add_argument('--time', type=float, default=0.5, help='Minimum number of seconds each benchmark is timed')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the random inputs')
+    parser.add_argument('--speed-tolerance', type=float, default=0.25, help='Fraction by which the operations per second may fall below the baseline')
+    parser.add_argument('--memory-tolerance', type=float, default=0.1, help='Fraction by which the allocated memory may grow above the baseline')
+    args = parser.parse_args()
+
+    baselines = {}
+    if os.path.exists(BASELINES_PATH):
+        with open(BASELINES_PATH) as f:
+            baselines = json.load(f)
+
+    results = {}
+    regressions = []
+    print(f'{"Benchmark":<50} {"ops/s":>12} {"baseline":>12}    {"B/op":>8} {"baseline":>8}')
+    for name, (prepare, run) in BENCHMARKS.items():
+        if args.filter not in name:
+            continue
+        opsPerSecond = measureSpeed(prepare, run, args.time, args.seed)
+        bytesPerOperation = measureMemory(prepare, run, args.seed)
+        results[name] = {'opsPerSecond': round(opsPerSecond, 1), 'bytesPerOperation': bytesPerOperation}
+
+        baseline = baselines.get(name)
+        status = '' if baseline is not None or args.save else '  NEW BASELINE'
+        if baseline is not None and not args.save:
+            minOpsPerSecond = baseline['opsPerSecond'] * (1 - args.speed_tolerance)
+            for _ in range(SPEED_RETRIES):
+                if opsPerSecond >= minOpsPerSecond:
+                    break
+                opsPerSecond = max(opsPerSecond, measureSpeed(prepare, run, args.time, args.seed))
+            results[name]['opsPerSecond'] = round(opsPerSecond, 1)
+            if opsPerSecond < minOpsPerSecond:
+                regressions.append(f'{name}: {opsPerSecond:.0f} ops/s is slower than the baseline of {baseline["opsPerSecond"]:.0f} ops/s')
+                status += '  SLOWER'
+            if bytesPerOperation > baseline['bytesPerOperation'] * (1 + args.memory_tolerance) + MEMORY_SLACK:
+                regressions.append(f'{name}: {bytesPerOperation:.0f} B/op is more than the baseline of {baseline["bytesPerOperation"]:.0f} B/op')
+                status += '  MORE MEMORY'
+        print(f'{name:<50} {opsPerSecond:12.0f} {baseline["opsPerSecond"] if baseline else float("nan"):12.0f}    {bytesPerOperation:8.0f} {baseline["bytesPerOperation"] if baseline else float("nan"):8.0f}{status}')
+
+    # Benchmarks without a baseline on this machine yet become their own baseline
+    newBaselines = results if args.save else {name: result for name, result in results.items() if name not in baselines}
+    if newBaselines:
+        # Keep the baselines of benchmarks that were filtered out
+        baselines.update(newBaselines)
+        with open(BASELINES_PATH, 'w') as f:
+            json.dump(baselines, f, indent=4, sort_keys=True)
+            f.write('\n')
+        print(f'\nSaved the baselines of {len(newBaselines)} benchmarks to {BASELINES_PATH}')
+    if regressions:
+        print('\nRegressions compared with the baselines:\n' + '\n'.join(regressions))
+        sys.exit(1)
+    elif len(results) > len(newBaselines):
+        print(f'\nNo regressions compared with the baselines of {len(results) - len(newBaselines)} benchmarks')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,508 @@
+"""A minimal stand-in for the Discord gateway and REST API, so the bot can be run locally without a token or network access.
+The gateway answers HELLO, IDENTIFY and heartbeats and sends each shard the guilds Discord would route to it. The REST API implements the routes needed to log in,
+and keeps the messages, reactions and threads of the channels, sending the gateway events Discord would send for them.
+
+Simulated players can send messages, click buttons and add reactions with sendUserMessage(), clickButton() and addUserReaction(), which must be called on the loop the fake runs on.
+Every REST request is counted, per route and per command it is attributed to with attributeTo().
+
+Point a bot at it with useFakeDiscord(url) before starting the bot.
+"""
+import argparse
+import asyncio
+import collections
+import datetime
+import itertools
+import json
+import os
+import sys
+import time
+
+import aiohttp
+from aiohttp import web
+import discord
+import yarl
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from sharding import getShardId
+
+BOT_USER = {'id': '1000', 'username': 'RandomSixBot', 'discriminator': '0000', 'global_name': None, 'avatar': None, 'bot': True, 'flags': 0}
+OWNER_USER = {'id': '1001', 'username': 'owner', 'discriminator': '0000', 'global_name': None, 'avatar': None, 'flags': 0}
+DISCORD_EPOCH = 1420070400000
+
+def createGuildIds(numGuilds: int):
+    """Returns guild ids that are spread over the shards like real snowflakes, whose shard depends on their timestamp bits."""
+    return [(1 << 40) + (i << 22) for i in range(numGuilds)]
+
+def getPlayerIds(guildId: int, numPlayers: int):
+    """The user ids of the simulated players of a guild."""
+    return [guildId + 1000 + i for i in range(numPlayers)]
+
+def createUser(userId: int):
+    return {'id': str(userId), 'username': f'player{userId}', 'discriminator': '0', 'global_name': None, 'avatar': None, 'flags': 0}
+
+def createMember(user: dict):
+    return {'user': user, 'nick': None, 'roles': [], 'joined_at': '2020-01-01T00:00:00+00:00', 'deaf': False, 'mute': False, 'flags': 0}
+
+def createGuildData(guildId: int, numChannels: int = 1, numPlayers: int = 0):
+    """The GUILD_CREATE payload of a guild with a few text channels, with the bot and the simulated players as its members."""
+    return {
+        'id': str(guildId),
+        'name': f'Guild {guildId}',
+        'owner_id': BOT_USER['id'],
+        'unavailable': False,
+        'large': False,
+        'member_count': 1 + numPlayers,
+        'features': [],
+        'roles': [{'id': str(guildId), 'name': '@everyone', 'permissions': '0', 'position': 0, 'color': 0, 'hoist': False, 'managed': False, 'mentionable': False}],
+        'emojis': [],
+        'stickers': [],
+        'channels': [{'id': str(guildId + i + 1), 'type': 0, 'name': f'lobby-{i}', 'position': i, 'permission_overwrites': []} for i in range(numChannels)],
+        'threads': [],
+        'members': [createMember(BOT_USER)] + [createMember(createUser(playerId)) for playerId in getPlayerIds(guildId, numPlayers)],
+        'voice_states': [],
+        'presences': []
+    }
+
+def jsonResponse(data, status: int = 200):
+    # discord.py only parses responses whose content type is exactly application/json, without a charset
+    return web.Response(body=json.dumps(data).encode(), status=status, headers={'Content-Type': 'application/json'})
+
+def _timestamp():
+    return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+class FakeDiscord:
+    """Serves the fake gateway and REST API on a local port."""
+    def __init__(self, guildIds: list, shardCount: int = 1, numChannels: int = 1, numPlayers: int = 0):
+        self.guildIds = list(guildIds)
+        self.shardCount = shardCount
+        self.numChannels = numChannels
+        self.numPlayers = numPlayers
+        # Shard id -> the ids of the guilds sent to the shard, filled as shards identify
+        self.identifiedShards = {}
+        self.url = None
+        self._runner = None
+        # Shard id -> coroutine function sending a gateway event to the shard, and the shard count the bot identified with
+        self._shardDispatchers = {}
+        self._identifiedShardCount = shardCount
+        self._ids = itertools.count()
+
+        # Channel id -> (guild id, parent channel id for threads or None), and the message ids of each channel from oldest to newest
+        self.channels = {}
+        self.channelMessages = collections.defaultdict(list)
+        for guildId in self.guildIds:
+            for channel in createGuildData(guildId, numChannels)['channels']:
+                self.channels[int(channel['id'])] = (guildId, None)
+        # Message id -> message payload, the users that reacted with each emoji, and a revision increased by every change
+        self.messages = {}
+        self.reactionUsers = collections.defaultdict(dict)
+        self.revisions = collections.Counter()
+        self._interactionChannels = {}
+
+        # Counters of all REST requests, by route and by the command they were attributed to, and when each channel last saw a request
+        self.restCalls = collections.Counter()
+        self.restCallsByCommand = collections.Counter()
+        self._attributions = {}
+        self.lastChannelActivity = {}
+
+        self.app = web.Application(middlewares=[self._countRequests])
+        self.app.router.add_get('/api/v10/users/@me', self._getCurrentUser)
+        self.app.router.add_get('/api/v10/oauth2/applications/@me', self._getApplication)
+        self.app.router.add_get('/api/v10/gateway/bot', self._getBotGateway)
+        self.app.router.add_get('/gateway', self._gateway)
+
+        messages = '/api/v10/channels/{channelId}/messages'
+        reactions = messages + '/{messageId}/reactions'
+        self.app.router.add_post(messages, self._createMessage)
+        self.app.router.add_get(messages, self._getMessages)
+        self.app.router.add_get(messages + '/{messageId}', self._getMessage)
+        self.app.router.add_patch(messages + '/{messageId}', self._editMessage)
+        self.app.router.add_delete(messages + '/{messageId}', self._deleteMessage)
+        self.app.router.add_post(messages + '/{messageId}/threads', self._createThread)
+        self.app.router.add_patch('/api/v10/channels/{channelId}', self._editChannel)
+        self.app.router.add_put(reactions + '/{emoji}/@me', self._addReaction)
+        self.app.router.add_get(reactions + '/{emoji}', self._getReactionUsers)
+        self.app.router.add_delete(reactions + '/{emoji}/{userId}', self._removeReaction)
+        self.app.router.add_delete(reactions + '/{emoji}', self._clearReaction)
+        self.app.router.add_delete(reactions, self._clearReactions)
+        self.app.router.add_post('/api/v10/interactions/{interactionId}/{token}/callback', self._interactionCallback)
+
+    async def start(self, port: int = 0):
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', port)
+        await site.start()
+        self.url = f'http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}'
+        return self.url
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    def createSnowflake(self):
+        """A new id, whose timestamp bits are the current time like those of real snowflakes."""
+        return ((int(time.time() * 1000) - DISCORD_EPOCH) << 22) | (next(self._ids) & 0x3FFFFF)
+
+    def attributeTo(self, channelId: int, command: str):
+        """Counts the REST requests of the channel as requests of the command, until another command of the channel is attributed."""
+        self._attributions[channelId] = command
+
+    def _getRootChannel(self, channelId: int):
+        """Returns the channel a thread belongs to, or the channel itself."""
+        parentId = self.channels.get(channelId, (None, None))[1]
+        return parentId if parentId is not None else channelId
+
+    @web.middleware
+    async def _countRequests(self, request: web.Request, handler):
+        if request.path.startswith('/api/'):
+            self.restCalls[f'{request.method} {request.match_info.route.resource.canonical if request.match_info.route.resource else request.path}'] += 1
+            if 'channelId' in request.match_info:
+                channelId = self._getRootChannel(int(request.match_info['channelId']))
+            else:
+                channelId = self._interactionChannels.get(request.match_info.get('interactionId'))
+            if channelId is not None:
+                self.lastChannelActivity[channelId] = time.perf_counter()
+                if channelId in self._attributions:
+                    self.restCallsByCommand[self._attributions[channelId]] += 1
+        return await handler(request)
+
+    async def _getCurrentUser(self, request: web.Request):
+        return jsonResponse(BOT_USER)
+
+    async def _getApplication(self, request: web.Request):
+        return jsonResponse({
+            'id': BOT_USER['id'],
+            'name': BOT_USER['username'],
+            'icon': None,
+            'description': '',
+            'bot_public': True,
+            'bot_require_code_grant': False,
+            'owner': OWNER_USER,
+            'verify_key': '',
+            'flags': 0
+        })
+
+    async def _getBotGateway(self, request: web.Request):
+        return jsonResponse({
+            'url': self.url.replace('http', 'ws', 1) + '/gateway',
+            'shards': self.shardCount,
+            'session_start_limit': {'total': 1000, 'remaining': 1000, 'reset_after': 0, 'max_concurrency': 16}
+        })
+
+    async def _gateway(self, request: web.Request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        sequence = 0
+
+        async def dispatch(event: str, data):
+            nonlocal sequence
+            sequence += 1
+            await ws.send_str(json.dumps({'op': 0, 't': event, 's': sequence, 'd': data}))
+
+        await ws.send_str(json.dumps({'op': 10, 'd': {'heartbeat_interval': 45000}}))
+        async for message in ws:
+            if message.type != aiohttp.WSMsgType.TEXT:
+                break
+            payload = json.loads(message.data)
+            if payload['op'] == 1:
+                await ws.send_str(json.dumps({'op': 11}))
+            elif payload['op'] == 2:
+                shardId, shardCount = payload['d'].get('shard', [0, 1])
+                guildIds = [guildId for guildId in self.guildIds if getShardId(guildId, shardCount) == shardId]
+                self.identifiedShards[shardId] = guildIds
+                self._shardDispatchers[shardId] = dispatch
+                self._identifiedShardCount = shardCount
+                await dispatch('READY', {
+                    'v': 10,
+                    'user': BOT_USER,
+                    'guilds': [{'id': str(guildId), 'unavailable': True} for guildId in guildIds],
+                    'session_id': f'session-{shardId}',
+                    'resume_gateway_url': self.url.replace('http', 'ws', 1) + '/gateway',
+                    'shard': [shardId, shardCount],
+                    'application': {'id': BOT_USER['id'], 'flags': 0}
+                })
+                for guildId in guildIds:
+                    await dispatch('GUILD_CREATE', createGuildData(guildId, self.numChannels, self.numPlayers))
+            elif payload['op'] == 8:
+                # Member chunks requested at startup
+                await dispatch('GUILD_MEMBERS_CHUNK', {
+                    'guild_id': payload['d']['guild_id'],
+                    'members': createGuildData(int(payload['d']['guild_id']), self.numChannels, self.numPlayers)['members'],
+                    'chunk_index': 0,
+                    'chunk_count': 1,
+                    'nonce': payload['d'].get('nonce')
+                })
+        return ws
+
+    async def dispatchToGuild(self, guildId: int, event: str, data):
+        """Sends a gateway event to the shard the guild is on, if it is connected."""
+        dispatch = self._shardDispatchers.get(getShardId(guildId, self._identifiedShardCount))
+        if dispatch is not None:
+            await dispatch(event, data)
+
+    def _createMessagePayload(self, channelId: int, author: dict, content: str, components: list = None, messageType: int = 0):
+        guildId = self.channels[channelId][0]
+        message = {
+            'id': str(self.createSnowflake()),
+            'channel_id': str(channelId),
+            'guild_id': str(guildId),
+            'author': author,
+            'member': {key: value for key, value in createMember(author).items() if key != 'user'},
+            'content': content,
+            'timestamp': _timestamp(),
+            'edited_timestamp': None,
+            'tts': False,
+            'mention_everyone': False,
+            'mentions': [{**createUser(int(userId)), 'member': createMember(createUser(int(userId)))} for userId in _findMentions(content)],
+            'mention_roles': [],
+            'attachments': [],
+            'embeds': [],
+            'pinned': False,
+            'type': messageType,
+            'flags': 0,
+            'components': components or [],
+            'reactions': []
+        }
+        self.messages[int(message['id'])] = message
+        self.channelMessages[channelId].append(int(message['id']))
+        return message
+
+    def _getMessagePayload(self, request: web.Request):
+        message = self.messages.get(int(request.match_info['messageId']))
+        if message is None or message['channel_id'] != request.match_info['channelId']:
+            raise web.HTTPNotFound(body=json.dumps({'message': 'Unknown Message', 'code': 10008}).encode(), content_type='application/json')
+        return message
+
+    def _getReactionPayloads(self, messageId: int):
+        return [{
+            'emoji': {'id': None, 'name': emoji},
+            'count': len(users),
+            'count_details': {'normal': len(users), 'burst': 0},
+            'me': int(BOT_USER['id']) in users,
+            'me_burst': False,
+            'burst_colors': []
+        } for emoji, users in self.reactionUsers[messageId].items() if users]
+
+    def _changed(self, message: dict):
+        messageId = int(message['id'])
+        message['reactions'] = self._getReactionPayloads(messageId)
+        self.revisions[messageId] += 1
+
+    async def _createMessage(self, request: web.Request):
+        channelId = int(request.match_info['channelId'])
+        if channelId not in self.channels:
+            raise web.HTTPNotFound()
+        body = await request.json()
+        message = self._createMessagePayload(channelId, BOT_USER, body.get('content') or '', body.get('components'))
+        await self.dispatchToGuild(self.channels[channelId][0], 'MESSAGE_CREATE', message)
+        return jsonResponse(message)
+
+    async def _getMessages(self, request: web.Request):
+        channelId = int(request.match_info['channelId'])
+        limit = int(request.query.get('limit', 50))
+        messageIds = self.channelMessages[channelId]
+        if 'before' in request.query:
+            messageIds = [messageId for messageId in messageIds if messageId < int(request.query['before'])]
+        return jsonResponse([self.messages[messageId] for messageId in reversed(messageIds[-limit:])])
+
+    async def _getMessage(self, request: web.Request):
+        return jsonResponse(self._getMessagePayload(request))
+
+    async def _editMessage(self, request: web.Request):
+        message = self._getMessagePayload(request)
+        body = await request.json()
+        if 'content' in body:
+            message['content'] = body['content'] or ''
+        if 'components' in body:
+            message['components'] = body['components'] or []
+        message['edited_timestamp'] = _timestamp()
+        self._changed(message)
+        await self.dispatchToGuild(int(message['guild_id']), 'MESSAGE_UPDATE', message)
+        return jsonResponse(message)
+
+    async def _deleteMessage(self, request: web.Request):
+        message = self._getMessagePayload(request)
+        messageId = int(message['id'])
+        del self.messages[messageId]
+        self.channelMessages[int(message['channel_id'])].remove(messageId)
+        self.revisions[messageId] += 1
+        await self.dispatchToGuild(int(message['guild_id']), 'MESSAGE_DELETE', {'id': message['id'], 'channel_id': message['channel_id'], 'guild_id': message['guild_id']})
+        return web.Response(status=204)
+
+    async def _createThread(self, request: web.Request):
+        message = self._getMessagePayload(request)
+        body = await request.json()
+        channelId = int(message['channel_id'])
+        guildId = self.channels[channelId][0]
+        # Threads started on a message have the id of the message
+        thread = {
+            'id': message['id'],
+            'guild_id': str(guildId),
+            'parent_id': str(channelId),
+            'owner_id': BOT_USER['id'],
+            'name': body['name'],
+            'type': 11,
+            'last_message_id': None,
+            'message_count': 0,
+            'member_count': 1,
+            'rate_limit_per_user': 0,
+            'flags': 0,
+            'thread_metadata': {'archived': False, 'auto_archive_duration': body.get('auto_archive_duration', 1440), 'archive_timestamp': _timestamp(), 'locked': False}
+        }
+        self.channels[int(thread['id'])] = (guildId, channelId)
+        message['thread'] = thread
+        await self.dispatchToGuild(guildId, 'THREAD_CREATE', {**thread, 'newly_created': True})
+        # Like Discord, announce the thread with a system message in the channel
+        systemMessage = self._createMessagePayload(channelId, BOT_USER, body['name'], messageType=18)
+        await self.dispatchToGuild(guildId, 'MESSAGE_CREATE', systemMessage)
+        return jsonResponse(thread, 201)
+
+    async def _editChannel(self, request: web.Request):
+        channelId = int(request.match_info['channelId'])
+        message = self.messages.get(channelId)
+        if message is None or 'thread' not in message:
+            raise web.HTTPNotFound()
+        body = await request.json()
+        thread = message['thread']
+        if 'archived' in body:
+            thread['thread_metadata']['archived'] = body['archived']
+        await self.dispatchToGuild(int(thread['guild_id']), 'THREAD_UPDATE', thread)
+        return jsonResponse(thread)
+
+    async def _setReaction(self, message: dict, emoji: str, userId: int, added: bool):
+        """Adds or removes the reaction of a user and sends the gateway event."""
+        messageId = int(message['id'])
+        users = self.reactionUsers[messageId].setdefault(emoji, set())
+        if added == (userId in users):
+            return
+        (users.add if added else users.discard)(userId)
+        self._changed(message)
+        event = {
+            'user_id': str(userId),
+            'channel_id': message['channel_id'],
+            'message_id': message['id'],
+            'guild_id': message['guild_id'],
+            'emoji': {'id': None, 'name': emoji},
+            'burst': False,
+            'type': 0
+        }
+        if added:
+            event['member'] = createMember(BOT_USER if userId == int(BOT_USER['id']) else createUser(userId))
+        await self.dispatchToGuild(int(message['guild_id']), 'MESSAGE_REACTION_ADD' if added else 'MESSAGE_REACTION_REMOVE', event)
+
+    async def _addReaction(self, request: web.Request):
+        await self._setReaction(self._getMessagePayload(request), request.match_info['emoji'], int(BOT_USER['id']), True)
+        return web.Response(status=204)
+
+    async def _getReactionUsers(self, request: web.Request):
+        message = self._getMessagePayload(request)
+        users = sorted(self.reactionUsers[int(message['id'])].get(request.match_info['emoji'], set()))
+        return jsonResponse([BOT_USER if userId == int(BOT_USER['id']) else createUser(userId) for userId in users])
+
+    async def _removeReaction(self, request: web.Request):
+        userId = request.match_info['userId']
+        await self._setReaction(self._getMessagePayload(request), request.match_info['emoji'], int(BOT_USER['id']) if userId == '@me' else int(userId), False)
+        return web.Response(status=204)
+
+    async def _clearReaction(self, request: web.Request):
+        message = self._getMessagePayload(request)
+        self.reactionUsers[int(message['id'])].pop(request.match_info['emoji'], None)
+        self._changed(message)
+        await self.dispatchToGuild(int(message['guild_id']), 'MESSAGE_REACTION_REMOVE_EMOJI', {
+            'channel_id': message['channel_id'], 'message_id': message['id'], 'guild_id': message['guild_id'], 'emoji': {'id': None, 'name': request.match_info['emoji']}
+        })
+        return web.Response(status=204)
+
+    async def _clearReactions(self, request: web.Request):
+        message = self._getMessagePayload(request)
+        self.reactionUsers[int(message['id'])].clear()
+        self._changed(message)
+        await self.dispatchToGuild(int(message['guild_id']), 'MESSAGE_REACTION_REMOVE_ALL', {'channel_id': message['channel_id'], 'message_id': message['id'], 'guild_id': message['guild_id']})
+        return web.Response(status=204)
+
+    async def _interactionCallback(self, request: web.Request):
+        body = await request.json()
+        return jsonResponse({
+            'interaction': {'id': request.match_info['interactionId'], 'type': 3, 'response_message_loading': False, 'response_message_ephemeral': False},
+            'resource': {'type': body['type']}
+        })
+
+    def createUserMessage(self, channelId: int, userId: int, content: str):
+        """Stores a message of a simulated player without sending it to the bot yet, and returns its payload."""
+        return self._createMessagePayload(channelId, createUser(userId), content)
+
+    async def sendUserMessage(self, channelId: int, userId: int, content: str, message: dict = None):
+        """Posts a message of a simulated player, or a message created with createUserMessage(), and returns its id."""
+        message = message or self.createUserMessage(channelId, userId, content)
+        await self.dispatchToGuild(self.channels[channelId][0], 'MESSAGE_CREATE', message)
+        return int(message['id'])
+
+    async def clickButton(self, messageId: int, userId: int, customId: str, interactionId: int = None):
+        """Clicks a button of a message as a simulated player and returns the id of the interaction."""
+        message = self.messages[messageId]
+        interactionId = interactionId or self.createSnowflake()
+        self._interactionChannels[str(interactionId)] = int(message['channel_id'])
+        await self.dispatchToGuild(int(message['guild_id']), 'INTERACTION_CREATE', {
+            'id': str(interactionId),
+            'application_id': BOT_USER['id'],
+            'type': 3,
+            'data': {'custom_id': customId, 'component_type': 2},
+            'guild_id': message['guild_id'],
+            'channel': {'id': message['channel_id'], 'type': 0, 'guild_id': message['guild_id'], 'name': 'lobby', 'position': 0, 'permission_overwrites': []},
+            'channel_id': message['channel_id'],
+            'member': {**createMember(createUser(userId)), 'permissions': '0'},
+            'token': f'token-{interactionId}',
+            'version': 1,
+            'message': message,
+            'locale': 'en-US',
+            'guild_locale': 'en-US',
+            'app_permissions': '0',
+            'entitlements': [],
+            'authorizing_integration_owners': {},
+            'context': 0,
+            'attachment_size_limit': 8 * 1024 * 1024
+        })
+        return interactionId
+
+    async def addUserReaction(self, messageId: int, userId: int, emoji: str):
+        """Reacts to a message as a simulated player."""
+        await self._setReaction(self.messages[messageId], emoji, userId, True)
+
+    def getControls(self, messageId: int):
+        """Returns the (emoji, button custom id) pairs of the controls of a message, with None as the custom id of reactions added by the bot."""
+        message = self.messages.get(messageId)
+        if message is None:
+            return []
+        controls = [(button['emoji']['name'], button['custom_id']) for row in message['components'] for button in row['components'] if 'custom_id' in button]
+        controls += [(emoji, None) for emoji, users in self.reactionUsers[messageId].items() if int(BOT_USER['id']) in users]
+        return controls
+
+    def getLatestBotMessage(self, channelId: int):
+        """Returns the id of the newest regular message of the bot in the channel, or None."""
+        for messageId in reversed(self.channelMessages[channelId]):
+            message = self.messages[messageId]
+            if message['author']['id'] == BOT_USER['id'] and message['type'] == 0:
+                return messageId
+        return None
+
+def _findMentions(content: str):
+    """Returns the user ids mentioned in the content."""
+    return [part.split('>')[0].lstrip('!') for part in content.split('<@')[1:] if part.split('>')[0].lstrip('!').isdigit()]
+
+def useFakeDiscord(url: str):
+    """Sends all REST requests and gateway connections of bots created in this process to the fake Discord at the url."""
+    discord.http.Route.BASE = f'{url}/api/v10'
+    discord.gateway.DiscordWebSocket.DEFAULT_GATEWAY = yarl.URL(url.replace('http', 'ws', 1) + '/gateway')
+
+async def _serve(args):
+    fake = FakeDiscord(createGuildIds(args.guilds), args.shards, numPlayers=args.players)
+    print(f'Fake Discord listening on {await fake.start(args.port)}')
+    await asyncio.Event().wait()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--guilds', type=int, default=16)
+    parser.add_argument('--shards', type=int, default=1, help='The number of shards recommended to bots using SHARD_COUNT=auto')
+    parser.add_argument('--players', type=int, default=0, help='The number of simulated players that are members of every guild')
+    asyncio.run(_serve(parser.parse_args()))
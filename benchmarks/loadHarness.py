@@ -0,0 +1,302 @@
+"""Drives the bot with simulated players in many guilds at once, against the fake Discord gateway and REST API, and reports how it keeps up.
+In every guild, players repeatedly start a match, set the map, ban operators, pick a side, win or lose rounds with the controls of the match message until the match ends,
+view their statistics and end the match with !goodnight. The actions of all guilds are spread evenly at the given rate, and each player waits for the bot to finish their previous action.
+
+Reports the p50/p99 latency of each command from the gateway event to the bot finishing it, the event loop lag of the bot, the time spent waiting for the database
+and the number of REST requests per command. The fake Discord runs on its own thread, so it does not slow down the bot's event loop.
+
+Usage: python benchmarks/loadHarness.py [--guilds 20] [--rate 20] [--duration 30] [--players 3] [--reactions] [--seed 0]
+"""
+import argparse
+import asyncio
+import collections
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from fakeDiscord import FakeDiscord, createGuildIds, getPlayerIds, useFakeDiscord
+
+# How long the bot may take to finish an action, or the controls of a match message to appear, before it counts as a timeout
+ACTION_TIMEOUT = 30.0
+# How long a channel must see no REST requests before the match message is considered up to date, longer than the bot holds back edits and waits between reaction requests
+SETTLE_TIME = 0.5
+# How often the event loop lag of the bot is sampled
+LAG_INTERVAL = 0.05
+
+def percentile(values: list, fraction: float):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+class Recorder:
+    """Collects the measurements, written from the loop of the bot and read from the loop of the fake Discord."""
+    def __init__(self):
+        # Event id -> (command, time the event was sent, future resolved on the fake's loop when the bot finished it)
+        self._pending = {}
+        self._lock = threading.Lock()
+        self.latencies = collections.defaultdict(list)
+        self.timeouts = collections.Counter()
+        self.loopLags = []
+        self.databaseTime = collections.Counter()
+        self.databaseCalls = collections.Counter()
+
+    def expect(self, eventId, command: str, loop: asyncio.AbstractEventLoop):
+        future = loop.create_future()
+        with self._lock:
+            self._pending[eventId] = (command, time.perf_counter(), future, loop)
+        return future
+
+    def finish(self, eventId):
+        with self._lock:
+            pending = self._pending.pop(eventId, None)
+        if pending is None:
+            return
+        command, start, future, loop = pending
+        self.latencies[command].append(time.perf_counter() - start)
+        loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+    def forget(self, eventId):
+        with self._lock:
+            pending = self._pending.pop(eventId, None)
+        if pending is not None:
+            self.timeouts[pending[0]] += 1
+
+def instrumentBot(bot, recorder: Recorder):
+    """Wraps the entry points of commands, button clicks and reactions and the storage backend, so the recorder sees when each action is done and how long the database took."""
+    invoke = bot.invoke
+    async def timedInvoke(ctx):
+        try:
+            await invoke(ctx)
+        finally:
+            recorder.finish(ctx.message.id)
+    bot.invoke = timedInvoke
+
+    handleMatchControl = bot.handleMatchControl
+    async def timedHandleMatchControl(interaction, matchId: str, emoji: str):
+        try:
+            await handleMatchControl(interaction, matchId, emoji)
+        finally:
+            recorder.finish(interaction.id)
+    bot.handleMatchControl = timedHandleMatchControl
+
+    onRawReactionAdd = bot.on_raw_reaction_add
+    async def timedOnRawReactionAdd(payload):
+        try:
+            await onRawReactionAdd(payload)
+        finally:
+            recorder.finish((payload.message_id, payload.user_id, str(payload.emoji)))
+    bot.on_raw_reaction_add = timedOnRawReactionAdd
+
+    for name in ['loadOngoingMatches', 'writeOngoingMatches', 'saveCompletedMatches', 'deleteMatch', 'deleteMatchesWithoutMap', 'rebuildStatistics', 'getPlayerStatistics', 'getServerStatistics']:
+        def wrap(method, name=name):
+            async def timed(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await method(*args, **kwargs)
+                finally:
+                    recorder.databaseTime[name] += time.perf_counter() - start
+                    recorder.databaseCalls[name] += 1
+            return timed
+        setattr(bot.storage, name, wrap(getattr(bot.storage, name)))
+
+async def measureLoopLag(recorder: Recorder):
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(LAG_INTERVAL)
+        recorder.loopLags.append(time.perf_counter() - start - LAG_INTERVAL)
+
+class RateLimiter:
+    """Spaces out the actions of all guilds evenly at a number of actions per second."""
+    def __init__(self, rate: float):
+        self.interval = 1 / rate
+        self._next = time.perf_counter()
+
+    async def acquire(self):
+        now = time.perf_counter()
+        self._next = max(self._next + self.interval, now)
+        await asyncio.sleep(self._next - now)
+
+def getRevision(fake: FakeDiscord, channelId: int):
+    """Identifies the current state of the newest match message of the channel."""
+    messageId = fake.getLatestBotMessage(channelId)
+    return messageId, fake.revisions[messageId]
+
+async def waitForControls(fake: FakeDiscord, channelId: int, previousRevision, deadline: float):
+    """Waits until the newest match message of the channel changed since previousRevision and the channel is quiet, and returns it with its controls."""
+    while time.perf_counter() < deadline:
+        messageId = fake.getLatestBotMessage(channelId)
+        settled = time.perf_counter() - fake.lastChannelActivity.get(channelId, 0) >= SETTLE_TIME
+        if messageId is not None and settled and (messageId, fake.revisions[messageId]) != previousRevision:
+            controls = fake.getControls(messageId)
+            if controls:
+                return messageId, controls
+        await asyncio.sleep(SETTLE_TIME / 5)
+    return None, []
+
+async def waitForQuiet(fake: FakeDiscord, channelId: int, deadline: float):
+    """Waits until the bot sent no REST requests for the channel for SETTLE_TIME, like a player reading the reply before the next action."""
+    while time.perf_counter() < deadline and time.perf_counter() - fake.lastChannelActivity.get(channelId, 0) < SETTLE_TIME:
+        await asyncio.sleep(SETTLE_TIME / 5)
+
+async def playGuild(fake: FakeDiscord, recorder: Recorder, limiter: RateLimiter, guildId: int, numPlayers: int, useReactions: bool, rng: random.Random, stopAt: float):
+    """Plays matches in the first channel of the guild until stopAt."""
+    from rainbow import RainbowData
+
+    loop = asyncio.get_running_loop()
+    channelId = guildId + 1
+    playerIds = getPlayerIds(guildId, numPlayers)
+
+    async def wait(eventId, future):
+        try:
+            await asyncio.wait_for(future, ACTION_TIMEOUT)
+        except asyncio.TimeoutError:
+            recorder.forget(eventId)
+
+    async def command(name: str, content: str):
+        await limiter.acquire()
+        fake.attributeTo(channelId, name)
+        # The bot may finish the command before sendUserMessage returns, so the message is created and expected first
+        message = fake.createUserMessage(channelId, rng.choice(playerIds), content)
+        future = recorder.expect(int(message['id']), name, loop)
+        await fake.sendUserMessage(channelId, None, None, message)
+        await wait(int(message['id']), future)
+        await waitForQuiet(fake, channelId, time.perf_counter() + ACTION_TIMEOUT)
+
+    async def control(messageId: int, emoji: str, customId: str, players: list):
+        await limiter.acquire()
+        name = f'{"reaction" if useReactions else "button"} {emoji}'
+        fake.attributeTo(channelId, name)
+        # The bot ignores the controls of users who are not playing the match
+        userId = rng.choice(players)
+        if useReactions:
+            eventId = (messageId, userId, emoji)
+            future = recorder.expect(eventId, name, loop)
+            await fake.addUserReaction(messageId, userId, emoji)
+        else:
+            eventId = fake.createSnowflake()
+            future = recorder.expect(eventId, name, loop)
+            await fake.clickButton(messageId, userId, customId, eventId)
+        await wait(eventId, future)
+
+    maps = list(RainbowData.maps.keys())[:-1]
+    while time.perf_counter() < stopAt:
+        players = rng.sample(playerIds, rng.randint(1, len(playerIds)))
+        mentions = ' '.join(f'<@{playerId}>' for playerId in players)
+        await command('!startMatch', f'!startMatch {mentions}')
+        await command('!setMap', f'!setMap {rng.choice(maps)}')
+        await command('!ban', f'!ban {rng.choice(RainbowData.attackers)} {rng.choice(RainbowData.defenders)}')
+        # The controls are only read once the match message changed after the action, as its edits are debounced
+        revision = getRevision(fake, channelId)
+        side = rng.choice(['attack', 'defense'])
+        await command(f'!{side}', f'!{side}')
+
+        # Matches that are already running are played until they end
+        while True:
+            messageId, controls = await waitForControls(fake, channelId, revision, time.perf_counter() + ACTION_TIMEOUT)
+            if messageId is None:
+                recorder.timeouts['controls'] += 1
+                break
+            roundControls = [(emoji, customId) for emoji, customId in controls if emoji in ['🇼', '🇱', '⚔️', '🛡️']]
+            if not roundControls:
+                break
+            revision = (messageId, fake.revisions[messageId])
+            await control(messageId, *rng.choice(roundControls), players)
+
+        await command('!stats', '!stats')
+        await command('!goodnight', '!goodnight')
+
+def runFake(fake: FakeDiscord, ready: threading.Event, loopHolder: list):
+    """Runs the fake Discord on a new event loop on the current thread until its loop is stopped."""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loopHolder.append(loop)
+    loop.run_until_complete(fake.start())
+    ready.set()
+    loop.run_forever()
+    loop.run_until_complete(fake.stop())
+    loop.close()
+
+def printReport(recorder: Recorder, fake: FakeDiscord, duration: float):
+    print(f'\n{"Command":<16} {"count":>7} {"p50 ms":>9} {"p99 ms":>9} {"max ms":>9} {"timeouts":>9} {"REST/cmd":>9}')
+    for name in sorted(recorder.latencies.keys() | recorder.timeouts.keys()):
+        latencies = recorder.latencies[name]
+        count = len(latencies) + recorder.timeouts[name]
+        print(f'{name:<16} {count:7d} {percentile(latencies, 0.5) * 1000:9.1f} {percentile(latencies, 0.99) * 1000:9.1f} {max(latencies, default=float("nan")) * 1000:9.1f} {recorder.timeouts[name]:9d} {fake.restCallsByCommand[name] / count:9.2f}')
+    allLatencies = [latency for latencies in recorder.latencies.values() for latency in latencies]
+    print(f'{"all":<16} {len(allLatencies):7d} {percentile(allLatencies, 0.5) * 1000:9.1f} {percentile(allLatencies, 0.99) * 1000:9.1f} {max(allLatencies, default=float("nan")) * 1000:9.1f} {sum(recorder.timeouts.values()):9d}')
+    print(f'\nThroughput: {len(allLatencies) / duration:.1f} actions/s')
+
+    lags = recorder.loopLags
+    print(f'Event loop lag: p50 {percentile(lags, 0.5) * 1000:.1f} ms, p99 {percentile(lags, 0.99) * 1000:.1f} ms, max {max(lags, default=float("nan")) * 1000:.1f} ms')
+
+    totalDatabaseTime = sum(recorder.databaseTime.values())
+    print(f'Database: {totalDatabaseTime:.2f} s waited over {sum(recorder.databaseCalls.values())} calls ({totalDatabaseTime / duration * 100:.1f}% of the run)')
+    for name, calls in recorder.databaseCalls.most_common():
+        print(f'    {name:<24} {calls:7d} calls {recorder.databaseTime[name] / calls * 1000:8.2f} ms/call')
+
+    print(f'REST: {sum(fake.restCalls.values())} requests')
+    for route, calls in fake.restCalls.most_common():
+        print(f'    {calls:7d} {route}')
+
+async def main(args):
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ.update({'DISCORD_BOT_TOKEN': 'fake-token', 'DATABASE_PATH': os.path.join(directory, 'load.db')})
+        if args.reactions:
+            os.environ['USE_REACTION_CONTROLS'] = '1'
+        import bot as botModule
+
+        guildIds = createGuildIds(args.guilds)
+        fake = FakeDiscord(guildIds, numPlayers=args.players)
+        ready, loopHolder = threading.Event(), []
+        fakeThread = threading.Thread(target=runFake, args=(fake, ready, loopHolder), daemon=True)
+        fakeThread.start()
+        await asyncio.get_running_loop().run_in_executor(None, ready.wait)
+        fakeLoop = loopHolder[0]
+
+        useFakeDiscord(fake.url)
+        recorder = Recorder()
+        bot = botModule.bot = botModule.RainbowBot()
+        instrumentBot(bot, recorder)
+        botTask = asyncio.create_task(bot.start('fake-token'))
+        # The cogs are loaded once the bot is ready
+        while not bot.is_ready() or bot.get_cog('Statistics') is None:
+            if botTask.done():
+                await botTask
+            await asyncio.sleep(0.05)
+        lagTask = asyncio.create_task(measureLoopLag(recorder))
+        print(f'Bot ready in {len(bot.guilds)} guilds, playing for {args.duration} s at {args.rate} actions/s with {"reactions" if args.reactions else "buttons"}')
+
+        rng = random.Random(args.seed)
+        limiter = None
+        async def drive():
+            nonlocal limiter
+            limiter = RateLimiter(args.rate)
+            stopAt = time.perf_counter() + args.duration
+            await asyncio.gather(*[playGuild(fake, recorder, limiter, guildId, args.players, args.reactions, random.Random(rng.getrandbits(64)), stopAt) for guildId in guildIds])
+
+        start = time.perf_counter()
+        await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(drive(), fakeLoop))
+        duration = time.perf_counter() - start
+
+        lagTask.cancel()
+        await bot.close()
+        await botTask
+        fakeLoop.call_soon_threadsafe(fakeLoop.stop)
+        fakeThread.join()
+        printReport(recorder, fake, duration)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--guilds', type=int, default=20, help='Number of guilds playing at once')
+    parser.add_argument('--rate', type=float, default=20, help='Actions per second of all guilds together')
+    parser.add_argument('--duration', type=float, default=30, help='Seconds after which no new matches are started, running matches are played until they end')
+    parser.add_argument('--players', type=int, default=3, help='Number of players in every guild, each match is played by some of them')
+    parser.add_argument('--reactions', action='store_true', help='Control matches with reactions instead of buttons')
+    parser.add_argument('--seed', type=int, default=0)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,85 @@
+"""Compares the size and speed of the binary match encoding with the previous JSON encoding of ongoing matches, after checking that every state of a simulated match survives a round trip through both.
+The binary encoding is several times smaller and faster to encode, but decoding it takes about as long as decoding the JSON, as json.loads runs in C while the binary decoder builds each round in Python.
+
+Usage: python benchmarks/matchCodecBenchmark.py [--matches 200] [--repeat 2000]
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from matchCodec import decodeMatch, encodeMatch
+from rainbow import RainbowData, RainbowMatch
+
+def simulateMatch(rng: random.Random):
+    """Plays a random match and returns a copy of its state after every step, as the bot would save it."""
+    random.seed(rng.getrandbits(64))
+    states = []
+    def snapshot():
+        states.append(json.loads(json.dumps(match.toDict())))
+
+    match = RainbowMatch()
+    numPlayers = rng.randint(1, 5)
+    playerIds = [rng.getrandbits(60) for _ in range(numPlayers)]
+    match.setPlayers([{
+        'id': playerId,
+        'mention': f'<@{playerId}>',
+        'name': f'player{i}',
+        'nick': rng.choice([None, f'Nick {i} ✨']),
+        'global_name': rng.choice([None, f'Global Name {i}'])
+    } for i, playerId in enumerate(playerIds)])
+    snapshot()
+
+    match.setMap(rng.choice(list(RainbowData.maps.keys())[:-1]))
+    match.banOperators(' '.join(rng.sample(RainbowData.attackers, 2) + rng.sample(RainbowData.defenders, 2)))
+    match.playingOnSide = rng.choice(['attack', 'defense'])
+    snapshot()
+
+    while True:
+        match.setupRound()
+        snapshot()
+        if rng.random() < 0.2:
+            match.addPlayerStat(rng.choice(match.players)['id'], rng.choice(['interrogations', 'aces']))
+        if not match.resolveRound(rng.choice(['won', 'lost']), rng.choice(['attack', 'defense'])):
+            snapshot()
+            return states
+        snapshot()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--matches', type=int, default=200, help='Number of simulated matches to check')
+    parser.add_argument('--repeat', type=int, default=2000, help='Number of times each state of the timed match is encoded and decoded')
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    states = [state for _ in range(args.matches) for state in simulateMatch(rng)]
+    for state in states:
+        match = RainbowMatch(state)
+        assert decodeMatch(encodeMatch(match)).toDict() == state, f'Binary round trip changed the match state {state}'
+        assert RainbowMatch(json.loads(json.dumps(match.toDict()))).toDict() == state, f'JSON round trip changed the match state {state}'
+    print(f'Round trips of {len(states)} match states from {args.matches} matches are lossless\n')
+
+    jsonSizes = [len(json.dumps(state).encode()) for state in states]
+    binarySizes = [len(encodeMatch(RainbowMatch(state))) for state in states]
+    print(f'{"Size":<10} JSON median {statistics.median(jsonSizes):7.0f} B    binary median {statistics.median(binarySizes):7.0f} B    ({sum(jsonSizes) / sum(binarySizes):.1f}x smaller)')
+
+    # Time the encoding and decoding of all states of the longest match
+    timedMatches = [RainbowMatch(state) for state in max((simulateMatch(random.Random(seed)) for seed in range(20)), key=len)]
+    timings = {
+        'Encode': (lambda: [json.dumps(match.toDict()) for match in timedMatches], lambda: [encodeMatch(match) for match in timedMatches]),
+    }
+    jsonData = [json.dumps(match.toDict()) for match in timedMatches]
+    binaryData = [encodeMatch(match) for match in timedMatches]
+    timings['Decode'] = (lambda: [RainbowMatch(json.loads(data)) for data in jsonData], lambda: [decodeMatch(data) for data in binaryData])
+    for name, (jsonPath, binaryPath) in timings.items():
+        jsonTime = min(timeit.repeat(jsonPath, number=args.repeat, repeat=3)) / (args.repeat * len(timedMatches))
+        binaryTime = min(timeit.repeat(binaryPath, number=args.repeat, repeat=3)) / (args.repeat * len(timedMatches))
+        print(f'{name:<10} JSON {jsonTime * 1e6:12.2f} us    binary {binaryTime * 1e6:8.2f} us    ({jsonTime / binaryTime:.1f}x)')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,36 @@
+"""Checks that the statistics queries and the statements updating the statistics rollups for every saved match can all use an index on the latest SQLite schema, as any full table scan gets slower with every match played.
+Exits with status 1 and prints the offending queries with their plan steps if one of them scans a full table.
+
+Usage: python benchmarks/queryPlanCheck.py
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from migrations import findFullTableScans
+from statisticsRollups import APPLY_STATEMENTS, CLEANUP_STATEMENTS
+from storage import PLAYER_STATISTICS_QUERIES, SERVER_STATISTICS_QUERIES
+
+QUERIES = {
+    **{f'player statistics "{statType}"': query for statType, query in PLAYER_STATISTICS_QUERIES.items()},
+    **{f'server statistics "{statType}"': query for statType, query in SERVER_STATISTICS_QUERIES.items()},
+    **{f'rollup update {i + 1}': query for i, query in enumerate(APPLY_STATEMENTS)},
+    **{f'rollup cleanup {i + 1}': query for i, query in enumerate(CLEANUP_STATEMENTS)}
+}
+
+def main():
+    numFullScans = 0
+    for name, query in QUERIES.items():
+        fullScans = findFullTableScans([query])
+        numFullScans += len(fullScans)
+        print(f'{name:<40} {"FULL SCAN" if fullScans else "ok"}')
+        for _, planStep in fullScans:
+            print(f'    {planStep}:{query}')
+
+    print(f'\n{len(QUERIES)} queries checked, {numFullScans} full table scans')
+    if numFullScans:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""Counts the API calls needed to update the reactions of a match message, for every transition between the reaction sets the bot uses, with and without reactions of other users on the message.
+Checks that each plan reaches the expected reactions and stays within the upper bound, and compares the call counts with the previous implementation, which cleared and re-added every reaction after the first mismatch.
+
+Usage: python benchmarks/reactionPlannerBenchmark.py [--seed 0]
+"""
+import argparse
+import itertools
+import os
+import random
+import sys
+from itertools import zip_longest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from reactionPlanner import applyPlan, planReactions
+
+# The reaction sets set by the cogs, with and without the interrogation reaction for rounds with Caveira
+REACTION_SETS = [
+    [],
+    ['⚔️', '🛡️'],
+    ['🇼', '🇱'],
+    ['🇼', '🇱', '🗡️'],
+    ['⚔️', '🛡️', '🇱'],
+    ['⚔️', '🛡️', '🇱', '🗡️'],
+    ['🇼', '⚔️', '🛡️'],
+    ['🇼', '⚔️', '🛡️', '🗡️'],
+    ['👍', '🎤', '👎', '✋']
+]
+
+def legacyCalls(current: list, expected: list):
+    """The number of API calls the previous implementation made for the transition."""
+    currentEmojis = [emoji for emoji, _, _ in current]
+    calls = 0
+    if not any(emoji in expected for emoji in currentEmojis):
+        calls += 1 if currentEmojis else 0
+    else:
+        calls += len([emoji for emoji in currentEmojis if emoji not in expected])
+
+    for i, (reaction, expectedEmoji) in enumerate(zip_longest(current, expected)):
+        if (reaction[0] if reaction else None) != expectedEmoji:
+            calls += len(current[i:]) + len(expected[i:])
+            break
+        elif len(reaction[2]) > 0:
+            # One call to list the users, and one to remove each of them
+            calls += 1 + len(reaction[2])
+    return calls
+
+def upperBound(current: list, expected: list):
+    """Never more than clearing everything and adding the expected reactions again."""
+    return (1 if current else 0) + len(expected)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--seed', type=int, default=0, help='Seed for choosing the reactions of other users')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    plannedTotal, legacyTotal, numTransitions = 0, 0, 0
+    for (before, after), withOtherUsers in itertools.product(itertools.product(REACTION_SETS, repeat=2), [False, True]):
+        current = [(emoji, True, set(rng.sample(range(1, 6), k=rng.randint(0, 2))) if withOtherUsers else set()) for emoji in before]
+        if withOtherUsers and rng.random() < 0.5:
+            # A reaction with an emoji the bot did not use
+            current.append(('🤡', False, {rng.randint(1, 5)}))
+
+        plan = planReactions(current, after)
+        assert applyPlan(current, plan) == [(emoji, True, set()) for emoji in after], f'Plan {plan} does not turn {current} into {after}'
+        assert len(plan) <= upperBound(current, after), f'Plan {plan} for {current} -> {after} exceeds the upper bound'
+        plannedTotal += len(plan)
+        legacyTotal += legacyCalls(current, after) if after else (1 if current else 0)
+        numTransitions += 1
+
+    print(f'{numTransitions} transitions checked, all plans reach the expected reactions within the upper bound')
+    print(f'API calls: {legacyTotal} before, {plannedTotal} after ({legacyTotal / numTransitions:.2f} vs {plannedTotal / numTransitions:.2f} per transition)')
+
+if __name__ == '__main__':
+    main()
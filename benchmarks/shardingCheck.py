@@ -0,0 +1,110 @@
+"""Runs the bot as several processes, each with its own range of shards, against the fake Discord gateway and a shared database.
+Checks that every guild is handled by exactly one process, that each process only restores the ongoing matches of its own guilds, and that completed matches of all processes end up in the shared database.
+
+Usage: python benchmarks/shardingCheck.py [--guilds 32] [--shards 4] [--processes 2]
+"""
+import argparse
+import asyncio
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from fakeDiscord import FakeDiscord, createGuildIds, useFakeDiscord
+from migrations import migrate
+
+def splitShards(shardCount: int, numProcesses: int):
+    """Splits the shards into one SHARD_IDS range per process."""
+    perProcess = -(-shardCount // numProcesses)
+    return [f'{start}-{min(start + perProcess, shardCount) - 1}' for start in range(0, shardCount, perProcess)]
+
+def seedOngoingMatches(databasePath: str, guildIds: list):
+    """Saves an ongoing match without match data in the first channel of every guild."""
+    conn = sqlite3.connect(databasePath)
+    try:
+        migrate(conn)
+        conn.executemany("INSERT INTO ongoing_matches (server_id, channel_id, match_data, discord_message) VALUES (?, ?, NULL, NULL)", [(guildId, guildId + 1) for guildId in guildIds])
+        conn.commit()
+    finally:
+        conn.close()
+
+async def runWorker(url: str):
+    """Runs the bot in this process until it is ready, saves a completed match for each of its guilds and reports what it owns."""
+    import bot as botModule
+    from rainbow import RainbowMatch
+
+    useFakeDiscord(url)
+    bot = botModule.bot = botModule.RainbowBot()
+
+    async def report():
+        await bot.wait_until_ready()
+        matches = [RainbowMatch() for _ in bot.guilds]
+        for match in matches:
+            match.setMap('bank')
+        await bot.saveCompletedMatches([(guild.id, match) for guild, match in zip(bot.guilds, matches)])
+        print(json.dumps({
+            'shardIds': sorted(bot.shards) if hasattr(bot, 'shards') else None,
+            'guildIds': sorted(guild.id for guild in bot.guilds),
+            'ongoingGuildIds': sorted(serverId for serverId, _ in bot.ongoingMatches)
+        }))
+        await bot.close()
+
+    reporter = asyncio.create_task(report())
+    await bot.start('fake-token')
+    await reporter
+
+async def runProcess(url: str, environment: dict):
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, os.path.abspath(__file__), '--worker', url,
+        env={**os.environ, **environment}, stdout=asyncio.subprocess.PIPE,
+        cwd=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    )
+    stdout, _ = await asyncio.wait_for(process.communicate(), timeout=60)
+    if process.returncode != 0:
+        raise RuntimeError(f'Bot process with {environment} exited with {process.returncode}')
+    return json.loads(stdout.decode().strip().splitlines()[-1])
+
+async def main(args):
+    guildIds = createGuildIds(args.guilds)
+    fake = FakeDiscord(guildIds, args.shards)
+    url = await fake.start()
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            databasePath = os.path.join(directory, 'shared.db')
+            seedOngoingMatches(databasePath, guildIds)
+            environment = {'DISCORD_BOT_TOKEN': 'fake-token', 'DATABASE_PATH': databasePath, 'SHARD_COUNT': str(args.shards)}
+
+            shardRanges = splitShards(args.shards, args.processes)
+            reports = await asyncio.gather(*[runProcess(url, {**environment, 'SHARD_IDS': shardRange}) for shardRange in shardRanges])
+            seenGuildIds = []
+            for shardRange, report in zip(shardRanges, reports):
+                assert report['ongoingGuildIds'] == report['guildIds'], f'Shards {shardRange} restored the matches of {report["ongoingGuildIds"]} but handle {report["guildIds"]}'
+                print(f'Shards {shardRange}: {len(report["guildIds"])} guilds, {len(report["ongoingGuildIds"])} ongoing matches restored')
+                seenGuildIds += report['guildIds']
+            assert sorted(seenGuildIds) == sorted(guildIds), 'Every guild must be handled by exactly one process'
+
+            # A single process using the number of shards recommended by Discord handles everything
+            report = await runProcess(url, {**environment, 'SHARD_COUNT': 'auto'})
+            assert report['shardIds'] == list(range(args.shards)) and report['guildIds'] == sorted(guildIds), report
+            print(f'SHARD_COUNT=auto: {len(report["shardIds"])} shards, {len(report["guildIds"])} guilds')
+
+            conn = sqlite3.connect(databasePath)
+            numMatches = conn.execute("SELECT COUNT(*) FROM matches").fetchone()[0]
+            conn.close()
+            assert numMatches == 2 * len(guildIds), f'Expected {2 * len(guildIds)} completed matches in the shared database, found {numMatches}'
+            print(f'{numMatches} completed matches written to the shared database by {len(shardRanges) + 1} processes')
+    finally:
+        await fake.stop()
+
+if __name__ == '__main__':
+    if len(sys.argv) == 3 and sys.argv[1] == '--worker':
+        asyncio.run(runWorker(sys.argv[2]))
+    else:
+        parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+        parser.add_argument('--guilds', type=int, default=32)
+        parser.add_argument('--shards', type=int, default=4)
+        parser.add_argument('--processes', type=int, default=2)
+        asyncio.run(main(parser.parse_args()))
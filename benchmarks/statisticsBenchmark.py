@@ -0,0 +1,155 @@
+"""Compares the latency of the "!stats" reports computed from the raw tables (the previous implementation) with the current rollup-based implementation, on a synthetic match history.
+Also measures reports served from the statistics cache, as happens for every repeated "!stats" until a match of the player or server is saved.
+
+Usage: python benchmarks/statisticsBenchmark.py [--rounds 100000] [--players 5] [--repeat 5]
+"""
+import argparse
+import asyncio
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+import types
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from cogs.statistics import Statistics
+from migrations import migrate
+from rainbow import RainbowData, RainbowMatch
+from sqliteStorage import SqliteStorage
+from statisticsCache import StatisticsCache
+from storage import getCompletedMatchRows
+
+SERVER_ID = 1
+
+def generateHistory(path: str, numRounds: int, numPlayers: int, seed: int = 0):
+    """Fills a new database with randomly played matches until it holds at least numRounds rounds."""
+    rng = random.Random(seed)
+    players = [{'id': i, 'mention': f'<@{i}>', 'name': f'player{i}', 'nick': None, 'global_name': None} for i in range(1, numPlayers + 1)]
+
+    conn = sqlite3.connect(path)
+    migrate(conn)
+    playedRounds = 0
+    while playedRounds < numRounds:
+        matches = []
+        for _ in range(500):
+            match = RainbowMatch()
+            match.matchId = str(uuid.UUID(int=rng.getrandbits(128)))
+            match.players = players
+            match.map = rng.choice(list(RainbowData.maps.keys())[:-1])
+            onDefense = rng.random() < 0.5
+            # Play rounds until one side has won four rounds, switching sides after three rounds
+            while max(match.scores.values()) < 4:
+                won = rng.random() < 0.5
+                match.scores['blue' if won else 'red'] += 1
+                match.rounds.append({
+                    'site': rng.randrange(len(RainbowData.maps[match.map])) if onDefense else None,
+                    'operators': [-rng.randint(1, len(RainbowData.defenders)) if onDefense else rng.randint(1, len(RainbowData.attackers)) for _ in players],
+                    'result': int(won),
+                    'playerStats': {'interrogations': {str(players[0]['id']): 1}} if onDefense and rng.random() < 0.1 else {}
+                })
+                if len(match.rounds) == 3:
+                    onDefense = not onDefense
+            playedRounds += len(match.rounds)
+            matches.append((SERVER_ID, match))
+        SqliteStorage._writeCompletedMatches(conn, getCompletedMatchRows(matches))
+        conn.commit()
+    conn.close()
+    return playedRounds
+
+def legacyReport(conn: sqlite3.Connection, statisticType: str, targetId: int):
+    """The previous implementation: loads every raw row, queries the sites of each top map separately and counts plays with a pass over all rows."""
+    if statisticType == 'overall':
+        maps = conn.execute("SELECT matches.map, matches.result FROM matches JOIN player_matches ON matches.match_id = player_matches.match_id WHERE player_matches.player_id = ?", (targetId,)).fetchall()
+        operators = conn.execute("SELECT player_rounds.operator, rounds.result FROM player_rounds JOIN rounds ON player_rounds.match_id = rounds.match_id AND player_rounds.round_num = rounds.round_num WHERE player_rounds.player_id = ?", (targetId,)).fetchall()
+        sitesQuery = "SELECT rounds.site, rounds.result FROM rounds JOIN matches ON rounds.match_id = matches.match_id JOIN player_rounds ON rounds.match_id = player_rounds.match_id AND rounds.round_num = player_rounds.round_num WHERE matches.map = ? AND player_rounds.player_id = ?"
+    else:
+        maps = conn.execute("SELECT matches.map, matches.result FROM matches WHERE matches.server_id = ?", (targetId,)).fetchall()
+        operators = conn.execute("SELECT player_rounds.operator, rounds.result FROM player_rounds JOIN rounds ON player_rounds.match_id = rounds.match_id AND player_rounds.round_num = rounds.round_num JOIN matches ON player_rounds.match_id = matches.match_id WHERE matches.server_id = ?", (targetId,)).fetchall()
+        sitesQuery = "SELECT rounds.site, rounds.result FROM rounds JOIN matches ON rounds.match_id = matches.match_id WHERE matches.map = ? AND matches.server_id = ?"
+
+    def winLoss(rows):
+        res = {}
+        for key, result in rows:
+            res.setdefault(key, {'wins': 0, 'losses': 0})['wins' if result == 1 else 'losses'] += 1
+        return res
+
+    def ratio(winsLosses):
+        return winsLosses['wins'] / winsLosses['losses'] if winsLosses['losses'] != 0 else winsLosses['wins']
+
+    message = ''
+    mapsWinLoss = winLoss(maps)
+    for map in sorted(mapsWinLoss, key=lambda x: ratio(mapsWinLoss[x]), reverse=True)[:3]:
+        numMapPlays = len([m for m in maps if m[0] == map])
+        siteWinsLosses = winLoss(conn.execute(sitesQuery, (map, targetId)).fetchall())
+        message += f'{map}: {round(ratio(mapsWinLoss[map]), 2)} ({numMapPlays} plays) {siteWinsLosses}\n'
+
+    operatorWinsLosses = winLoss(operators)
+    for side in [lambda op: op > 0, lambda op: op < 0]:
+        sideOperators = {op: winsLosses for op, winsLosses in operatorWinsLosses.items() if side(op)}
+        for operator in sorted(sideOperators, key=lambda x: ratio(sideOperators[x]), reverse=True)[:3]:
+            numOperatorPlays = len([o for o in operators if o[0] == operator])
+            message += f'{operator}: {round(ratio(sideOperators[operator]), 2)} ({numOperatorPlays} plays)\n'
+    return message
+
+async def currentReport(cog: Statistics, statisticType: str, targetId: int):
+    """The current implementation, as used by the "!stats" command."""
+    if statisticType == 'overall':
+        player = types.SimpleNamespace(id=targetId)
+        maps, operators = await asyncio.gather(cog._getPlayerStatisticFromDatabase(player, 'maps'), cog._getPlayerStatisticFromDatabase(player, 'operators'))
+    else:
+        server = types.SimpleNamespace(id=targetId)
+        maps, operators = await asyncio.gather(cog._getServerStatisticFromDatabase(server, 'maps'), cog._getServerStatisticFromDatabase(server, 'operators'))
+    return cog._createMapStatisticsString(maps) + cog._createOperatorStatisticsString(operators)
+
+def printTimings(name: str, timings: list):
+    print(f'{name:<28} median {statistics.median(timings) * 1000:10.2f} ms    min {min(timings) * 1000:10.2f} ms')
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rounds', type=int, default=100000, help='Minimum number of rounds in the synthetic history')
+    parser.add_argument('--players', type=int, default=5, help='Number of players playing every match')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of times each report is computed')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'benchmark.db')
+        start = time.perf_counter()
+        numRounds = generateHistory(path, args.rounds, args.players)
+        print(f'Generated {numRounds} rounds played by {args.players} players in {time.perf_counter() - start:.1f} s\n')
+
+        conn = sqlite3.connect(path)
+        storage = SqliteStorage(path)
+        await storage.open()
+        cog = Statistics(types.SimpleNamespace(storage=storage, statisticsCache=StatisticsCache(100)))
+        try:
+            for statisticType, targetId in [('overall', 1), ('server', SERVER_ID)]:
+                before, after, cached = [], [], []
+                for _ in range(args.repeat):
+                    start = time.perf_counter()
+                    legacyReport(conn, statisticType, targetId)
+                    before.append(time.perf_counter() - start)
+
+                    start = time.perf_counter()
+                    await currentReport(cog, statisticType, targetId)
+                    after.append(time.perf_counter() - start)
+
+                    kind, target = 'player' if statisticType == 'overall' else 'server', types.SimpleNamespace(id=targetId)
+                    await cog._getStatisticsReport(kind, target)
+                    start = time.perf_counter()
+                    await cog._getStatisticsReport(kind, target)
+                    cached.append(time.perf_counter() - start)
+                printTimings(f'!stats {statisticType} (before)', before)
+                printTimings(f'!stats {statisticType} (after)', after)
+                printTimings(f'!stats {statisticType} (cached)', cached)
+                print(f'Speedup: {statistics.median(before) / statistics.median(after):.1f}x\n')
+        finally:
+            conn.close()
+            await storage.close()
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,262 @@
+"""Runs the same conformance checks and throughput measurements against every storage backend.
+The conformance checks compare the statistics each backend returns with statistics computed directly from the saved matches, through saving, deleting and rebuilding.
+
+SQLite is always checked, on a temporary file. PostgreSQL is checked on an empty database given with --postgres, on a temporary server started
+with the initdb and pg_ctl binaries of a local PostgreSQL installation if --start-postgres is given, or on the server of benchmarks/docker-compose.yml
+if --compose-postgres is given, which needs Docker Compose but no local PostgreSQL. All of them need the asyncpg package.
+
+Usage: python benchmarks/storageCheck.py [--matches 300] [--postgres postgresql://user@host/emptydb | --start-postgres | --compose-postgres]
+"""
+import argparse
+import asyncio
+import glob
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from rainbow import RainbowData, RainbowMatch
+from statisticsRollups import MATCH_SITE
+from storage import PLAYER_STATISTICS_QUERIES, SERVER_STATISTICS_QUERIES, createStorage
+
+COMPOSE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'docker-compose.yml')
+COMPOSE_POSTGRES_URL = 'postgresql://postgres@127.0.0.1:55432/postgres'
+
+SERVER_IDS = [1 << 40, 2 << 40]
+PLAYER_IDS = [(1 << 50) + i for i in range(8)]
+
+def generateMatches(rng: random.Random, numMatches: int):
+    """Returns (serverId, match) tuples of randomly played matches."""
+    matches = []
+    for _ in range(numMatches):
+        match = RainbowMatch()
+        match.matchId = str(uuid.UUID(int=rng.getrandbits(128)))
+        match.players = [{'id': playerId, 'mention': f'<@{playerId}>', 'name': str(playerId), 'nick': None, 'global_name': None} for playerId in rng.sample(PLAYER_IDS, rng.randint(1, 5))]
+        match.map = rng.choice(list(RainbowData.maps.keys())[:-1])
+        onDefense = rng.random() < 0.5
+        while max(match.scores.values()) < 4:
+            won = rng.random() < 0.5
+            match.scores['blue' if won else 'red'] += 1
+            match.rounds.append({
+                'site': rng.randrange(len(RainbowData.maps[match.map])) if onDefense else None,
+                'operators': [-rng.randint(1, len(RainbowData.defenders)) if onDefense else rng.randint(1, len(RainbowData.attackers)) for _ in match.players],
+                'result': int(won),
+                'playerStats': {'interrogations': {str(match.players[0]['id']): 1}} if onDefense and rng.random() < 0.2 else {}
+            })
+            if len(match.rounds) == 3:
+                onDefense = not onDefense
+        matches.append((rng.choice(SERVER_IDS), match))
+    return matches
+
+def expectedStatistics(matches: list, allMatches: list):
+    """Computes the rows every statistics query should return from the matches, the additional statistics from allMatches as they are never subtracted."""
+    counters = {}
+    def count(kind: str, targetId: int, key: tuple, won: bool):
+        winsLosses = counters.setdefault((kind, targetId), {}).setdefault(key, [0, 0])
+        winsLosses[0 if won else 1] += 1
+
+    for serverId, match in matches:
+        won = match.scores['blue'] > match.scores['red']
+        count('serverMaps', serverId, (match.map, MATCH_SITE), won)
+        for player in match.players:
+            count('playerMaps', player['id'], (match.map, MATCH_SITE), won)
+        for round in match.rounds:
+            roundWon = round['result'] == 1
+            count('serverMaps', serverId, (match.map, round['site']), roundWon)
+            for player, operator in zip(match.players, round['operators']):
+                count('playerMaps', player['id'], (match.map, round['site']), roundWon)
+                count('playerOperators', player['id'], (operator,), roundWon)
+                count('serverOperators', serverId, (operator,), roundWon)
+
+    additionalStatistics = {}
+    for _, match in allMatches:
+        for round in match.rounds:
+            for statType, players in round['playerStats'].items():
+                for playerId, value in players.items():
+                    key = (int(playerId), statType)
+                    additionalStatistics[key] = additionalStatistics.get(key, 0) + value
+
+    def rows(kind: str, targetId: int):
+        return sorted((key + tuple(winsLosses) for key, winsLosses in counters.get((kind, targetId), {}).items()), key=repr)
+
+    expected = {}
+    for playerId in PLAYER_IDS:
+        expected[('player', playerId, 'maps')] = rows('playerMaps', playerId)
+        expected[('player', playerId, 'operators')] = rows('playerOperators', playerId)
+        expected[('player', playerId, 'additionalStatistics')] = sorted((statType, value) for (statPlayerId, statType), value in additionalStatistics.items() if statPlayerId == playerId)
+    for serverId in SERVER_IDS:
+        expected[('server', serverId, 'maps')] = rows('serverMaps', serverId)
+        expected[('server', serverId, 'operators')] = rows('serverOperators', serverId)
+    return expected
+
+async def readStatistics(storage):
+    actual = {}
+    for playerId in PLAYER_IDS:
+        for statType in PLAYER_STATISTICS_QUERIES:
+            actual[('player', playerId, statType)] = sorted((tuple(row) for row in await storage.getPlayerStatistics(playerId, statType)), key=repr)
+    for serverId in SERVER_IDS:
+        for statType in SERVER_STATISTICS_QUERIES:
+            actual[('server', serverId, statType)] = sorted((tuple(row) for row in await storage.getServerStatistics(serverId, statType)), key=repr)
+    return actual
+
+async def checkStatistics(storage, matches: list, allMatches: list, step: str):
+    expected, actual = expectedStatistics(matches, allMatches), await readStatistics(storage)
+    for key in expected:
+        assert actual[key] == expected[key], f'{step}: {key} returned {actual[key]}, expected {expected[key]}'
+
+async def checkConformance(createBackend, numMatches: int):
+    """Runs every operation of the storage interface on an empty database and checks the results."""
+    # Several processes may start at once, all of them must end up on the latest schema
+    storages = [createBackend() for _ in range(3)]
+    versions = await asyncio.gather(*[storage.open() for storage in storages])
+    assert len({currentVersion for _, currentVersion in versions}) == 1, f'Concurrent migrations ended on different versions: {versions}'
+    for storage in storages[1:]:
+        await storage.close()
+    storage = storages[0]
+    try:
+        # Ongoing matches
+        await storage.writeOngoingMatches([(1, 10, b'\x01\x02', '{"matchMessageId": 5}'), (1, 11, None, None), (2, 10, b'\x03', None)], [])
+        await storage.writeOngoingMatches([(1, 10, b'\x04', None)], [(1, 11), (3, 3)])
+        ongoingMatches = sorted(tuple(row) for row in await storage.loadOngoingMatches())
+        assert ongoingMatches == [(1, 10, b'\x04', None), (2, 10, b'\x03', None)], f'Ongoing matches: {ongoingMatches}'
+        await storage.writeOngoingMatches([], [(1, 10), (2, 10)])
+        assert list(await storage.loadOngoingMatches()) == [], 'Ongoing matches were not deleted'
+
+        # Completed matches and their statistics
+        rng = random.Random(0)
+        matches = generateMatches(rng, numMatches)
+        for start in range(0, len(matches), 50):
+            await storage.saveCompletedMatches(matches[start:start + 50])
+        await checkStatistics(storage, matches, matches, 'After saving')
+
+        deleted = matches[::7]
+        for serverId, match in deleted:
+            affected = await storage.deleteMatch(match.matchId)
+            assert affected is not None and affected[0] == serverId and sorted(affected[1]) == sorted(player['id'] for player in match.players), f'Deleting {match.matchId} returned {affected}'
+        assert await storage.deleteMatch(deleted[0][1].matchId) is None, 'Deleting a missing match did not return None'
+        remaining = [entry for entry in matches if entry not in deleted]
+        await checkStatistics(storage, remaining, matches, 'After deleting')
+
+        await storage.rebuildStatistics()
+        await checkStatistics(storage, remaining, matches, 'After rebuilding')
+
+        withoutMap = generateMatches(rng, 5)
+        for _, match in withoutMap:
+            match.map = None
+        await storage.saveCompletedMatches(withoutMap)
+        await storage.deleteMatchesWithoutMap()
+        await checkStatistics(storage, remaining, matches + withoutMap, 'After deleting matches without a map')
+    finally:
+        await storage.close()
+
+async def measureThroughput(createBackend, numMatches: int):
+    """Measures the operations per second of the workloads of the bot: saving single matches, flushing ongoing matches and reading statistics."""
+    storage = createBackend()
+    await storage.open()
+    results = {}
+    try:
+        matches = generateMatches(random.Random(1), numMatches)
+        start = time.perf_counter()
+        for entry in matches:
+            await storage.saveCompletedMatches([entry])
+        results['completed matches saved/s'] = numMatches / (time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for i in range(100):
+            await storage.writeOngoingMatches([(serverId, i, os.urandom(200), '{}') for serverId in range(50)], [])
+        results['ongoing matches flushed/s'] = 100 * 50 / (time.perf_counter() - start)
+
+        numReads = 2000
+        start = time.perf_counter()
+        await asyncio.gather(*[storage.getPlayerStatistics(PLAYER_IDS[i % len(PLAYER_IDS)], 'maps') for i in range(numReads)])
+        results['statistics reads/s'] = numReads / (time.perf_counter() - start)
+    finally:
+        await storage.close()
+    return results
+
+def _getFreePort():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def startPostgres(directory: str):
+    """Starts a throwaway PostgreSQL server in the directory and returns its URL, or None if PostgreSQL is not installed."""
+    binDirectories = [os.path.dirname(path) for path in [shutil.which('pg_ctl')] if path] + sorted(glob.glob('/usr/lib/postgresql/*/bin'), reverse=True)
+    if not binDirectories:
+        return None
+    pgCtl = os.path.join(binDirectories[0], 'pg_ctl')
+    dataDirectory = os.path.join(directory, 'data')
+    subprocess.run([os.path.join(binDirectories[0], 'initdb'), '-D', dataDirectory, '-U', 'postgres', '--auth=trust', '-E', 'UTF8'], check=True, stdout=subprocess.DEVNULL)
+    port = _getFreePort()
+    subprocess.run([pgCtl, '-D', dataDirectory, '-l', os.path.join(directory, 'server.log'), '-w', '-o', f'-p {port} -k {directory} -c listen_addresses=127.0.0.1', 'start'], check=True, stdout=subprocess.DEVNULL)
+    return f'postgresql://postgres@127.0.0.1:{port}/postgres'
+
+def stopPostgres(directory: str):
+    pgCtl = shutil.which('pg_ctl') or os.path.join(sorted(glob.glob('/usr/lib/postgresql/*/bin'), reverse=True)[0], 'pg_ctl')
+    subprocess.run([pgCtl, '-D', os.path.join(directory, 'data'), '-m', 'fast', 'stop'], check=True, stdout=subprocess.DEVNULL)
+
+def startComposePostgres():
+    """Starts the PostgreSQL server of the compose file, waits until it accepts connections and returns its URL."""
+    subprocess.run(['docker', 'compose', '-f', COMPOSE_FILE, 'up', '--detach', '--wait', 'postgres'], check=True)
+    return COMPOSE_POSTGRES_URL
+
+def stopComposePostgres():
+    subprocess.run(['docker', 'compose', '-f', COMPOSE_FILE, 'down', '--volumes'], check=True)
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--matches', type=int, default=300, help='Number of matches saved by the conformance checks and the throughput measurement')
+    parser.add_argument('--postgres', help='URL of an empty PostgreSQL database, which will be modified')
+    parser.add_argument('--start-postgres', action='store_true', help='Start a temporary PostgreSQL server from a local installation')
+    parser.add_argument('--compose-postgres', action='store_true', help='Start the PostgreSQL server of benchmarks/docker-compose.yml and remove it afterwards')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        backends = [('SQLite', lambda name: os.path.join(directory, f'{name}.db'))]
+        postgresUrl = args.postgres
+        postgresDirectory = None
+        if postgresUrl is None and args.compose_postgres:
+            postgresUrl = startComposePostgres()
+        elif postgresUrl is None and args.start_postgres:
+            postgresDirectory = os.path.join(directory, 'postgres')
+            os.makedirs(postgresDirectory)
+            postgresUrl = startPostgres(postgresDirectory)
+            if postgresUrl is None:
+                postgresDirectory = None
+                print('PostgreSQL is not installed, skipping it')
+        if postgresUrl is not None:
+            backends.append(('PostgreSQL', lambda name: postgresUrl))
+
+        try:
+            for backendName, getDatabase in backends:
+                await checkConformance(lambda: createStorage(getDatabase('conformance')), args.matches)
+                print(f'{backendName}: all conformance checks passed')
+                if backendName == 'PostgreSQL':
+                    # The throughput is measured on the same database, so start from empty tables again
+                    await _truncatePostgres(postgresUrl)
+                for name, value in (await measureThroughput(lambda: createStorage(getDatabase('throughput')), args.matches)).items():
+                    print(f'{backendName}: {value:10.0f} {name}')
+        finally:
+            if postgresDirectory is not None:
+                stopPostgres(postgresDirectory)
+            if args.compose_postgres and args.postgres is None:
+                stopComposePostgres()
+
+async def _truncatePostgres(url: str):
+    import asyncpg
+    conn = await asyncpg.connect(url)
+    try:
+        tables = [row[0] for row in await conn.fetch("SELECT tablename FROM pg_tables WHERE schemaname = current_schema() AND tablename <> 'schema_version'")]
+        await conn.execute(f"TRUNCATE {', '.join(tables)}")
+    finally:
+        await conn.close()
+
+if __name__ == '__main__':
+    asyncio.run(main())
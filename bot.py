@@ -1,160 +1,211 @@
+# Imported first, so the startup profile includes the time spent importing everything else
+from startupProfile import startupProfile
 import discord
-from itertools import zip_longest
 import json
 import os
-import sqlite3
-from discord.ext import commands
+import sys
+from discord.ext import commands, tasks
 from dotenv import load_dotenv
+from guildExecutor import GuildExecutor
+from loopWatchdog import LoopWatchdog
+from matchCodec import decodeMatch, encodeMatch
+from matchControls import MatchControlButton, createControlsView
+import metrics
+from messageTracker import MessageTracker, RECENT_MESSAGE_LIMIT
+from migrations import LEGACY_CHANNEL_ID
+from outbound import OutboundQueue, RateLimitBucket
 from rainbow import RainbowMatch
+import reactionPlanner
+from sharding import getShardId, parseShardCount, parseShardIds
+from statisticsCache import StatisticsCache
+from storage import createStorage
 from version import __version__ as VERSION
 
 load_dotenv()
 TOKEN = os.getenv('DISCORD_BOT_TOKEN')
 IS_DEBUG = os.getenv('IS_DEBUG') == '1'
+# How often (in seconds) changes to ongoing matches are written to the database
+MATCH_FLUSH_INTERVAL = float(os.getenv('MATCH_FLUSH_INTERVAL', '5'))
+# How long (in seconds) updates of a match message are held back to be merged with further updates
+MESSAGE_EDIT_DEBOUNCE = float(os.getenv('MESSAGE_EDIT_DEBOUNCE', '0.3'))
+# Match messages are controlled with buttons, unless reactions are enabled instead
+USE_REACTION_CONTROLS = os.getenv('USE_REACTION_CONTROLS') == '1'
+# The bot connects to Discord over several shards if SHARD_COUNT is set, either to a number or to "auto" for the number recommended by Discord.
+# SHARD_IDS limits this process to some of the shards (e.g. "0-3"), so the shards can be spread over several processes
+SHARD_COUNT = parseShardCount(os.getenv('SHARD_COUNT'))
+SHARD_IDS = parseShardIds(os.getenv('SHARD_IDS'), SHARD_COUNT)
+# All processes of a sharded bot must use the same database. DATABASE_URL selects a PostgreSQL server (postgresql://...) instead of the SQLite file at DATABASE_PATH
+DATABASE_PATH = os.getenv('DATABASE_PATH', 'data/rainbowDiscordBot.db')
+DATABASE_URL = os.getenv('DATABASE_URL')
+# How many player and server statistics reports are kept in memory
+STATS_CACHE_SIZE = int(os.getenv('STATS_CACHE_SIZE', '1000'))
+# How long (in seconds) a sharded process may show player statistics, which other processes can change without it knowing
+SHARDED_PLAYER_STATS_MAX_AGE = 60
+# If METRICS_PORT is set, timings and counters are served in the Prometheus text format at http://METRICS_HOST:METRICS_PORT/metrics
+METRICS_PORT = int(os.getenv('METRICS_PORT')) if os.getenv('METRICS_PORT') else None
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+# The event loop being blocked for longer than this (in seconds) is logged with the stack and command that blocked it, 0 turns the watchdog off
+LOOP_LAG_THRESHOLD = float(os.getenv('LOOP_LAG_THRESHOLD', '0.25'))
+# Prints how long each phase of the startup took once the bot is ready
+PROFILE_STARTUP = os.getenv('PROFILE_STARTUP') == '1'
+
+COGS = [
+    'matchManagement',
+    'ongoingMatch',
+    'trackingMatchStatistics',
+    'statistics',
+    'general'
+]
 
 if IS_DEBUG:
     print('DEBUG MODE: Running in debug mode')
 
 print(f'Running RandomSixBot v{VERSION}')
+if SHARD_COUNT is not None:
+    print(f'Running {"all shards" if SHARD_IDS is None else "shards " + ", ".join(map(str, SHARD_IDS))} of {SHARD_COUNT}')
 
-class RainbowBot(commands.Bot):
+class RainbowBot(commands.AutoShardedBot if SHARD_COUNT is not None else commands.Bot):
     def __init__(self):
-        os.makedirs('data', exist_ok=True)
-        self.conn = sqlite3.connect("data/rainbowDiscordBot.db")
-        self.cursor = self.conn.cursor()
-
-        # Currently ongoing matches, one per server
-        self.cursor.execute("""
-            CREATE TABLE IF NOT EXISTS ongoing_matches (
-                server_id INTEGER PRIMARY KEY,
-                match_data TEXT,
-                discord_message TEXT
-            )
-        """)
-
-        # Matches with their map and overall scores
-        self.cursor.execute("""
-            CREATE TABLE IF NOT EXISTS matches (
-                match_id TEXT PRIMARY KEY,
-                server_id INTEGER,
-                map TEXT,
-                result INTEGER
-            )
-        """)
-
-        # Players that have ever played in a match
-        self.cursor.execute("""
-            CREATE TABLE IF NOT EXISTS players (
-                player_id INTEGER PRIMARY KEY
-            )
-        """)
-
-        # Matches a certain player has played
-        self.cursor.execute("""
-            CREATE TABLE IF NOT EXISTS player_matches (
-                player_id INTEGER,
-                match_id TEXT,
-                PRIMARY KEY(player_id, match_id),
-                FOREIGN KEY(player_id) REFERENCES players(player_id),
-                FOREIGN KEY(match_id) REFERENCES matches(match_id)
-            )
-        """)
-
-        # Played sites and outcome for each round, 1 is win, 0 is loss
-        self.cursor.execute("""
-            CREATE TABLE IF NOT EXISTS rounds (
-                match_id TEXT,
-                round_num INTEGER,
-                site INTEGER,
-                result INTEGER,
-                PRIMARY KEY(match_id, round_num),
-                FOREIGN KEY(match_id) REFERENCES matches(match_id)
-            )
-        """)
-
-        # Operators played by a player in each round
-        self.cursor.execute("""
-            CREATE TABLE IF NOT EXISTS player_rounds (
-                player_id INTEGER,
-                match_id TEXT,
-                round_num INTEGER,
-                operator INTEGER,
-                PRIMARY KEY(player_id, match_id, round_num),
-                FOREIGN KEY(match_id) REFERENCES matches(match_id),
-                FOREIGN KEY(player_id) REFERENCES players(player_id)
-            )
-        """)
-
-        # Additional player statistics, such as Caveira interrogations, Aces etc.
-        self.cursor.execute("""
-            CREATE TABLE IF NOT EXISTS player_additional_stats (
-                player_id INTEGER,
-                stat_type INTEGER,
-                value INTEGER,
-                PRIMARY KEY(player_id, stat_type),
-                FOREIGN KEY(player_id) REFERENCES players(player_id)
-            )
-        """)
-
-        if IS_DEBUG:
-            print('DEBUG MODE: Deleting matches with no map set')
-            # Get all match ids where map is null
-            self.cursor.execute("SELECT match_id FROM matches WHERE map IS NULL")
-            match_ids = [row[0] for row in self.cursor.fetchall()]
-
-            # Delete data associated with these match ids in the other tables
-            for match_id in match_ids:
-                self.cursor.execute("DELETE FROM player_matches WHERE match_id = ?", (match_id,))
-                self.cursor.execute("DELETE FROM rounds WHERE match_id = ?", (match_id,))
-                self.cursor.execute("DELETE FROM player_rounds WHERE match_id = ?", (match_id,))
-
-            # Delete matches where map is null
-            self.cursor.execute("DELETE FROM matches WHERE map IS NULL")
-
-        self.conn.commit()
+        startupProfile.mark('imports')
+        # Opened in setup_hook, as some backends can only connect on the event loop
+        self.storage = createStorage(DATABASE_URL or DATABASE_PATH)
+        # The shards run by this process, or None if it runs all of them. Each process only handles the ongoing matches of the servers on its shards
+        self.ownedShardIds = set(SHARD_IDS) if SHARD_IDS is not None else None
+        # Rendered statistics, dropped whenever a match of the player or server is saved or removed
+        self.statisticsCache = StatisticsCache(STATS_CACHE_SIZE, SHARDED_PLAYER_STATS_MAX_AGE if self.ownedShardIds is not None else None)
+
+        # Ongoing matches are kept in memory and written to the database in the background, keyed by (server id, channel id), so every channel can run its own match
+        self.ongoingMatches = {}
+        self._dirtyMatches = set()
+        # Message id -> match key of all match messages of ongoing matches, and the reverse
+        self.activeMatchMessages = {}
+        self._matchMessageIds = {}
+        # Channels whose match message lookup showed that the server's match saved before matches were kept per channel is not theirs
+        self._legacyMisses = set()
+        self.messageTracker = MessageTracker()
+        self.outbound = OutboundQueue(self._manageReactions, MESSAGE_EDIT_DEBOUNCE)
+        # Commands and reactions of one channel are handled one at a time, so they never modify the same match concurrently
+        self.guildExecutor = GuildExecutor()
+        self.loopWatchdog = LoopWatchdog(LOOP_LAG_THRESHOLD)
+        self._metricsRunner = None
+        metrics.registry.addCollector('guild_executor', self.guildExecutor.getMetrics)
+        metrics.registry.addCollector('statistics_cache', self.statisticsCache.getMetrics)
+        metrics.registry.addCollector('loop_watchdog', self.loopWatchdog.getMetrics)
+        metrics.registry.addCollector('bot', self.getMetrics)
 
         intents = discord.Intents.default()
         intents.members = True
         intents.message_content = True
 
-        commands.Bot.__init__(self, command_prefix='!', intents=intents, case_insensitive=True, help_command=commands.HelpCommand())
-
-    async def on_ready(self):
-        print(f'Logged in as {bot.user}')
-        cogs_list = [
-            'matchManagement',
-            'ongoingMatch',
-            'trackingMatchStatistics',
-            'statistics',
-            'general'
-        ]
-        for cog in cogs_list:
-            await bot.load_extension(f'cogs.{cog}')
-
+        shardOptions = {'shard_count': SHARD_COUNT, 'shard_ids': SHARD_IDS} if isinstance(SHARD_COUNT, int) else {}
+        # The presence is sent when connecting, so it is kept after reconnects without setting it again
+        activity = discord.Activity(type=discord.ActivityType.playing, name='the development build' if IS_DEBUG else '!startMatch here | !help')
+        super().__init__(command_prefix='!', intents=intents, case_insensitive=True, help_command=commands.HelpCommand(), activity=activity, **shardOptions)
+        startupProfile.mark('create the bot')
+
+    async def setup_hook(self):
+        """Prepares everything that must be ready before the first event arrives. Unlike on_ready, this only runs once, before connecting to the gateway."""
+        startupProfile.mark('log in')
+        if LOOP_LAG_THRESHOLD > 0:
+            self.loopWatchdog.start()
+            if IS_DEBUG:
+                # asyncio names every callback that runs too long, at the cost of slowing down the whole loop
+                self.loop.set_debug(True)
+                self.loop.slow_callback_duration = LOOP_LAG_THRESHOLD
+        previousVersion, currentVersion = await self.storage.open()
+        if currentVersion != previousVersion:
+            print(f'Migrated the database from schema version {previousVersion} to {currentVersion}')
         if IS_DEBUG:
-            await bot.change_presence(activity=discord.Activity(type=discord.ActivityType.playing, name='the development build'))
-        else:
-            await bot.change_presence(activity=discord.Activity(type=discord.ActivityType.playing, name='!startMatch here | !help'))
+            print('DEBUG MODE: Deleting matches with no map set')
+            await self.storage.deleteMatchesWithoutMap()
+        startupProfile.mark('open the database')
+        await self._loadOngoingMatches()
+        startupProfile.mark('load ongoing matches')
+
+        for cog in COGS:
+            await self.load_extension(f'cogs.{cog}')
+        startupProfile.mark('load cogs')
+
+        self.add_dynamic_items(MatchControlButton)
+        self.flushOngoingMatchesTask.change_interval(seconds=MATCH_FLUSH_INTERVAL)
+        self.flushOngoingMatchesTask.start()
+        if METRICS_PORT is not None:
+            self._metricsRunner = await metrics.startServer(METRICS_HOST, METRICS_PORT)
+            print(f'Serving metrics at http://{METRICS_HOST}:{METRICS_PORT}/metrics')
+        startupProfile.mark('start background tasks')
+
+    async def close(self):
+        self.loopWatchdog.stop()
+        self.flushOngoingMatchesTask.cancel()
+        await self.outbound.flush()
+        await self.flushOngoingMatches()
+        await super().close()
+        await self.storage.close()
+        if self._metricsRunner is not None:
+            await self._metricsRunner.cleanup()
+            self._metricsRunner = None
+
+    def getMetrics(self):
+        return {
+            'guilds': len(self.guilds),
+            'ongoingMatches': len(self.ongoingMatches),
+            'unsavedMatches': len(self._dirtyMatches),
+            'heartbeatLatency': self.latency
+        }
 
-    async def on_reaction_add(self, reaction: discord.Reaction, user: discord.User):
-        """Handles reactions being added to messages."""
-        ctx: commands.Context = await self.get_context(reaction.message)
+    async def on_ready(self):
+        # Also called after every reconnect that could not resume the previous session
+        print(f'Logged in as {self.user}')
+        if startupProfile.finish('connect to the gateway') and PROFILE_STARTUP:
+            print(startupProfile.getReport())
+
+    async def invoke(self, ctx: commands.Context):
+        """Invokes a command, after all earlier commands and reactions of the same channel are done."""
+        if ctx.guild is None:
+            await super().invoke(ctx)
+            return
+        async with self.guildExecutor.serialize(self.getMatchKey(ctx)):
+            if ctx.command is None:
+                await super().invoke(ctx)
+                return
+            labels = {'command': ctx.command.qualified_name, 'cog': ctx.cog.qualified_name if ctx.cog is not None else ''}
+            with metrics.timed('command_seconds', **labels), self.loopWatchdog.label(ctx.guild.id, labels['command']):
+                await super().invoke(ctx)
+            if ctx.command_failed:
+                metrics.increment('command_errors_total', **labels)
+
+    async def handleMatchControl(self, interaction: discord.Interaction, matchId: str, emoji: str):
+        """Handles a click on a button of a match message, which has already been acknowledged."""
+        async with self.guildExecutor.serialize((interaction.guild_id, interaction.channel_id)):
+            with metrics.timed('control_seconds', control=emoji, kind='button'), self.loopWatchdog.label(interaction.guild_id, f'button {emoji}'):
+                await self._handleControl(interaction.message, interaction.user, emoji, matchId)
+
+    async def _handleReaction(self, payload: discord.RawReactionActionEvent):
+        """Handles reactions being added to match messages."""
+        channel = self.get_channel(payload.channel_id)
+        # Removing a reaction does not need the message itself, so it also works for messages discord.py has not cached
+        await discord.PartialMessage(channel=channel, id=payload.message_id).remove_reaction(payload.emoji, payload.member)
+        matchMessage = await self._getMessageForContext(channel, payload.message_id)
+        await self._handleControl(matchMessage, payload.member, str(payload.emoji))
+
+    async def _handleControl(self, matchMessage: discord.Message, user: discord.Member, emoji: str, matchId: str = None):
+        """Runs the action of a control of the match message, given by its emoji. Controls of an earlier match than the given one are ignored."""
+        ctx: commands.Context = await self.get_context(matchMessage)
         match, discordMessage, canContinue = await self.getMatchData(ctx, False)
 
-        if discordMessage is None or discordMessage['matchMessageId'] != reaction.message.id or user == bot.user:
-            return     
-        if user.mention not in [player['mention'] for player in match.players] or reaction.emoji not in discordMessage['reactions'] or not canContinue:
-            await reaction.message.remove_reaction(reaction, user)
+        if discordMessage is None or discordMessage['matchMessageId'] != matchMessage.id:
+            return
+        if match is None or (matchId is not None and match.matchId != matchId):
+            return
+        if user.mention not in [player['mention'] for player in match.players] or emoji not in discordMessage['reactions'] or not canContinue:
             return
-
-        await reaction.message.remove_reaction(reaction, user)
 
         # During a match
-        if reaction.emoji == '🇼': # Round was won
+        if emoji == '🇼': # Round was won
             await self.get_cog('Ongoing Match')._won(ctx)
-        elif reaction.emoji == '🇱': # Round was lost
+        elif emoji == '🇱': # Round was lost
             await self.get_cog('Ongoing Match')._lost(ctx)
-        elif reaction.emoji == '⚔️': # Starting (overtime) on attack
+        elif emoji == '⚔️': # Starting (overtime) on attack
             if match.currRound == 0:
                 await self.get_cog('Ongoing Match')._startAttack(ctx)
             elif (match.currRound == 6 and match.scores["red"] == 3):
@@ -163,7 +214,7 @@ class RainbowBot(commands.Bot):
                 await self.get_cog('Ongoing Match')._lost(ctx, 'attack')
             else:
                 print('Unknown reaction/match state combination: ⚔️', match.currRound, match.scores)
-        elif reaction.emoji == '🛡️': # Starting (overtime) on defense
+        elif emoji == '🛡️': # Starting (overtime) on defense
             if match.currRound == 0:
                 await self.get_cog('Ongoing Match')._startDefense(ctx)
             elif (match.currRound == 6 and match.scores["red"] == 3):
@@ -174,33 +225,66 @@ class RainbowBot(commands.Bot):
                 print('Unknown reaction/match state combination: 🛡️', match.currRound, match.scores)
 
         # End of match
-        elif reaction.emoji == '👍': # Play another match with the same players
+        elif emoji == '👍': # Play another match with the same players
             await self.get_cog('Match Management')._another(ctx)
-        elif reaction.emoji == '🎤': # Play another match with players in the current voice channel
-            member = reaction.message.guild.get_member(user.id)
-            ctx.author = member if member.voice else ctx.author
+        elif emoji == '🎤': # Play another match with players in the current voice channel
+            ctx.author = user if user.voice else ctx.author
             await self.get_cog('Match Management')._another(ctx, 'here')
-        elif reaction.emoji == '👎': # End the match
+        elif emoji == '👎': # End the match
             await self.get_cog('Match Management')._goodnight(ctx)
-        elif reaction.emoji == '✋': # End the match without saving statistics
+        elif emoji == '✋': # End the match without saving statistics
             await self.get_cog('Match Management')._goodnight(ctx, 'delete')
 
         # Statistics
-        elif reaction.emoji == '🗡️': # Player got an interrogation
+        elif emoji == '🗡️': # Player got an interrogation
             await self.get_cog('Tracking Match Statistics')._interrogation(ctx, user)
         else:
-            print('Unknown reaction:', reaction.emoji)
+            print('Unknown reaction:', emoji)
             return
 
     async def on_message(self, message: discord.Message):
+        self.messageTracker.onMessage(message)
         if message.content.startswith('!') and message.channel.type in [discord.ChannelType.public_thread, discord.ChannelType.private_thread, discord.ChannelType.news_thread]:
             await message.channel.send('You cannot use commands in threads, please try again in a text channel.')
             return
         await bot.process_commands(message)
 
-    def resetDiscordMessage(self, serverId: int):
-        self.cursor.execute("DELETE FROM ongoing_matches WHERE server_id = ?", (serverId,))
-        self.conn.commit()
+    async def on_raw_reaction_add(self, payload: discord.RawReactionActionEvent):
+        self.messageTracker.onReactionAdd(payload.channel_id, payload.message_id, payload.emoji, payload.user_id)
+        # Reactions on any other message only cost this lookup
+        if payload.message_id not in self.activeMatchMessages or payload.guild_id is None or payload.user_id == self.user.id:
+            return
+        async with self.guildExecutor.serialize((payload.guild_id, payload.channel_id)):
+            with metrics.timed('control_seconds', control=str(payload.emoji), kind='reaction'), self.loopWatchdog.label(payload.guild_id, f'reaction {payload.emoji}'):
+                await self._handleReaction(payload)
+
+    async def on_raw_reaction_remove(self, payload: discord.RawReactionActionEvent):
+        self.messageTracker.onReactionRemove(payload.channel_id, payload.message_id, payload.emoji, payload.user_id)
+
+    async def on_raw_reaction_clear(self, payload: discord.RawReactionClearEvent):
+        self.messageTracker.onReactionClear(payload.channel_id, payload.message_id)
+
+    async def on_raw_reaction_clear_emoji(self, payload: discord.RawReactionClearEmojiEvent):
+        self.messageTracker.onReactionClear(payload.channel_id, payload.message_id, payload.emoji)
+
+    async def on_raw_message_edit(self, payload: discord.RawMessageUpdateEvent):
+        if 'content' in payload.data:
+            self.messageTracker.onMessageEdit(payload.channel_id, payload.message_id, payload.data['content'])
+
+    async def on_raw_message_delete(self, payload: discord.RawMessageDeleteEvent):
+        self.messageTracker.onMessageDelete(payload.channel_id, payload.message_id)
+
+    async def on_raw_bulk_message_delete(self, payload: discord.RawBulkMessageDeleteEvent):
+        for messageId in payload.message_ids:
+            self.messageTracker.onMessageDelete(payload.channel_id, messageId)
+
+    @staticmethod
+    def getMatchKey(ctx: commands.Context):
+        """Returns the key of the ongoing match a command or control belongs to. Each channel of a server has its own match."""
+        return (ctx.guild.id, ctx.channel.id)
+
+    def resetDiscordMessage(self, matchKey: tuple):
+        self.deleteOngoingMatch(matchKey)
         return {
             'matchMessageId': None,
             'messageContent': {
@@ -217,136 +301,263 @@ class RainbowBot(commands.Bot):
 
     async def sendMatchMessage(self, ctx: commands.Context, discordMessage, forgetMatch=False):
         message = '\n'.join([v for v in discordMessage['messageContent'].values() if v != ''])
+        # Forgotten matches have all controls removed
+        if USE_REACTION_CONTROLS:
+            view = None
+            reactions = discordMessage['reactions'] if not forgetMatch else None
+        else:
+            ongoingMatch = self.ongoingMatches.get(self.getMatchKey(ctx))
+            matchId = ongoingMatch['match'].matchId if ongoingMatch is not None and ongoingMatch['match'] is not None else None
+            view = createControlsView(ctx.guild.id, matchId, discordMessage['reactions']) if not forgetMatch else None
+            # With buttons, the reactions left over from before are removed as well
+            reactions = None
 
         if discordMessage['matchMessageId']:
-            recentMessages = [message async for message in ctx.channel.history(limit=7)]
-            matchMessage: discord.Message = await ctx.channel.fetch_message(discordMessage['matchMessageId'])
-
-            if matchMessage in recentMessages:
-                numLinesInRecentMessages = 0
-                for recentMessage in recentMessages:
-                    if recentMessage.id == matchMessage.id:
-                        break
-                    numLinesInRecentMessages += len(recentMessage.content.split('\n'))
-
-                if numLinesInRecentMessages < 12:
-                    await matchMessage.edit(content=message)
-                else:
-                    if ctx.channel.get_thread(matchMessage.id) is None:
-                        await matchMessage.delete()
-                    else:
-                        discordMessage['messageContent']['actionPrompt'] = 'Use "**!startMatch**" to start a new match.'
-                        message = '\n'.join([v for v in discordMessage['messageContent'].values() if v != ''])
-                        await matchMessage.edit(content=message)
-                        await matchMessage.clear_reactions()
-                        await self.archiveThread(ctx, matchMessage.id)
-                    matchMessage = (await ctx.send(message))
-                    discordMessage['matchMessageId'] = matchMessage.id
+            matchMessage, isRecent = await self._getMatchMessage(ctx.channel, discordMessage['matchMessageId'])
+
+            if isRecent:
+                update = self.outbound.submit(matchMessage, message, view, reactions)
             else:
+                self.outbound.discard(matchMessage.id)
                 if ctx.channel.get_thread(matchMessage.id) is None:
                     await matchMessage.delete()
                 else:
                     discordMessage['messageContent']['actionPrompt'] = 'Use "**!startMatch**" to start a new match.'
                     message = '\n'.join([v for v in discordMessage['messageContent'].values() if v != ''])
-                    await matchMessage.edit(content=message)
+                    await matchMessage.edit(content=message, view=None)
                     await matchMessage.clear_reactions()
                     await self.archiveThread(ctx, matchMessage.id)
-                matchMessage = (await ctx.send(message))
-                discordMessage['matchMessageId'] = matchMessage.id
+                update = await self._sendNewMatchMessage(ctx, discordMessage, message, view, reactions)
         else:
-            matchMessage = (await ctx.send(message))
-            discordMessage['matchMessageId'] = matchMessage.id
+            update = await self._sendNewMatchMessage(ctx, discordMessage, message, view, reactions)
 
         if forgetMatch:
-            await matchMessage.clear_reactions()
-            self.resetDiscordMessage(ctx.guild.id)
+            # The message must be final before the caller continues, e.g. by archiving its thread
+            await update
+            self.outbound.discard(discordMessage['matchMessageId'])
+            self.resetDiscordMessage(self.getMatchKey(ctx))
             self.saveDiscordMessage(ctx, discordMessage)
         else:
             self.saveDiscordMessage(ctx, discordMessage)
-            await self._manageReactions(matchMessage, discordMessage)
 
-    async def _manageReactions(self, message: discord.Message, discordMessage):
-        currentReactions = [r.emoji for r in message.reactions]
+    async def _sendNewMatchMessage(self, ctx: commands.Context, discordMessage, message: str, view, reactions):
+        """Posts a new match message and schedules adding its reactions."""
+        with metrics.timed('discord_seconds', operation='sendMessage'):
+            matchMessage = (await ctx.send(message, view=view))
+        metrics.increment('discord_requests_total', request='sendMessage')
+        self._trackMatchMessage(matchMessage)
+        self.outbound.markSent(matchMessage.id, message, view)
+        discordMessage['matchMessageId'] = matchMessage.id
+        return self.outbound.submit(matchMessage, message, view, reactions)
+
+    def _trackMatchMessage(self, message: discord.Message, messagesAfter: dict = None):
+        """Starts tracking a match message, using the copy discord.py keeps up to date if its gateway event arrived before the REST reply."""
+        # New messages are at the end of the cache, so the search usually stops right away
+        liveMessage = discord.utils.get(reversed(self.cached_messages), id=message.id)
+        self.messageTracker.track(liveMessage or message, messagesAfter, liveMessage is not None)
+
+    async def _getMessageForContext(self, channel: discord.TextChannel, messageId: int):
+        """Returns a full message object for creating a command context, preferring cached ones over fetching it."""
+        message = self.messageTracker.getMessage(channel.id, messageId, requireLive=False) or discord.utils.get(reversed(self.cached_messages), id=messageId)
+        if message is None:
+            message = await channel.fetch_message(messageId)
+        return message
+
+    async def _getMatchMessage(self, channel: discord.TextChannel, messageId: int):
+        """Returns the match message and whether it is recent enough to be edited in place. Only reads the channel history if the message is not tracked yet, e.g. after a restart."""
+        isRecent = self.messageTracker.isRecent(channel.id, messageId)
+        if isRecent is None:
+            recentMessages = [message async for message in channel.history(limit=RECENT_MESSAGE_LIMIT)]
+            matchIndex = next((i for i, message in enumerate(recentMessages) if message.id == messageId), None)
+            if matchIndex is None:
+                return await channel.fetch_message(messageId), False
+
+            self._trackMatchMessage(recentMessages[matchIndex], {message.id: len(message.content.split('\n')) for message in recentMessages[:matchIndex]})
+            return recentMessages[matchIndex], self.messageTracker.isRecent(channel.id, messageId)
+
+        matchMessage = self.messageTracker.getMessage(channel.id, messageId)
+        if matchMessage is None:
+            matchMessage = await channel.fetch_message(messageId)
+        return matchMessage, isRecent
+
+    async def _manageReactions(self, message: discord.Message, expectedReactions, bucket: RateLimitBucket):
+        """Brings the reactions of the message to the expected ones with as few API calls as possible, or clears them if expectedReactions is None. Called by the outbound queue once the content is up to date."""
+        with metrics.timed('discord_seconds', operation='manageReactions'):
+            return await self._applyReactionPlan(message, expectedReactions, bucket)
+
+    async def _applyReactionPlan(self, message: discord.Message, expectedReactions, bucket: RateLimitBucket):
+        currentReactions = []
+        for reaction in message.reactions:
+            emoji = str(reaction.emoji)
+            otherUserIds = self.messageTracker.getReactionUsers(message.channel.id, message.id, emoji) - {self.user.id}
+            # Reactions added before the message was tracked, e.g. before a restart, are unknown and must be looked up
+            if reaction.count - reaction.me > len(otherUserIds) and expectedReactions and emoji in expectedReactions:
+                await bucket.acquire()
+                metrics.increment('discord_requests_total', request='fetchReactionUsers')
+                otherUserIds = {user.id async for user in reaction.users() if user.id != self.user.id}
+            currentReactions.append((emoji, reaction.me, otherUserIds))
+
+        plan = reactionPlanner.planReactions(currentReactions, expectedReactions)
+        for op in plan:
+            await bucket.acquire()
+            metrics.increment('discord_requests_total', request=op[0])
+            if op[0] == reactionPlanner.CLEAR_ALL:
+                await message.clear_reactions()
+            elif op[0] == reactionPlanner.CLEAR_EMOJI:
+                await message.clear_reaction(op[1])
+            elif op[0] == reactionPlanner.REMOVE_USER:
+                await message.remove_reaction(op[1], discord.Object(id=op[2]))
+            elif op[0] == reactionPlanner.ADD:
+                await message.add_reaction(op[1])
+        if IS_DEBUG and plan:
+            print(f'DEBUG MODE: Updated the reactions of message {message.id} with {len(plan)} API calls: {plan}')
+        return len(plan)
+
+    def ownsGuild(self, guildId: int):
+        """Whether the server is on one of the shards run by this process."""
+        return self.ownedShardIds is None or getShardId(guildId, SHARD_COUNT) in self.ownedShardIds
+
+    async def _loadOngoingMatches(self):
+        """Fills the in-memory store with the ongoing matches saved in the database, skipping those of servers handled by other processes."""
+        with metrics.timed('database_seconds', operation='loadOngoingMatches'):
+            savedMatches = await self.storage.loadOngoingMatches()
+        for serverId, channelId, matchData, discordMessage in savedMatches:
+            if not self.ownsGuild(serverId):
+                continue
+            matchKey = (serverId, channelId)
+            self.ongoingMatches[matchKey] = {
+                # Matches saved before the binary encoding are stored as JSON text
+                'match': (decodeMatch(matchData) if isinstance(matchData, bytes) else RainbowMatch(json.loads(matchData))) if matchData is not None else None,
+                'discordMessage': json.loads(discordMessage) if discordMessage is not None else None
+            }
+            self._indexMatchMessage(matchKey, self.ongoingMatches[matchKey]['discordMessage'])
+
+    async def getOngoingMatch(self, ctx: commands.Context):
+        """Returns the ongoing match of the channel of the context, or None."""
+        matchKey = self.getMatchKey(ctx)
+        ongoingMatch = self.ongoingMatches.get(matchKey)
+        if ongoingMatch is None and (matchKey[0], LEGACY_CHANNEL_ID) in self.ongoingMatches and matchKey not in self._legacyMisses:
+            ongoingMatch = await self._adoptLegacyMatch(ctx.channel, matchKey)
+        return ongoingMatch
+
+    async def _adoptLegacyMatch(self, channel: discord.TextChannel, matchKey: tuple):
+        """Moves a match saved before matches were kept per channel to the given channel, if its match message was posted there. Returns the match, or None if it belongs to another channel."""
+        legacyKey = (matchKey[0], LEGACY_CHANNEL_ID)
+        discordMessage = self.ongoingMatches[legacyKey]['discordMessage']
+        if discordMessage is not None and discordMessage['matchMessageId'] is not None:
+            try:
+                await channel.fetch_message(discordMessage['matchMessageId'])
+            except discord.HTTPException:
+                # Only ask Discord once per channel
+                self._legacyMisses.add(matchKey)
+                return None
+
+        # Another command may have taken the match over while the message was being fetched
+        ongoingMatch = self.ongoingMatches.pop(legacyKey, None)
+        if ongoingMatch is not None:
+            self._indexMatchMessage(legacyKey, None)
+            self.ongoingMatches[matchKey] = ongoingMatch
+            self._indexMatchMessage(matchKey, ongoingMatch['discordMessage'])
+            self._dirtyMatches.update([legacyKey, matchKey])
+        return self.ongoingMatches.get(matchKey)
+
+    def createOngoingMatch(self, matchKey: tuple, discordMessage):
+        """Registers a new ongoing match without any match data for the given channel."""
+        self.ongoingMatches[matchKey] = {'match': None, 'discordMessage': discordMessage}
+        self._indexMatchMessage(matchKey, discordMessage)
+        self._dirtyMatches.add(matchKey)
+
+    def deleteOngoingMatch(self, matchKey: tuple):
+        """Forgets the ongoing match of the given channel."""
+        self._indexMatchMessage(matchKey, None)
+        if self.ongoingMatches.pop(matchKey, None) is not None:
+            self._dirtyMatches.add(matchKey)
+
+    def _indexMatchMessage(self, matchKey: tuple, discordMessage):
+        """Updates the index of active match messages with the current match message of the channel, if any."""
+        messageId = discordMessage['matchMessageId'] if discordMessage is not None else None
+        previousMessageId = self._matchMessageIds.pop(matchKey, None)
+        if previousMessageId is not None:
+            self.activeMatchMessages.pop(previousMessageId, None)
+        if messageId is not None:
+            self._matchMessageIds[matchKey] = messageId
+            self.activeMatchMessages[messageId] = matchKey
+
+    async def flushOngoingMatches(self):
+        """Writes all ongoing matches that changed since the last flush to the database."""
+        if not self._dirtyMatches:
+            return
+        dirtyMatches, self._dirtyMatches = self._dirtyMatches, set()
+
+        try:
+            # Serialize on the event loop, so the writer thread never sees a match that is being modified
+            upserts, deletions = [], []
+            for matchKey in dirtyMatches:
+                ongoingMatch = self.ongoingMatches.get(matchKey)
+                if ongoingMatch is None:
+                    deletions.append(matchKey)
+                    continue
+                match, discordMessage = ongoingMatch['match'], ongoingMatch['discordMessage']
+                upserts.append((*matchKey, encodeMatch(match) if match is not None else None, json.dumps(discordMessage) if discordMessage is not None else None))
+            with metrics.timed('database_seconds', operation='writeOngoingMatches'):
+                await self.storage.writeOngoingMatches(upserts, deletions)
+        except BaseException:
+            # The next flush writes the then current state of these matches, together with anything that changed in the meantime
+            self._dirtyMatches |= dirtyMatches
+            raise
+
+    @tasks.loop(seconds=MATCH_FLUSH_INTERVAL)
+    async def flushOngoingMatchesTask(self):
+        # tasks.loop stops for good on any error that is not a connection error, e.g. the database being locked by another process
+        try:
+            await self.flushOngoingMatches()
+        except Exception as e:
+            print(f'Failed to write the ongoing matches to the database, retrying in {MATCH_FLUSH_INTERVAL} seconds: {e!r}')
 
-        if not any(reaction in discordMessage['reactions'] for reaction in currentReactions):
-            await message.clear_reactions()
-        else:
-            # Remove extra reactions from right to left
-            for reaction in reversed(currentReactions):
-                if reaction not in discordMessage['reactions']:
-                    await message.clear_reaction(reaction)
-
-        # Make sure the reactions are in the correct order and remove user-added reaction counts
-        for i, (current, expected) in enumerate(zip_longest(currentReactions, discordMessage['reactions'])):
-            if current != expected:
-                for reaction in currentReactions[i:]:
-                    await message.clear_reaction(reaction)
-                for reaction in discordMessage['reactions'][i:]:
-                    await message.add_reaction(reaction)
-                break
-            elif next((r for r in message.reactions if r.emoji == current), None).count > 1:
-                users = [user async for user in current.users()]
-                for user in users[1:]:
-                    await message.remove_reaction(current, user)
-    
     def saveOngoingMatch(self, ctx: commands.Context, match):
-        serverId = ctx.guild.id
-        matchData = json.dumps(match.__dict__)
-        self.cursor.execute("UPDATE ongoing_matches SET match_data = ? WHERE server_id = ?", (matchData, serverId))
-        self.conn.commit()
-
-    def saveCompletedMatch(self, ctx: commands.Context, match: RainbowMatch):
-        matchMap = match.map
+        matchKey = self.getMatchKey(ctx)
+        ongoingMatch = self.ongoingMatches.get(matchKey)
+        # Like an UPDATE on the database, saving does nothing if the match has already been forgotten
+        if ongoingMatch is not None:
+            ongoingMatch['match'] = match
+            self._dirtyMatches.add(matchKey)
+
+    async def saveCompletedMatch(self, ctx: commands.Context, match: RainbowMatch):
+        await self.saveCompletedMatches([(ctx.guild.id, match)])
+
+    async def saveCompletedMatches(self, matches: list):
+        """Saves a list of (serverId, match) tuples of completed matches to the database in a single transaction."""
         # Proper matches will have a map name set, so we only save those to the database
-        if not IS_DEBUG and matchMap is None:
-            return
-        matchId = match.matchId
-        serverId = ctx.guild.id
-        didWin = match.scores['blue'] > match.scores['red']
-
-        self.cursor.execute("INSERT INTO matches (match_id, server_id, map, result) VALUES (?, ?, ?, ?)", (matchId, serverId, matchMap, didWin))
-        self.conn.commit()
-
-        for player in match.players:
-            self.cursor.execute("INSERT OR IGNORE INTO players (player_id) VALUES (?)", (player['id'],))
-            self.cursor.execute("INSERT INTO player_matches (player_id, match_id) VALUES (?, ?)", (player['id'], matchId))
-            self.conn.commit()
-
-        for roundNumber, round in enumerate(match.rounds):
-            site = round['site']
-            roundResult = round['result']
-            self.cursor.execute("INSERT INTO rounds (round_num, match_id, site, result) VALUES (?, ?, ?, ?)", (roundNumber, matchId, site, roundResult))
-            self.conn.commit()
-
-            for playerIndex, player in enumerate(match.players):
-                playerId = player['id']
-                operator = round['operators'][playerIndex]
-                self.cursor.execute("INSERT INTO player_rounds (player_id, match_id, round_num, operator) VALUES (?, ?, ?, ?)", (playerId, matchId, roundNumber, operator))
-                self.conn.commit()
-
-        for round in match.rounds:
-            for statType, players in round['playerStats'].items():
-                for playerId, count in players.items():
-                    # Increase the counter of this stat by the count, or create it if it doesn't exist.
-                    self.cursor.execute("""
-                        INSERT OR REPLACE INTO player_additional_stats (player_id, stat_type, value)
-                        VALUES (?, ?, COALESCE((SELECT value FROM player_additional_stats WHERE player_id = ? AND stat_type = ?), 0) + ?)
-                    """, (playerId, statType, playerId, statType, count))
-                    self.conn.commit()
-
-    def removeMatchData(self, matchId):
+        matches = [(serverId, match) for serverId, match in matches if IS_DEBUG or match.map is not None]
+        try:
+            with metrics.timed('database_seconds', operation='saveCompletedMatches'):
+                await self.storage.saveCompletedMatches(matches)
+        finally:
+            for serverId, match in matches:
+                self.statisticsCache.invalidateMatch(serverId, [player['id'] for player in match.players])
+
+    async def rebuildStatistics(self):
+        """Regenerates the win/loss counters used for statistics from all saved matches."""
+        try:
+            with metrics.timed('database_seconds', operation='rebuildStatistics'):
+                await self.storage.rebuildStatistics()
+        finally:
+            self.statisticsCache.clear()
+
+    async def removeMatchData(self, matchId):
         """Removes all data associated with a match from the database."""
-        self.cursor.execute("DELETE FROM matches WHERE match_id = ?", (matchId,))
-        self.cursor.execute("DELETE FROM player_matches WHERE match_id = ?", (matchId,))
-        self.cursor.execute("DELETE FROM rounds WHERE match_id = ?", (matchId,))
-        self.cursor.execute("DELETE FROM player_rounds WHERE match_id = ?", (matchId,))
-        self.conn.commit()
+        with metrics.timed('database_seconds', operation='deleteMatch'):
+            affected = await self.storage.deleteMatch(matchId)
+        if affected is not None:
+            self.statisticsCache.invalidateMatch(*affected)
 
     def saveDiscordMessage(self, ctx: commands.Context, discordMessage):
-        serverId = ctx.guild.id
-        discordMessage = json.dumps(discordMessage)
-        self.cursor.execute("UPDATE ongoing_matches SET discord_message = ? WHERE server_id = ?", (discordMessage, serverId))
-        self.conn.commit()
+        matchKey = self.getMatchKey(ctx)
+        ongoingMatch = self.ongoingMatches.get(matchKey)
+        if ongoingMatch is not None:
+            ongoingMatch['discordMessage'] = discordMessage
+            self._indexMatchMessage(matchKey, discordMessage)
+            self._dirtyMatches.add(matchKey)
 
     async def startThreadOnMessage(self, ctx: commands.Context, threadParentMessage: discord.Message, threadName: str) -> discord.Thread:
         """Starts a new thread on a message."""
@@ -377,29 +588,28 @@ class RainbowBot(commands.Bot):
             await thread.edit(archived=True)
 
     async def getMatchData(self, ctx: commands.Context, shouldAlertOnNoMatch=True):
-        """Gets the match data and discord message from the database. If there is no match in progress, it will send a message to the user."""
-        serverId = ctx.guild.id
-        matchData, discordMessage = None, None
-        result = self.cursor.execute("SELECT match_data, discord_message FROM ongoing_matches WHERE server_id = ?", (serverId,)).fetchone()
-
-        if result is not None:
-            matchData, discordMessage = result
-            matchData = json.loads(matchData) if matchData is not None else None
-            discordMessage = json.loads(discordMessage) if discordMessage is not None else self.resetDiscordMessage(ctx.guild.id)
+        """Gets the match and discord message from the in-memory store. If there is no match in progress, it will send a message to the user."""
+        match, discordMessage = None, None
+        matchKey = self.getMatchKey(ctx)
+        with metrics.timed('match_data_seconds'):
+            ongoingMatch = await self.getOngoingMatch(ctx)
+
+        if ongoingMatch is not None:
+            match, discordMessage = ongoingMatch['match'], ongoingMatch['discordMessage']
+            discordMessage = discordMessage if discordMessage is not None else self.resetDiscordMessage(matchKey)
         else:
-            discordMessage = self.resetDiscordMessage(ctx.guild.id)
+            discordMessage = self.resetDiscordMessage(matchKey)
 
-        if matchData is None and shouldAlertOnNoMatch:
+        if match is None and shouldAlertOnNoMatch:
             discordMessage['messageContent']['playersBanner'] = 'No match in progress. Use "**!startMatch @player1 @player2...**" to start a new match.'
             await bot.sendMatchMessage(ctx, discordMessage, True)
             return None, None, False
 
-        match = RainbowMatch(matchData)
+        match = match if match is not None else RainbowMatch()
         return match, discordMessage, True
 
-    def __del__(self):
-        self.conn.close()
-
 if __name__ == "__main__":
+    # The cogs import this file as "bot", which would otherwise run all of it a second time while loading them
+    sys.modules['bot'] = sys.modules[__name__]
     bot = RainbowBot()
     bot.run(TOKEN)
@@ -1,8 +1,12 @@
 from discord.ext import commands
 from bot import RainbowBot
 from cogs.botHelp import CustomHelpCommand
+import metrics
 from version import __version__ as VERSION
 
+# The timings with the most total time shown by !perf, the rest are only exported
+PERF_TIMINGS_SHOWN = 12
+
 class General(commands.Cog, name='General'):
     """Commands that allow you to manage the bot itself."""
     def __init__(self, bot: RainbowBot):
@@ -18,6 +22,7 @@ class General(commands.Cog, name='General'):
             return
 
         message = await ctx.channel.fetch_message(discordMessage['matchMessageId'])
+        self.bot.outbound.discard(message.id)
         await message.delete()
 
         discordMessage['matchMessageId'] = None
@@ -33,5 +38,26 @@ class General(commands.Cog, name='General'):
         message += 'Do you want to say thank you and support the bot? You can do so by [buying me a coffee](<https://ko-fi.com/nikkelm>)!\n\n'
         await ctx.send(message)
 
+    @commands.command(aliases=['perf', 'performance'])
+    @commands.is_owner()
+    async def _perf(self, ctx: commands.Context):
+        """Shows where the bot spent its time since it started, and the state of its queues and caches. Can only be used by the owner of the bot."""
+        histograms = sorted(metrics.registry.getHistograms(), key=lambda entry: entry[2].sum, reverse=True)
+        lines = [f'{"Timing":<40} {"count":>7} {"mean":>7} {"p50":>7} {"p99":>7} {"max":>7}']
+        for name, labels, histogram in histograms[:PERF_TIMINGS_SHOWN]:
+            label = f'{name} {" ".join(str(value) for value in labels.values())}'.strip()
+            lines.append(f'{label[:40]:<40} {histogram.count:7d} {histogram.sum / histogram.count * 1000:7.1f} {histogram.getQuantile(0.5) * 1000:7.1f} {histogram.getQuantile(0.99) * 1000:7.1f} {histogram.max * 1000:7.1f}')
+        lines.append('(times in ms, percentiles are bucket bounds)\n')
+        for name, labels, count in sorted(metrics.registry.getCounters(), key=lambda entry: entry[2], reverse=True):
+            lines.append(f'{name} {" ".join(str(value) for value in labels.values())}: {count:g}')
+        for collectorName, values in metrics.registry.collect().items():
+            lines.append(f'{collectorName}: ' + ', '.join(f'{key} {value:.3g}' if isinstance(value, float) else f'{key} {value}' for key, value in values.items()))
+
+        # Messages are limited to 2000 characters
+        report = '\n'.join(lines)
+        if len(report) > 1990:
+            report = report[:report.rfind('\n', 0, 1980)] + '\n...'
+        await ctx.send(f'```\n{report}\n```')
+
 async def setup(bot: RainbowBot):
     await bot.add_cog(General(bot))
\ No newline at end of file
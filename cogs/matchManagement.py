@@ -1,5 +1,4 @@
 from discord.ext import commands
-import json
 import re
 from rainbow import RainbowMatch
 from bot import RainbowBot
@@ -12,13 +11,12 @@ class MatchManagement(commands.Cog, name='Match Management'):
     @commands.command(aliases=['startMatch', 'start', 'play'], category='Rainbow Six')
     async def _startMatch(self, ctx: commands.Context, *playerNamesOrHere):
         """Starts a new match with up to five players. Use **!startMatch here** to start a match with everyone in your current voice channel, or **!startMatch @player1 @player2...** to start a match with the mentioned players. This command must be used first in order for any other match commands to work."""
-        serverId = ctx.guild.id
-        matchData = self.bot.cursor.execute("SELECT match_data FROM ongoing_matches WHERE server_id = ?", (serverId,)).fetchone()
+        matchKey = self.bot.getMatchKey(ctx)
+        ongoingMatch = await self.bot.getOngoingMatch(ctx)
 
-        if matchData is not None and matchData[0] is not None:
-            oldMatch = RainbowMatch(json.loads(matchData[0]))
-            discordMessage = self.bot.cursor.execute("SELECT discord_message FROM ongoing_matches WHERE server_id = ?", (serverId,)).fetchone()[0]
-            discordMessage = json.loads(discordMessage)
+        if ongoingMatch is not None and ongoingMatch['match'] is not None:
+            oldMatch = ongoingMatch['match']
+            discordMessage = ongoingMatch['discordMessage']
             if not oldMatch.isMatchFinished():
                 await ctx.message.delete()
                 previousActionPrompt = discordMessage['messageContent']['actionPrompt']
@@ -30,8 +28,8 @@ class MatchManagement(commands.Cog, name='Match Management'):
                 await self._goodnight(ctx)
 
         match = RainbowMatch()
-        discordMessage = self.bot.resetDiscordMessage(ctx.guild.id)
-        self.bot.cursor.execute("INSERT INTO ongoing_matches (server_id, discord_message) VALUES (?, ?)", (serverId, json.dumps(discordMessage)))
+        discordMessage = self.bot.resetDiscordMessage(matchKey)
+        self.bot.createOngoingMatch(matchKey, discordMessage)
 
         # Instead of a player name, the user can use the argument "here" to start a match with the players in their voice channel
         if len(playerNamesOrHere) == 1 and playerNamesOrHere[0].lower() in ['voice', 'voicechannel', 'channel', 'here']:
@@ -171,8 +169,7 @@ class MatchManagement(commands.Cog, name='Match Management'):
         await self.bot.sendMatchMessage(ctx, discordMessage, True)
         await self.bot.archiveThread(ctx, discordMessage['matchMessageId'])
 
-        self.bot.cursor.execute("DELETE FROM ongoing_matches WHERE server_id = ?", (ctx.guild.id,))
-        self.bot.conn.commit()
+        self.bot.deleteOngoingMatch(self.bot.getMatchKey(ctx))
 
         playerIdStrings = [f'<@{player["id"]}>' for player in match.players]
         if here is not None and here.lower() in ['voice', 'voicechannel', 'channel', 'here']:
@@ -203,14 +200,14 @@ class MatchManagement(commands.Cog, name='Match Management'):
         discordMessage['reactions'] = []
 
         if delete == 'delete':
-            self.bot.removeMatchData(match.matchId)
+            await self.bot.removeMatchData(match.matchId)
             discordMessage['messageContent']['statsBanner'] = 'Match data has been **removed** from the database (additional player statistics such as interrogations are always saved).\n'
 
         await self.bot.sendMatchMessage(ctx, discordMessage)
         await self.bot.archiveThread(ctx, discordMessage['matchMessageId'])
 
-        self.bot.cursor.execute("DELETE FROM ongoing_matches WHERE server_id = ?", (ctx.guild.id,))
-        self.bot.conn.commit()
+        self.bot.deleteOngoingMatch(self.bot.getMatchKey(ctx))
+        await self.bot.flushOngoingMatches()
 
     def _validatePlayerNames(self, ctx: commands.Context, playerNames):
         playerIds = [re.findall(r'\d+', name) for name in playerNames if name.startswith('<@')]
@@ -1,7 +1,6 @@
 from discord.ext import commands
-from fuzzywuzzy import process
 from bot import RainbowBot
-from rainbow import RainbowData, RainbowMatch
+from rainbow import RainbowData, RainbowMatch, resolveOperators
 
 class OngoingMatch(commands.Cog, name='Ongoing Match'):
     """Commands to interact with an ongoing match, such as banning operators or playing rounds."""
@@ -140,7 +139,7 @@ class OngoingMatch(commands.Cog, name='Ongoing Match'):
             await self.bot.sendMatchMessage(ctx, discordMessage)
             return
         
-        validOperators = RainbowData.attackers if match.playingOnSide == 'attack' else RainbowData.defenders
+        validOperatorIds = [RainbowData.operatorIds[op] for op in (RainbowData.attackers if match.playingOnSide == 'attack' else RainbowData.defenders)]
 
         if operator is None:
             discordMessage['messageContent']['statsBanner'] = 'You must include the operator you are swapping to. Use "**!swap operator**" or "**!swap operator @player**" to try again.'
@@ -152,15 +151,13 @@ class OngoingMatch(commands.Cog, name='Ongoing Match'):
             player = await commands.MemberConverter().convert(ctx, player)
 
         operator = operator.lower().capitalize()
-        operatorMatch, score = process.extractOne(operator, validOperators)
-        if score >= 75:
-            operator = operatorMatch
-        else:
+        operatorId = resolveOperators([operator], validOperatorIds)[0]
+        if operatorId is None:
             discordMessage['messageContent']['statsBanner'] = f'**{operator}** is not a valid operator. Use "**!swap operator**" or "**!swap operator @player**" to try again.'
             await self.bot.sendMatchMessage(ctx, discordMessage)
             return
 
-        playerOperators, backupOperators = match.swapOperator(player, operator)
+        playerOperators, backupOperators = match.swapOperator(player, operatorId)
 
         discordMessage = self._setRoundLineup(discordMessage, match, playerOperators, backupOperators)
 
@@ -323,7 +320,8 @@ class OngoingMatch(commands.Cog, name='Ongoing Match'):
         discordMessage['messageContent']['actionPrompt'] = 'Use "**!another**" 👍 for a new match with the same players, "**!another here**" 🎤 for a new match in your voice channel, or "**!goodnight (delete)**" 👎 (✋) to end the match (and exclude it from statistics).'
         discordMessage['reactions'] = ['👍', '🎤', '👎', '✋']
         self.bot.saveOngoingMatch(ctx, match)
-        self.bot.saveCompletedMatch(ctx, match)
+        await self.bot.saveCompletedMatch(ctx, match)
+        await self.bot.flushOngoingMatches()
         await self.bot.createMatchRecapThread(ctx, match, discordMessage)
         await self.bot.sendMatchMessage(ctx, discordMessage)
     
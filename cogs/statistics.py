@@ -1,7 +1,11 @@
+import asyncio
 import discord
 from discord.ext import commands
 from bot import RainbowBot
+import metrics
 from rainbow import RainbowData, RainbowMatch
+from statisticsRollups import MATCH_SITE
+from storage import PLAYER_STATISTICS_QUERIES, SERVER_STATISTICS_QUERIES
 
 class Statistics(commands.Cog, name='Statistics'):
     """Commands to view statistics for players and past matches."""
@@ -48,25 +52,9 @@ class Statistics(commands.Cog, name='Statistics'):
         if statisticType == 'overall' or statisticType == 'server':
             message += f'Here are the requested statistics for **{target}** (Use "**!stats help**" for more usage information):\n\n'
             if statisticType == 'overall':
-                maps = self._getPlayerStatisticFromDatabase(player, 'maps')
-                additionalStatistics = self._getPlayerStatisticFromDatabase(player, 'additionalStatistics')
-                operators = self._getPlayerStatisticFromDatabase(player, 'operators')
+                message += await self._getStatisticsReport('player', player)
             else:
-                maps = self._getServerStatisticFromDatabase(ctx.guild, 'maps')
-                additionalStatistics = []
-                operators = self._getServerStatisticFromDatabase(ctx.guild, 'operators')
-
-            # Maps/Sites
-            message += self._createMapStatisticsString(ctx, statisticType, maps, player)
-
-            # Operators
-            message += self._createOperatorStatisticsString(operators)
-
-            # Additional statistics
-            if len(additionalStatistics) > 0:
-                message += '\nSome additional statistics:\n'
-                for stat in additionalStatistics:
-                    message += f'**{stat[0].title()}**: {stat[1]}\n'
+                message += await self._getStatisticsReport('server', ctx.guild)
         elif statisticType == 'help':
             message = 'The "**!stats**" command allows you to query and view statistics for yourself, your server, or another user on this server.\n\n'
             message += 'Available *statisticTypes* are:\n'
@@ -81,114 +69,109 @@ class Statistics(commands.Cog, name='Statistics'):
         thread: discord.Thread = await self.bot.startThreadOnMessage(ctx, ctx.message, threadName)
         await thread.send(message)
 
-    def _getPlayerStatisticFromDatabase(self, player: discord.User, statType: str, additionalArguments: list = None):
+    @commands.command(aliases=['rebuildStats', 'rebuildStatistics'])
+    @commands.is_owner()
+    async def _rebuildStats(self, ctx: commands.Context):
+        """Regenerates the statistics of all players and servers from the saved matches. Can only be used by the owner of the bot."""
+        await self.bot.rebuildStatistics()
+        await ctx.send('The statistics have been rebuilt from all saved matches.')
+
+    async def _getStatisticsReport(self, kind: str, target):
+        """Returns the statistics of a player or server ('player' or 'server'), from the cache if they have not changed since they were last viewed."""
+        key = (kind, target.id)
+        report = self.bot.statisticsCache.get(key)
+        if report is None:
+            epoch = self.bot.statisticsCache.getEpoch()
+            report = await self._createStatisticsReport(kind, target)
+            self.bot.statisticsCache.put(key, report, epoch)
+        return report
+
+    async def _createStatisticsReport(self, kind: str, target):
+        """Creates the win/loss ratios and additional statistics of a player or server from the database."""
+        if kind == 'player':
+            maps, additionalStatistics, operators = await asyncio.gather(
+                self._getPlayerStatisticFromDatabase(target, 'maps'),
+                self._getPlayerStatisticFromDatabase(target, 'additionalStatistics'),
+                self._getPlayerStatisticFromDatabase(target, 'operators')
+            )
+        else:
+            maps, operators = await asyncio.gather(
+                self._getServerStatisticFromDatabase(target, 'maps'),
+                self._getServerStatisticFromDatabase(target, 'operators')
+            )
+            additionalStatistics = []
+
+        # Maps/Sites
+        report = self._createMapStatisticsString(maps)
+
+        # Operators
+        report += self._createOperatorStatisticsString(operators)
+
+        # Additional statistics
+        if len(additionalStatistics) > 0:
+            report += '\nSome additional statistics:\n'
+            for stat in additionalStatistics:
+                report += f'**{stat[0].title()}**: {stat[1]}\n'
+        return report
+
+    async def _getPlayerStatisticFromDatabase(self, player: discord.User, statType: str):
         """Gets all data related to the given player and statistic from the database."""
-        # Returns a list of maps and match results for matches this player played
-        if statType == 'maps':
-            return self.bot.cursor.execute("""
-                SELECT matches.map, matches.result
-                FROM matches
-                JOIN player_matches ON matches.match_id = player_matches.match_id
-                WHERE player_matches.player_id = ?
-            """, (player.id,)).fetchall()
-        # Returns a list of all additional statistics for this player, such as interrogations or aces
-        elif statType == 'additionalStatistics':
-            return self.bot.cursor.execute("""
-                SELECT stat_type, value
-                FROM player_additional_stats
-                WHERE player_id = ?
-            """, (player.id,)).fetchall()
-        # Gets a list of operators played by this player, and if the player won the round
-        elif statType == 'operators':
-            return self.bot.cursor.execute("""
-                SELECT player_rounds.operator, rounds.result
-                FROM player_rounds
-                JOIN rounds ON player_rounds.match_id = rounds.match_id AND player_rounds.round_num = rounds.round_num
-                WHERE player_rounds.player_id = ?
-            """, (player.id,)).fetchall()
-        # Gets a list of played sites for a given map, and if the player won the round
-        elif statType == 'sites':
-            map = additionalArguments[0]
-            return self.bot.cursor.execute("""
-                SELECT rounds.site, rounds.result
-                FROM rounds
-                JOIN matches ON rounds.match_id = matches.match_id
-                JOIN player_rounds ON rounds.match_id = player_rounds.match_id AND rounds.round_num = player_rounds.round_num
-                WHERE matches.map = ? AND player_rounds.player_id = ?
-            """, (map, player.id)).fetchall()
+        if statType in PLAYER_STATISTICS_QUERIES:
+            with metrics.timed('database_seconds', operation='getPlayerStatistics'):
+                return await self.bot.storage.getPlayerStatistics(player.id, statType)
         else:
             print(f'Unknown statType when querying player statistics: {statType}')
             return None
     
-    def _getServerStatisticFromDatabase(self, server: discord.Guild, statType: str, additionalArguments: list = None):
+    async def _getServerStatisticFromDatabase(self, server: discord.Guild, statType: str):
         """Gets all data related to the given server and statistic from the database."""
-        # Returns a list of maps and match results for matches played on this server
-        if statType == 'maps':
-            return self.bot.cursor.execute("""
-                SELECT matches.map, matches.result
-                FROM matches
-                WHERE matches.server_id = ?
-            """, (server.id,)).fetchall()
-        # Gets a list of operators played in matches on this server, and if the player won the round
-        elif statType == 'operators':
-            return self.bot.cursor.execute("""
-                SELECT player_rounds.operator, rounds.result
-                FROM player_rounds
-                JOIN rounds ON player_rounds.match_id = rounds.match_id AND player_rounds.round_num = rounds.round_num
-                JOIN matches ON player_rounds.match_id = matches.match_id
-                WHERE matches.server_id = ?
-            """, (server.id,)).fetchall()
-        # Gets a list of played sites for a given map, and if the players won the round
-        elif statType == 'sites':
-            map = additionalArguments[0]
-            return self.bot.cursor.execute("""
-                SELECT rounds.site, rounds.result
-                FROM rounds
-                JOIN matches ON rounds.match_id = matches.match_id
-                WHERE matches.map = ? AND matches.server_id = ?
-            """, (map, server.id)).fetchall()
+        if statType in SERVER_STATISTICS_QUERIES:
+            with metrics.timed('database_seconds', operation='getServerStatistics'):
+                return await self.bot.storage.getServerStatistics(server.id, statType)
         else:
             print(f'Unknown statType when querying server statistics: {statType}')
             return None
 
-    def _calculateWinLossRatio(self, maps: list):
+    def _calculateWinLossRatio(self, winsLosses: list):
+        """Groups a list of (key, wins, losses) rows by their key, and sums up the overall wins and losses."""
         res = {}
         overallWins = 0
         overallLosses = 0
-        for map in maps:
-            if map[0] not in res:
-                res[map[0]] = {'wins': 0, 'losses': 0}
-            if map[1] == 1:
-                overallWins += 1
-                res[map[0]]['wins'] += 1
-            else:
-                overallLosses += 1
-                res[map[0]]['losses'] += 1
+        for key, wins, losses in winsLosses:
+            if key not in res:
+                res[key] = {'wins': 0, 'losses': 0}
+            overallWins += wins
+            overallLosses += losses
+            res[key]['wins'] += wins
+            res[key]['losses'] += losses
         # None means no map is set, or the round was played on attack
         none = res.pop(None, None)
         overall = {'wins': overallWins, 'losses': overallLosses}
         return res, overall, none
     
     def _getOperatorFromId(self, operatorId: int):
-        if operatorId > 0:
-            return RainbowData.attackers[operatorId - 1]
-        return RainbowData.defenders[abs(operatorId) - 1]
+        return RainbowData.getOperatorName(operatorId)
+
+    def _createMapStatisticsString(self, maps: list):
+        # Split the rows into the match results for each map, and the round results for the sites of each map
+        mapResults = []
+        siteResults = {}
+        for map, site, wins, losses in maps:
+            if site == MATCH_SITE:
+                mapResults.append((map, wins, losses))
+            else:
+                siteResults.setdefault(map, []).append((site, wins, losses))
 
-    def _createMapStatisticsString(self, ctx: commands.Context, statisticType: str, maps: list, player: discord.User):
-        mapsWinLoss, overallWinLoss, _ = self._calculateWinLossRatio(maps)
-        message = f'Matches played: **{len(maps)}**, with **{overallWinLoss["wins"]}** wins and **{overallWinLoss["losses"]}** losses.\n'
+        mapsWinLoss, overallWinLoss, _ = self._calculateWinLossRatio(mapResults)
+        message = f'Matches played: **{overallWinLoss["wins"] + overallWinLoss["losses"]}**, with **{overallWinLoss["wins"]}** wins and **{overallWinLoss["losses"]}** losses.\n'
         message += f'Overall Win/Loss Ratio: **{round(overallWinLoss["wins"]/overallWinLoss["losses"], 2) if overallWinLoss["losses"] != 0 else float(overallWinLoss["wins"])}**\n\n'
         sortedMaps = sorted(mapsWinLoss, key=lambda x: mapsWinLoss[x]['wins']/mapsWinLoss[x]['losses']if mapsWinLoss[x]["losses"] != 0 else mapsWinLoss[x]['wins'], reverse=True)[:3]
         if len(sortedMaps) > 0:
             # Get the win/loss of each defensive site for the top maps
             message += 'Top maps:\n'
             for map in sortedMaps:
-                numMapPlays = len([m for m in maps if m[0] == map])
-                if statisticType == 'overall':
-                    sites = self._getPlayerStatisticFromDatabase(player, 'sites', [map])
-                elif statisticType == 'server':
-                    sites = self._getServerStatisticFromDatabase(ctx.guild, 'sites', [map])
-                siteWinsLosses, siteOverallWinLoss, attackWinLoss = self._calculateWinLossRatio(sites)
+                numMapPlays = mapsWinLoss[map]['wins'] + mapsWinLoss[map]['losses']
+                siteWinsLosses, siteOverallWinLoss, attackWinLoss = self._calculateWinLossRatio(siteResults.get(map, []))
                 sortedSites = sorted(siteWinsLosses, key=lambda x: siteWinsLosses[x]['wins']/siteWinsLosses[x]['losses'] if siteWinsLosses[x]["losses"] != 0 else siteWinsLosses[x]['wins'], reverse=True)
 
                 message += f'**{map}: {round(mapsWinLoss[map]["wins"]/mapsWinLoss[map]["losses"], 2) if mapsWinLoss[map]["losses"] != 0 else float(mapsWinLoss[map]["wins"])}** (**{numMapPlays}** plays)\n'
@@ -210,14 +193,7 @@ class Statistics(commands.Cog, name='Statistics'):
         if len(operators) == 0:
             return message
 
-        operatorWinsLosses = {}
-        for operator in operators:
-            if operator[0] not in operatorWinsLosses:
-                operatorWinsLosses[operator[0]] = {'wins': 0, 'losses': 0}
-            if operator[1] == 1:
-                operatorWinsLosses[operator[0]]['wins'] += 1
-            else:
-                operatorWinsLosses[operator[0]]['losses'] += 1
+        operatorWinsLosses, _, _ = self._calculateWinLossRatio(operators)
 
         attackers = {k: operatorWinsLosses[k] for k in operatorWinsLosses if k > 0}
         defenders = {k: operatorWinsLosses[k] for k in operatorWinsLosses if k < 0}
@@ -227,13 +203,13 @@ class Statistics(commands.Cog, name='Statistics'):
         # Add the top three attackers to the message
         message += 'Top Attackers:\n'
         for operator in sorted_attackers:
-            numOperatorPlays = len([o for o in operators if o[0] == operator])
+            numOperatorPlays = attackers[operator]['wins'] + attackers[operator]['losses']
             message += f'**{self._getOperatorFromId(operator)}: {round(attackers[operator]["wins"]/attackers[operator]["losses"], 2) if attackers[operator]["losses"] != 0 else float(attackers[operator]["wins"])}** (**{numOperatorPlays}** plays)\n'
 
         # Add the top three defenders to the message
         message += '\nTop Defenders:\n'
         for operator in sorted_defenders:
-            numOperatorPlays = len([o for o in operators if o[0] == operator])
+            numOperatorPlays = defenders[operator]['wins'] + defenders[operator]['losses']
             message += f'**{self._getOperatorFromId(operator)}: {round(defenders[operator]["wins"]/defenders[operator]["losses"], 2) if defenders[operator]["losses"] != 0 else float(defenders[operator]["wins"])}** (**{numOperatorPlays}** plays)\n'
 
         return message
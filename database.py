@@ -0,0 +1,84 @@
+import asyncio
+import pathlib
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# How long (in seconds) a connection waits for a lock on the database held by another connection
+BUSY_TIMEOUT = 30.0
+# The number of compiled statements each connection keeps, all queries of the bot use fixed SQL with parameters so they are compiled only once
+CACHED_STATEMENTS = 256
+
+class DatabaseExecutor:
+    """Runs all SQLite work on dedicated threads, so a slow query never blocks the event loop.
+    Writes are serialized on a single writer thread that owns the only read-write connection, reads are spread over a pool of read-only connections."""
+    def __init__(self, path: str, numReaders: int = 4):
+        self.path = path
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+        self._readers = ThreadPoolExecutor(max_workers=numReaders, thread_name_prefix='db-reader')
+        self._readerLocal = threading.local()
+        self._readerConnections = []
+        self._readerConnectionsLock = threading.Lock()
+        self._writeConnection = self._writer.submit(self._connectWriter).result()
+
+    def _connectWriter(self):
+        # Other processes of a sharded bot may be writing to the same database, so wait for them to finish instead of failing right away
+        conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, cached_statements=CACHED_STATEMENTS)
+        # Write-ahead logging allows the read-only connections to read while the writer is writing
+        conn.execute("PRAGMA journal_mode=WAL")
+        # In WAL mode, this only syncs to disk at checkpoints. A power loss can lose the last commits, but never corrupts the database
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _getReaderConnection(self):
+        """Returns the read-only connection of the current reader thread, opening it on first use."""
+        conn = getattr(self._readerLocal, 'conn', None)
+        if conn is None:
+            uri = f'{pathlib.Path(self.path).absolute().as_uri()}?mode=ro'
+            conn = sqlite3.connect(uri, uri=True, check_same_thread=False, timeout=BUSY_TIMEOUT, cached_statements=CACHED_STATEMENTS)
+            self._readerLocal.conn = conn
+            with self._readerConnectionsLock:
+                self._readerConnections.append(conn)
+        return conn
+
+    def _runWrite(self, fn, *args):
+        try:
+            result = fn(self._writeConnection, *args)
+            self._writeConnection.commit()
+            return result
+        except BaseException:
+            self._writeConnection.rollback()
+            raise
+
+    def _runRead(self, fn, *args):
+        return fn(self._getReaderConnection(), *args)
+
+    async def write(self, fn, *args):
+        """Runs fn(connection, *args) on the writer thread and commits the result, or rolls back if it raises."""
+        return await asyncio.wrap_future(self._writer.submit(self._runWrite, fn, *args))
+
+    async def read(self, fn, *args):
+        """Runs fn(connection, *args) on one of the read-only connections."""
+        return await asyncio.wrap_future(self._readers.submit(self._runRead, fn, *args))
+
+    async def execute(self, sql: str, parameters=()):
+        """Executes a single writing statement."""
+        return await self.write(lambda conn: conn.execute(sql, parameters).rowcount)
+
+    async def fetchall(self, sql: str, parameters=()):
+        return await self.read(lambda conn: conn.execute(sql, parameters).fetchall())
+
+    async def fetchone(self, sql: str, parameters=()):
+        return await self.read(lambda conn: conn.execute(sql, parameters).fetchone())
+
+    def close(self):
+        """Waits for all pending work to finish and closes all connections."""
+        self._readers.shutdown(wait=True)
+        with self._readerConnectionsLock:
+            for conn in self._readerConnections:
+                conn.close()
+            self._readerConnections.clear()
+        if self._writeConnection is not None:
+            self._writer.submit(self._writeConnection.close).result()
+            self._writeConnection = None
+        self._writer.shutdown(wait=True)
@@ -0,0 +1,54 @@
+import asyncio
+import contextlib
+import time
+
+class GuildExecutor:
+    """Runs the work of each lobby one piece at a time in arrival order, while different lobbies run in parallel.
+    A lobby is a (server id, channel id) key. Commands and reactions of one lobby read and modify the same ongoing match, so they must never interleave."""
+    def __init__(self):
+        # Lobby key -> the lock serializing the lobby's work and the number of pieces of work waiting for or holding it
+        self._lobbies = {}
+        self.numWaits = 0
+        self.totalWaitTime = 0.0
+        self.maxWaitTime = 0.0
+        self.maxQueueDepth = 0
+
+    @contextlib.asynccontextmanager
+    async def serialize(self, key: tuple):
+        """Waits until all work of the lobby that arrived earlier is done, and holds off all work that arrives later until the block is left."""
+        lobby = self._lobbies.get(key)
+        if lobby is None:
+            # asyncio.Lock wakes up its waiters in the order they started waiting
+            lobby = self._lobbies[key] = {'lock': asyncio.Lock(), 'depth': 0}
+        lobby['depth'] += 1
+        self.maxQueueDepth = max(self.maxQueueDepth, lobby['depth'])
+
+        start = time.perf_counter()
+        try:
+            async with lobby['lock']:
+                waitTime = time.perf_counter() - start
+                self.numWaits += 1
+                self.totalWaitTime += waitTime
+                self.maxWaitTime = max(self.maxWaitTime, waitTime)
+                yield
+        finally:
+            lobby['depth'] -= 1
+            if lobby['depth'] == 0:
+                del self._lobbies[key]
+
+    def getQueueDepth(self, key: tuple = None):
+        """Returns the number of pieces of work waiting for or holding the lobby, or for all lobbies if no lobby is given."""
+        if key is not None:
+            lobby = self._lobbies.get(key)
+            return lobby['depth'] if lobby is not None else 0
+        return sum(lobby['depth'] for lobby in self._lobbies.values())
+
+    def getMetrics(self):
+        return {
+            'activeLobbies': len(self._lobbies),
+            'queueDepth': self.getQueueDepth(),
+            'maxQueueDepth': self.maxQueueDepth,
+            'numWaits': self.numWaits,
+            'meanWaitTime': self.totalWaitTime / self.numWaits if self.numWaits else 0.0,
+            'maxWaitTime': self.maxWaitTime
+        }
@@ -0,0 +1,117 @@
+import asyncio
+import contextlib
+import os
+import sys
+import threading
+import time
+import traceback
+import metrics
+
+# Number of innermost frames of the blocking code that are logged
+STACK_DEPTH = 15
+
+def _formatStack(frame):
+    """Formats the innermost frames of the stack, leaving out the frames of the event loop running the callback."""
+    if frame is None:
+        return ''
+    stack = traceback.extract_stack(frame)
+    callbackIndex = max((i for i, entry in enumerate(stack) if entry.name == '_run' and entry.filename.endswith(os.path.join('asyncio', 'events.py'))), default=-1)
+    return ''.join(traceback.format_list(stack[callbackIndex + 1:][-STACK_DEPTH:]))
+
+class LoopWatchdog:
+    """Measures how late the event loop runs a heartbeat timer, and logs what the loop is running whenever it is blocked for longer than the threshold.
+    A separate thread watches the heartbeat, so it can read the stack of the blocking code while the loop is still blocked, and attribute it to the guild and command the blocked task was labelled with.
+    While the loop is fine this only costs a timer on the loop and a sleeping thread waking up a few times per threshold."""
+    def __init__(self, threshold: float):
+        self.threshold = threshold
+        self.interval = threshold / 2
+        # Task -> (guild id, command) of the work the task is running, set by label()
+        self._labels = {}
+        self._loop = None
+        self._loopThreadId = None
+        self._heartbeatTask = None
+        self._thread = None
+        self._stopped = threading.Event()
+        # The time the heartbeat should wake up next, and the last such time it actually woke up for
+        self._nextBeat = None
+        self._wokenBeat = None
+        # (heartbeat time, command) of the last stall the thread logged, recorded in the metrics by the heartbeat, as the metrics must only be changed on the loop
+        self._loggedStall = (None, None)
+        # Makes sure a stall is either logged by the thread while the loop is still blocked, or not at all
+        self._lock = threading.Lock()
+        self.numStalls = 0
+        self.maxLag = 0.0
+
+    def start(self):
+        """Starts watching the running event loop."""
+        self._loop = asyncio.get_running_loop()
+        self._loopThreadId = threading.get_ident()
+        self._nextBeat = time.monotonic() + self.interval
+        self._stopped.clear()
+        self._heartbeatTask = asyncio.create_task(self._heartbeat())
+        self._thread = threading.Thread(target=self._watch, name='LoopWatchdog', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._heartbeatTask is not None:
+            self._heartbeatTask.cancel()
+            self._heartbeatTask = None
+
+    @contextlib.contextmanager
+    def label(self, guildId: int, command: str):
+        """Attributes stalls of the event loop while the current task is inside the block to the given guild and command."""
+        task = asyncio.current_task()
+        previous = self._labels.get(task)
+        self._labels[task] = (guildId, command)
+        try:
+            yield
+        finally:
+            if previous is None:
+                del self._labels[task]
+            else:
+                self._labels[task] = previous
+
+    async def _heartbeat(self):
+        while True:
+            beat = self._nextBeat = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            with self._lock:
+                self._wokenBeat = beat
+                loggedBeat, command = self._loggedStall
+            lag = max(0.0, time.monotonic() - beat)
+            metrics.observe('loop_lag_seconds', lag)
+            self.maxLag = max(self.maxLag, lag)
+            if lag >= self.threshold:
+                self.numStalls += 1
+                metrics.increment('loop_stalls_total', command=command if loggedBeat == beat else '')
+                # Stalls that ended before the thread noticed them have no stack
+                print(f'The event loop was blocked for {lag * 1000:.0f} ms' + ('' if loggedBeat == beat else ', too briefly to capture what blocked it'))
+
+    def _watch(self):
+        while not self._stopped.wait(self.interval / 2):
+            beat = self._nextBeat
+            lag = time.monotonic() - beat
+            if lag < self.threshold or beat == self._loggedStall[0]:
+                continue
+
+            with self._lock:
+                if self._wokenBeat == beat:
+                    continue
+                frame = sys._current_frames().get(self._loopThreadId)
+                task = asyncio.current_task(self._loop)
+                guildId, command = self._labels.get(task, (None, None))
+                self._loggedStall = (beat, command or '')
+            if command is not None:
+                blocker = f'command {command} in guild {guildId}'
+            elif task is not None:
+                blocker = f'task {task.get_name()} ({task.get_coro().__qualname__})'
+            else:
+                blocker = 'a callback outside of any task'
+            print(f'The event loop has been blocked for {lag * 1000:.0f} ms by {blocker}:\n{_formatStack(frame)}', end='')
+
+    def getMetrics(self):
+        return {
+            'stalls': self.numStalls,
+            'maxLag': self.maxLag
+        }
@@ -0,0 +1,134 @@
+import functools
+import struct
+from rainbow import RainbowData, RainbowMatch
+
+# The first byte of every encoded match. Bump it whenever the layout changes, and keep decoding the older versions
+CODEC_VERSION = 1
+
+_SIDES = [None, 'attack', 'defense']
+_STAT_TYPES = ['interrogations', 'aces']
+
+# Version, match id, banned operators bitset (low and high half), map id, remaining sites bitset, side, current round, scores, number of players and rounds
+_HEADER = struct.Struct('<B16sQQbHBBBBBB')
+# Player id and the encoded lengths of the name, nick and global name
+_PLAYER = struct.Struct('<QBBB')
+# Site, result, number of operators and backup operators, number of player stat types
+_ROUND = struct.Struct('<bbBBB')
+# Stat type and number of players with that stat
+_STAT = struct.Struct('<BB')
+# The remaining sites of every site bitset a map can have
+_SITES_BY_MASK = [[site for site in range(mask.bit_length()) if mask >> site & 1] for mask in range(1 << max(len(sites) for sites in RainbowData.maps.values()))]
+# Marks a missing value in the unsigned fields, and a missing map, site or result in the signed ones
+_NONE = 255
+_NONE_SIGNED = -128
+
+def _encodeString(value):
+    return value.encode() if value is not None else b''
+
+@functools.lru_cache(maxsize=None)
+def _arrayStruct(item: str, count: int):
+    """Returns the compiled struct of count items, e.g. the operators or the player stats of a round, so their format is only built once per length."""
+    return struct.Struct(f'<{item * count}')
+
+def _decodeString(data: bytes, pos: int, length: int):
+    return (data[pos:pos + length].decode(), pos + length) if length != _NONE else (None, pos)
+
+def _formatMatchId(hexId: str):
+    """Formats the hex digits of a match id like str(uuid.UUID(...)), which is much slower."""
+    return f'{hexId[:8]}-{hexId[8:12]}-{hexId[12:16]}-{hexId[16:20]}-{hexId[20:]}'
+
+def encodeMatch(match: RainbowMatch):
+    """Encodes the state of an ongoing match into its compact binary form.
+    Players are stored by id with their names, their mentions and the players string are derived again when decoding."""
+    parts = [_HEADER.pack(
+        CODEC_VERSION,
+        bytes.fromhex(match.matchId.replace('-', '')),
+        match.bannedMask & 0xffffffffffffffff,
+        match.bannedMask >> 64,
+        RainbowData.mapIds[match.map] if match.map is not None else _NONE_SIGNED,
+        sum(1 << site for site in match.sites),
+        _SIDES.index(match.playingOnSide),
+        match.currRound,
+        match.scores['blue'],
+        match.scores['red'],
+        len(match.players),
+        len(match.rounds)
+    )]
+
+    for player in match.players:
+        names = [_encodeString(player['name']), _encodeString(player['nick']), _encodeString(player['global_name'])]
+        parts.append(_PLAYER.pack(player['id'], *(len(name) if player[key] is not None else _NONE for name, key in zip(names, ['name', 'nick', 'global_name']))))
+        parts.extend(names)
+
+    for round in match.rounds:
+        operators = round['operators']
+        # The backup operators only exist until the round is resolved
+        backupOperators = [RainbowData.operatorIds[op] for op in round['backupOperators']] if 'backupOperators' in round else None
+        parts.append(_ROUND.pack(
+            round['site'] if round['site'] is not None else _NONE_SIGNED,
+            round['result'] if round['result'] is not None else _NONE_SIGNED,
+            len(operators),
+            len(backupOperators) if backupOperators is not None else _NONE,
+            len(round['playerStats'])
+        ))
+        parts.append(_arrayStruct('b', len(operators)).pack(*operators))
+        if backupOperators:
+            parts.append(_arrayStruct('b', len(backupOperators)).pack(*backupOperators))
+        for statType, values in round['playerStats'].items():
+            parts.append(_STAT.pack(_STAT_TYPES.index(statType), len(values)))
+            parts.append(_arrayStruct('QH', len(values)).pack(*(int(value) for item in values.items() for value in item)))
+    return b''.join(parts)
+
+def decodeMatch(data: bytes):
+    """Decodes a match encoded with encodeMatch. The unused match-wide player stats are not encoded and always decode as empty."""
+    if data[0] != CODEC_VERSION:
+        raise ValueError(f'Unsupported match encoding version {data[0]}')
+    _, matchId, bannedLow, bannedHigh, mapId, siteMask, side, currRound, blue, red, numPlayers, numRounds = _HEADER.unpack_from(data)
+    pos = _HEADER.size
+
+    players = []
+    for _ in range(numPlayers):
+        playerId, nameLength, nickLength, globalNameLength = _PLAYER.unpack_from(data, pos)
+        pos += _PLAYER.size
+        name, pos = _decodeString(data, pos, nameLength)
+        nick, pos = _decodeString(data, pos, nickLength)
+        globalName, pos = _decodeString(data, pos, globalNameLength)
+        players.append({'id': playerId, 'mention': f'<@{playerId}>', 'name': name, 'nick': nick, 'global_name': globalName})
+
+    rounds = []
+    for _ in range(numRounds):
+        site, result, numOperators, numBackupOperators, numStatTypes = _ROUND.unpack_from(data, pos)
+        pos += _ROUND.size
+        round = {'site': site if site != _NONE_SIGNED else None, 'operators': list(_arrayStruct('b', numOperators).unpack_from(data, pos))}
+        pos += numOperators
+        if numBackupOperators != _NONE:
+            round['backupOperators'] = [RainbowData.getOperatorName(operatorId) for operatorId in _arrayStruct('b', numBackupOperators).unpack_from(data, pos)]
+            pos += numBackupOperators
+        round['result'] = result if result != _NONE_SIGNED else None
+        playerStats = {}
+        for _ in range(numStatTypes):
+            statType, numValues = _STAT.unpack_from(data, pos)
+            pos += _STAT.size
+            valuesStruct = _arrayStruct('QH', numValues)
+            values = valuesStruct.unpack_from(data, pos)
+            pos += valuesStruct.size
+            playerStats[_STAT_TYPES[statType]] = {str(values[i]): values[i + 1] for i in range(0, len(values), 2)}
+        round['playerStats'] = playerStats
+        rounds.append(round)
+
+    match = RainbowMatch({
+        'matchId': _formatMatchId(matchId.hex()),
+        'bannedMask': bannedLow | bannedHigh << 64,
+        'map': RainbowData.mapsById[mapId] if mapId != _NONE_SIGNED else None,
+        # Copied, as the sites of a match are changed in place
+        'sites': _SITES_BY_MASK[siteMask][:],
+        'playingOnSide': _SIDES[side],
+        'currRound': currRound,
+        'rounds': rounds,
+        'scores': {'blue': blue, 'red': red},
+        'players': players,
+        'playersString': '',
+        'playerStats': []
+    })
+    match._constructPlayersString()
+    return match
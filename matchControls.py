@@ -0,0 +1,55 @@
+import re
+import discord
+
+# The controls of a match message are stored as the emojis used for them in the message text, each control runs the same action as reacting with its emoji
+CONTROL_ACTIONS = {
+    '🇼': 'won',
+    '🇱': 'lost',
+    '⚔️': 'attack',
+    '🛡️': 'defense',
+    '👍': 'another',
+    '🎤': 'anotherHere',
+    '👎': 'goodnight',
+    '✋': 'delete',
+    '🗡️': 'interrogation'
+}
+_CONTROL_EMOJIS = {action: emoji for emoji, action in CONTROL_ACTIONS.items()}
+
+_CONTROL_BUTTONS = {
+    'won': ('Won', discord.ButtonStyle.success),
+    'lost': ('Lost', discord.ButtonStyle.danger),
+    'attack': ('Attack', discord.ButtonStyle.primary),
+    'defense': ('Defense', discord.ButtonStyle.primary),
+    'another': ('Another', discord.ButtonStyle.success),
+    'anotherHere': ('Another here', discord.ButtonStyle.success),
+    'goodnight': ('Goodnight', discord.ButtonStyle.secondary),
+    'delete': ('Goodnight (delete)', discord.ButtonStyle.danger),
+    'interrogation': ('Interrogation', discord.ButtonStyle.secondary)
+}
+
+class MatchControlButton(discord.ui.DynamicItem[discord.ui.Button], template=rf'r6:(?P<guildId>[0-9]+):(?P<matchId>[0-9a-f-]+):(?P<action>{"|".join(_CONTROL_BUTTONS)})'):
+    """A button of a match message. Its custom id holds the server, match and action, so the button keeps working after a restart without any stored view."""
+    def __init__(self, guildId: int, matchId: str, action: str):
+        label, style = _CONTROL_BUTTONS.get(action, (action, discord.ButtonStyle.secondary))
+        super().__init__(discord.ui.Button(label=label, emoji=_CONTROL_EMOJIS.get(action), style=style, custom_id=f'r6:{guildId}:{matchId}:{action}'))
+        self.guildId = guildId
+        self.matchId = matchId
+        self.action = action
+
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: discord.ui.Button, match: re.Match):
+        return cls(int(match['guildId']), match['matchId'], match['action'])
+
+    async def callback(self, interaction: discord.Interaction):
+        # Acknowledge the click right away, the match message is then updated by the usual edit
+        await interaction.response.defer()
+        await interaction.client.handleMatchControl(interaction, self.matchId, _CONTROL_EMOJIS[self.action])
+
+def createControlsView(guildId: int, matchId: str, emojis: list):
+    """Returns the view with the buttons for the given controls, or None if there are no controls."""
+    if not emojis or matchId is None:
+        return None
+    view = discord.ui.View(timeout=None)
+    for emoji in emojis:
+        view.add_item(MatchControlButton(guildId, matchId, CONTROL_ACTIONS[emoji]))
+    return view
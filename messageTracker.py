@@ -0,0 +1,97 @@
+import discord
+
+# Match messages are only edited in place while they are among this many of the newest messages in their channel
+RECENT_MESSAGE_LIMIT = 7
+# ... and the messages below them have fewer than this many lines in total
+RECENT_LINE_LIMIT = 12
+
+class MessageTracker:
+    """Follows the messages posted below the match message of each channel through the gateway events, so deciding whether to edit or repost the match message needs no REST calls."""
+    def __init__(self):
+        # Channel id -> the tracked match message, its handle and the line counts of the messages posted after it, by message id
+        self._channels = {}
+
+    def track(self, message: discord.Message, messagesAfter: dict = None, isLive=False):
+        """Starts tracking a match message, optionally with the line counts of the messages already posted after it.
+        isLive tells whether the handle is the one discord.py keeps up to date, e.g. because the gateway event of the message arrived before it was tracked."""
+        self._channels[message.channel.id] = {
+            'messageId': message.id,
+            'message': message,
+            'isLive': isLive,
+            'linesAfter': dict(messagesAfter) if messagesAfter else {},
+            'overflowed': False,
+            # Emoji -> the ids of the users whose reactions were added since tracking started
+            'reactionUsers': {}
+        }
+
+    def forget(self, channelId: int):
+        self._channels.pop(channelId, None)
+
+    def getMessage(self, channelId: int, messageId: int, requireLive=True):
+        """Returns the cached handle of the tracked match message, or None if the message is not tracked. Unless requireLive is False, only handles that discord.py keeps up to date are returned."""
+        tracked = self._channels.get(channelId)
+        return tracked['message'] if tracked is not None and tracked['messageId'] == messageId and (tracked['isLive'] or not requireLive) else None
+
+    def isRecent(self, channelId: int, messageId: int):
+        """Returns whether the match message is still recent enough to be edited in place, or None if the tracker does not know."""
+        tracked = self._channels.get(channelId)
+        if tracked is None or tracked['messageId'] != messageId:
+            return None
+        if tracked['overflowed']:
+            return False
+        return len(tracked['linesAfter']) < RECENT_MESSAGE_LIMIT and sum(tracked['linesAfter'].values()) < RECENT_LINE_LIMIT
+
+    def getReactionUsers(self, channelId: int, messageId: int, emoji):
+        """Returns the ids of the users known to have reacted to the match message with the emoji."""
+        tracked = self._channels.get(channelId)
+        if tracked is None or tracked['messageId'] != messageId:
+            return set()
+        return tracked['reactionUsers'].get(str(emoji), set())
+
+    def onReactionAdd(self, channelId: int, messageId: int, emoji, userId: int):
+        tracked = self._channels.get(channelId)
+        if tracked is not None and tracked['messageId'] == messageId:
+            tracked['reactionUsers'].setdefault(str(emoji), set()).add(userId)
+
+    def onReactionRemove(self, channelId: int, messageId: int, emoji, userId: int):
+        tracked = self._channels.get(channelId)
+        if tracked is not None and tracked['messageId'] == messageId:
+            tracked['reactionUsers'].get(str(emoji), set()).discard(userId)
+
+    def onReactionClear(self, channelId: int, messageId: int, emoji=None):
+        """Forgets the reactions with the emoji, or all reactions if no emoji is given."""
+        tracked = self._channels.get(channelId)
+        if tracked is not None and tracked['messageId'] == messageId:
+            if emoji is None:
+                tracked['reactionUsers'].clear()
+            else:
+                tracked['reactionUsers'].pop(str(emoji), None)
+
+    def onMessage(self, message: discord.Message):
+        tracked = self._channels.get(message.channel.id)
+        if tracked is None:
+            return
+        if message.id == tracked['messageId']:
+            # Prefer the handle from the gateway, which discord.py keeps up to date with edits and reactions
+            tracked['message'] = message
+            tracked['isLive'] = True
+        elif message.id > tracked['messageId'] and not tracked['overflowed']:
+            tracked['linesAfter'][message.id] = len(message.content.split('\n'))
+            # Once far more messages than needed have been posted, only a repost can make the message recent again
+            if len(tracked['linesAfter']) > RECENT_MESSAGE_LIMIT * 4:
+                tracked['overflowed'] = True
+                tracked['linesAfter'].clear()
+
+    def onMessageEdit(self, channelId: int, messageId: int, content: str):
+        tracked = self._channels.get(channelId)
+        if tracked is not None and messageId in tracked['linesAfter']:
+            tracked['linesAfter'][messageId] = len(content.split('\n'))
+
+    def onMessageDelete(self, channelId: int, messageId: int):
+        tracked = self._channels.get(channelId)
+        if tracked is None:
+            return
+        if messageId == tracked['messageId']:
+            self.forget(channelId)
+        else:
+            tracked['linesAfter'].pop(messageId, None)
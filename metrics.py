@@ -0,0 +1,161 @@
+import bisect
+import contextlib
+import re
+import time
+
+# Upper bounds (in seconds) of the histogram buckets, from in-memory work that takes well below a millisecond to slow Discord requests
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Every metric the bot records, with the help text of the exported metric. Exported names get the "randomsix_" prefix
+METRIC_DESCRIPTIONS = {
+    'command_seconds': 'Time from the start of a command until it is done, by command and cog, excluding the wait for earlier work of the channel.',
+    'command_errors_total': 'Commands that raised an error or failed a check, by command and cog.',
+    'control_seconds': 'Time a click on a button or a reaction on a match message took to handle, by control emoji and kind.',
+    'match_data_seconds': 'Time getMatchData took to find the ongoing match of a channel.',
+    'database_seconds': 'Time waited for the database, by storage operation.',
+    'discord_seconds': 'Time spent on Discord requests for match messages, by operation.',
+    'discord_requests_total': 'Requests sent to Discord to post and edit match messages and to change their reactions, by request type.',
+    'fuzzy_match_seconds': 'Time fuzzy matching of user input took when the input was no exact name or prefix, by kind.',
+    'loop_lag_seconds': 'How late the event loop ran the timer of the loop watchdog.',
+    'loop_stalls_total': 'Times the event loop was blocked for longer than LOOP_LAG_THRESHOLD, by the command that blocked it if it could be captured.'
+}
+
+_PREFIX = 'randomsix_'
+
+def _escapeLabelValue(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _formatLabels(labels: tuple, extra: tuple = ()):
+    labels = labels + extra
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escapeLabelValue(value)}"' for key, value in labels) + '}'
+
+def _toSnakeCase(name: str):
+    return re.sub(r'(?<!^)(?=[A-Z])', '_', name).lower()
+
+class Histogram:
+    """Counts observations in fixed buckets, like a Prometheus histogram, and remembers their sum and maximum."""
+    def __init__(self, buckets: tuple = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        # The last count is for observations above the largest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def getQuantile(self, quantile: float):
+        """Returns the upper bound of the bucket the quantile falls into, or the maximum if it falls above the largest bucket."""
+        if self.count == 0:
+            return 0.0
+        rank = quantile * self.count
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return min(bound, self.max)
+        return self.max
+
+class MetricsRegistry:
+    """Holds the histograms and counters of the bot, keyed by metric name and labels, and the collectors of metrics other components already keep."""
+    def __init__(self):
+        # (name, labels) -> Histogram or number, labels being a tuple of (key, value) pairs in the order they were given
+        self._histograms = {}
+        self._counters = {}
+        # Name -> function returning a dict of the current values, such as GuildExecutor.getMetrics
+        self._collectors = {}
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(labels.items()))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = Histogram()
+        histogram.observe(value)
+
+    def increment(self, name: str, amount: float = 1, **labels):
+        key = (name, tuple(labels.items()))
+        self._counters[key] = self._counters.get(key, 0) + amount
+
+    @contextlib.contextmanager
+    def timed(self, name: str, **labels):
+        """Observes the time the block took in the histogram, also if it raised an error."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def addCollector(self, name: str, getMetrics):
+        """Exports the values getMetrics returns as gauges named after the collector and the keys, replacing any earlier collector of the same name."""
+        self._collectors[name] = getMetrics
+
+    def getHistograms(self):
+        """Returns (name, labels, histogram) of all histograms."""
+        return [(name, dict(labels), histogram) for (name, labels), histogram in self._histograms.items()]
+
+    def getCounters(self):
+        return [(name, dict(labels), value) for (name, labels), value in self._counters.items()]
+
+    def collect(self):
+        """Returns the current values of all collectors, as collector name -> dict."""
+        return {name: getMetrics() for name, getMetrics in self._collectors.items()}
+
+    def render(self):
+        """Returns all metrics in the Prometheus text exposition format."""
+        lines = []
+        for name in sorted({name for name, _ in self._histograms}):
+            self._renderHeader(lines, name, 'histogram')
+            for (histogramName, labels), histogram in self._histograms.items():
+                if histogramName != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f'{_PREFIX}{name}_bucket{_formatLabels(labels, (("le", bound),))} {cumulative}')
+                lines.append(f'{_PREFIX}{name}_bucket{_formatLabels(labels, (("le", "+Inf"),))} {histogram.count}')
+                lines.append(f'{_PREFIX}{name}_sum{_formatLabels(labels)} {histogram.sum}')
+                lines.append(f'{_PREFIX}{name}_count{_formatLabels(labels)} {histogram.count}')
+        for name in sorted({name for name, _ in self._counters}):
+            self._renderHeader(lines, name, 'counter')
+            for (counterName, labels), value in self._counters.items():
+                if counterName == name:
+                    lines.append(f'{_PREFIX}{name}{_formatLabels(labels)} {value}')
+        for collectorName, values in self.collect().items():
+            for key, value in values.items():
+                name = f'{_PREFIX}{collectorName}_{_toSnakeCase(key)}'
+                lines.append(f'# TYPE {name} gauge')
+                lines.append(f'{name} {float(value)}')
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _renderHeader(lines: list, name: str, kind: str):
+        if name in METRIC_DESCRIPTIONS:
+            lines.append(f'# HELP {_PREFIX}{name} {METRIC_DESCRIPTIONS[name]}')
+        lines.append(f'# TYPE {_PREFIX}{name} {kind}')
+
+# The registry of the bot process, shared by the bot, the cogs and the match engine
+registry = MetricsRegistry()
+observe = registry.observe
+increment = registry.increment
+timed = registry.timed
+
+async def startServer(host: str, port: int, metricsRegistry: MetricsRegistry = registry):
+    """Serves the metrics of the registry at http://host:port/metrics for Prometheus to scrape. Returns the runner, which must be cleaned up to stop the server."""
+    from aiohttp import web
+
+    async def handleMetrics(request):
+        return web.Response(text=metricsRegistry.render(), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+    app = web.Application()
+    app.router.add_get('/metrics', handleMetrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
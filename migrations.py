@@ -0,0 +1,156 @@
+import sqlite3
+import statisticsRollups
+
+# The channel id of ongoing matches that were saved before matches were kept per channel
+LEGACY_CHANNEL_ID = 0
+
+def _createInitialSchema(conn: sqlite3.Connection):
+    # Currently ongoing matches, one per server
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS ongoing_matches (
+            server_id INTEGER PRIMARY KEY,
+            match_data TEXT,
+            discord_message TEXT
+        )
+    """)
+
+    # Matches with their map and overall scores
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS matches (
+            match_id TEXT PRIMARY KEY,
+            server_id INTEGER,
+            map TEXT,
+            result INTEGER
+        )
+    """)
+
+    # Players that have ever played in a match
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS players (
+            player_id INTEGER PRIMARY KEY
+        )
+    """)
+
+    # Matches a certain player has played
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS player_matches (
+            player_id INTEGER,
+            match_id TEXT,
+            PRIMARY KEY(player_id, match_id),
+            FOREIGN KEY(player_id) REFERENCES players(player_id),
+            FOREIGN KEY(match_id) REFERENCES matches(match_id)
+        )
+    """)
+
+    # Played sites and outcome for each round, 1 is win, 0 is loss
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS rounds (
+            match_id TEXT,
+            round_num INTEGER,
+            site INTEGER,
+            result INTEGER,
+            PRIMARY KEY(match_id, round_num),
+            FOREIGN KEY(match_id) REFERENCES matches(match_id)
+        )
+    """)
+
+    # Operators played by a player in each round
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS player_rounds (
+            player_id INTEGER,
+            match_id TEXT,
+            round_num INTEGER,
+            operator INTEGER,
+            PRIMARY KEY(player_id, match_id, round_num),
+            FOREIGN KEY(match_id) REFERENCES matches(match_id),
+            FOREIGN KEY(player_id) REFERENCES players(player_id)
+        )
+    """)
+
+    # Additional player statistics, such as Caveira interrogations, Aces etc.
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS player_additional_stats (
+            player_id INTEGER,
+            stat_type INTEGER,
+            value INTEGER,
+            PRIMARY KEY(player_id, stat_type),
+            FOREIGN KEY(player_id) REFERENCES players(player_id)
+        )
+    """)
+
+def _addStatisticsIndexes(conn: sqlite3.Connection):
+    # Covering indexes for the statistics queries, so they never have to read the table rows
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_matches_match ON matches(match_id, map, result)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_matches_server ON matches(server_id, map, result, match_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_rounds_match ON rounds(match_id, round_num, result, site)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_player_rounds_player ON player_rounds(player_id, match_id, round_num, operator)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_player_rounds_match ON player_rounds(match_id, round_num, operator)")
+
+def _addStatisticsRollups(conn: sqlite3.Connection):
+    # Win/loss counters for the statistics, filled from all matches played so far
+    statisticsRollups.createRollupTables(conn)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_player_matches_match ON player_matches(match_id)")
+    statisticsRollups.rebuild(conn)
+
+def _keyOngoingMatchesByChannel(conn: sqlite3.Connection):
+    # Ongoing matches, one per channel of a server, so a server can run several lobbies at once.
+    # Matches saved while there was only one per server are kept under LEGACY_CHANNEL_ID until a channel of their server picks them up
+    conn.execute("""
+        CREATE TABLE ongoing_matches_by_channel (
+            server_id INTEGER,
+            channel_id INTEGER,
+            match_data BLOB,
+            discord_message TEXT,
+            PRIMARY KEY(server_id, channel_id)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("INSERT INTO ongoing_matches_by_channel (server_id, channel_id, match_data, discord_message) SELECT server_id, ?, match_data, discord_message FROM ongoing_matches", (LEGACY_CHANNEL_ID,))
+    conn.execute("DROP TABLE ongoing_matches")
+    conn.execute("ALTER TABLE ongoing_matches_by_channel RENAME TO ongoing_matches")
+
+# Each migration brings the database schema to the next version, as stored in "PRAGMA user_version". Never change or reorder existing migrations, only append new ones.
+MIGRATIONS = [
+    _createInitialSchema,
+    _addStatisticsIndexes,
+    _addStatisticsRollups,
+    _keyOngoingMatchesByChannel
+]
+
+def getSchemaVersion(conn: sqlite3.Connection):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def migrate(conn: sqlite3.Connection):
+    """Applies all migrations the database has not seen yet, each in its own transaction, and returns the new schema version.
+    Several processes sharing the database may migrate it at the same time, each migration is only applied by one of them."""
+    while True:
+        # Take the write lock before reading the version, so no other process can apply the same migration in between
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            version = getSchemaVersion(conn)
+            if version >= len(MIGRATIONS):
+                conn.rollback()
+                return version
+            MIGRATIONS[version](conn)
+            conn.execute(f"PRAGMA user_version = {version + 1}")
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+
+def findFullTableScans(queries: list):
+    """Returns the (query, plan step) pairs for all queries that would scan a full table or index on the latest schema."""
+    conn = sqlite3.connect(':memory:')
+    try:
+        migrate(conn)
+        fullScans = []
+        for query in queries:
+            # Scanning the rows of a subquery is fine, as long as the subquery itself uses an index
+            subqueries = set()
+            for _, _, _, detail in conn.execute(f'EXPLAIN QUERY PLAN {query}', [None] * query.count('?')):
+                if detail.startswith(('CO-ROUTINE ', 'MATERIALIZE ')):
+                    subqueries.add(detail.split()[1])
+                elif detail.startswith('SCAN') and detail.split()[1] not in subqueries:
+                    fullScans.append((query, detail))
+        return fullScans
+    finally:
+        conn.close()
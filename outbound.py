@@ -0,0 +1,129 @@
+import asyncio
+import time
+import discord
+import metrics
+
+class RateLimitBucket:
+    """A token bucket that spaces out requests sharing one of Discord's rate limits, so they are delayed locally instead of being answered with a 429."""
+    def __init__(self, capacity: int, period: float):
+        self.capacity = capacity
+        self.period = period
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.capacity / self.period)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) * self.period / self.capacity)
+
+def _getViewKey(view):
+    return tuple(item.custom_id for item in view.children) if view is not None else ()
+
+class OutboundQueue:
+    """Coalesces the updates of each match message: updates submitted within the debounce window, or while the previous update is still being sent, are merged so only the latest one is sent.
+    For every update that is sent, the content and components are always edited before the reactions are changed, and updates of one message are sent in the order they were submitted."""
+    def __init__(self, applyReactions, debounce: float):
+        # Called as applyReactions(message, reactions, bucket) after the content has been edited, reactions is None if all reactions should be cleared.
+        # Each reaction request must first be acquired from the bucket
+        self._applyReactions = applyReactions
+        self.debounce = debounce
+        # Message id -> the latest update that has not been sent yet
+        self._pending = {}
+        # Message id -> the task sending the updates of the message
+        self._workers = {}
+        # Message id -> the content and component ids the message was last edited to, so an unchanged message is never edited again
+        self._sentState = {}
+        # Channel id -> the buckets of message edits and reaction requests in the channel
+        self._buckets = {}
+        # Created on first use, as it has to be created on the event loop
+        self._flushing = None
+
+    def submit(self, message: discord.Message, content: str, view, reactions):
+        """Schedules an update of the message to the given content and view (None removes all components), replacing any update of it that has not been sent yet.
+        Returns a future that is done once this update, or one that replaced it, has been sent."""
+        if self._flushing is None:
+            self._flushing = asyncio.Event()
+        pending = self._pending.get(message.id)
+        done = pending['done'] if pending is not None else asyncio.get_running_loop().create_future()
+        self._pending[message.id] = {
+            'message': message,
+            'content': content,
+            'view': view,
+            'reactions': list(reactions) if reactions is not None else None,
+            'done': done
+        }
+        if message.id not in self._workers:
+            self._workers[message.id] = asyncio.create_task(self._run(message.id))
+        return done
+
+    def markSent(self, messageId: int, content: str, view):
+        """Records the content and view a message was sent with, so an update to the same state does not edit it."""
+        self._sentState[messageId] = (content, _getViewKey(view))
+
+    def _dropPending(self, messageId: int):
+        pending = self._pending.pop(messageId, None)
+        if pending is not None and not pending['done'].done():
+            pending['done'].set_result(None)
+
+    def discard(self, messageId: int):
+        """Drops all updates of a message that is about to be deleted or will no longer be updated."""
+        self._dropPending(messageId)
+        worker = self._workers.pop(messageId, None)
+        if worker is not None and worker is not asyncio.current_task():
+            worker.cancel()
+        self._sentState.pop(messageId, None)
+
+    async def flush(self):
+        """Sends all pending updates immediately and waits until they have been sent."""
+        if self._flushing is None:
+            return
+        self._flushing.set()
+        try:
+            await asyncio.gather(*self._workers.values(), return_exceptions=True)
+        finally:
+            self._flushing.clear()
+
+    def _getBuckets(self, channelId: int):
+        buckets = self._buckets.get(channelId)
+        if buckets is None:
+            # Discord allows about five message edits per five seconds and four reaction requests per second in each channel
+            buckets = self._buckets[channelId] = (RateLimitBucket(5, 5.0), RateLimitBucket(4, 1.0))
+        return buckets
+
+    async def _run(self, messageId: int):
+        try:
+            while messageId in self._pending:
+                # Wait for further updates to merge with, unless the queue is being flushed
+                try:
+                    await asyncio.wait_for(self._flushing.wait(), timeout=self.debounce)
+                except asyncio.TimeoutError:
+                    pass
+
+                update = self._pending.pop(messageId)
+                message = update['message']
+                editBucket, reactionBucket = self._getBuckets(message.channel.id)
+                try:
+                    state = (update['content'], _getViewKey(update['view']))
+                    if state != self._sentState.get(messageId):
+                        await editBucket.acquire()
+                        metrics.increment('discord_requests_total', request='editMessage')
+                        with metrics.timed('discord_seconds', operation='editMessage'):
+                            await message.edit(content=update['content'], view=update['view'])
+                        self._sentState[messageId] = state
+                    await self._applyReactions(message, update['reactions'], reactionBucket)
+                except discord.NotFound:
+                    # The message has been deleted in the meantime, so there is nothing left to update
+                    self._dropPending(messageId)
+                except discord.HTTPException as e:
+                    print(f'Failed to update message {messageId}: {e}')
+                finally:
+                    if not update['done'].done():
+                        update['done'].set_result(None)
+        finally:
+            if self._workers.get(messageId) is asyncio.current_task():
+                del self._workers[messageId]
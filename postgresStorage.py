@@ -0,0 +1,201 @@
+import functools
+import statisticsRollups
+from storage import MatchStorage, PLAYER_STATISTICS_QUERIES, SERVER_STATISTICS_QUERIES, getCompletedMatchRows
+
+# Makes sure only one process migrates the schema at a time, the number is arbitrary but must stay the same
+_MIGRATION_LOCK_ID = 0x52365342
+
+def _createInitialSchema():
+    statements = [
+        # Currently ongoing matches, one per channel of a server
+        """
+            CREATE TABLE ongoing_matches (
+                server_id BIGINT,
+                channel_id BIGINT,
+                match_data BYTEA,
+                discord_message TEXT,
+                PRIMARY KEY(server_id, channel_id)
+            )
+        """,
+        """
+            CREATE TABLE matches (
+                match_id TEXT PRIMARY KEY,
+                server_id BIGINT,
+                map TEXT,
+                result INTEGER
+            )
+        """,
+        "CREATE TABLE players (player_id BIGINT PRIMARY KEY)",
+        """
+            CREATE TABLE player_matches (
+                player_id BIGINT REFERENCES players(player_id),
+                match_id TEXT REFERENCES matches(match_id),
+                PRIMARY KEY(player_id, match_id)
+            )
+        """,
+        """
+            CREATE TABLE rounds (
+                match_id TEXT REFERENCES matches(match_id),
+                round_num INTEGER,
+                site INTEGER,
+                result INTEGER,
+                PRIMARY KEY(match_id, round_num)
+            )
+        """,
+        """
+            CREATE TABLE player_rounds (
+                player_id BIGINT REFERENCES players(player_id),
+                match_id TEXT REFERENCES matches(match_id),
+                round_num INTEGER,
+                operator INTEGER,
+                PRIMARY KEY(player_id, match_id, round_num)
+            )
+        """,
+        """
+            CREATE TABLE player_additional_stats (
+                player_id BIGINT REFERENCES players(player_id),
+                stat_type TEXT,
+                value INTEGER,
+                PRIMARY KEY(player_id, stat_type)
+            )
+        """,
+        # The same indexes as on SQLite, so the statistics never have to scan a table
+        "CREATE INDEX idx_matches_server ON matches(server_id, map, result, match_id)",
+        "CREATE INDEX idx_rounds_match ON rounds(match_id, round_num, result, site)",
+        "CREATE INDEX idx_player_rounds_player ON player_rounds(player_id, match_id, round_num, operator)",
+        "CREATE INDEX idx_player_rounds_match ON player_rounds(match_id, round_num, operator)",
+        "CREATE INDEX idx_player_matches_match ON player_matches(match_id)"
+    ]
+    for table, keys in statisticsRollups.ROLLUP_KEYS.items():
+        columns = ', '.join(f'{key} {"TEXT" if key == "map" else "BIGINT" if key.endswith("_id") else "INTEGER"} NOT NULL' for key in keys)
+        statements.append(f"CREATE TABLE {table} ({columns}, wins BIGINT NOT NULL, losses BIGINT NOT NULL, PRIMARY KEY({', '.join(keys)}))")
+    return statements
+
+# Each migration is a list of statements that brings the schema to the next version, as stored in the schema_version table. Never change or reorder existing migrations, only append new ones.
+# The versions are independent of the SQLite schema versions, as the PostgreSQL schema started out with all SQLite migrations applied
+MIGRATIONS = [
+    _createInitialSchema()
+]
+
+@functools.lru_cache(maxsize=None)
+def _toPostgres(sql: str):
+    """Replaces the ? placeholders of the shared SQL with the numbered placeholders PostgreSQL uses."""
+    parts = sql.split('?')
+    return ''.join(part + (f'${i + 1}' if i < len(parts) - 1 else '') for i, part in enumerate(parts))
+
+class PostgresStorage(MatchStorage):
+    """Stores everything in a PostgreSQL server, which any number of bot processes on any number of machines can share. Requires the asyncpg package."""
+    def __init__(self, url: str, minConnections: int = 1, maxConnections: int = 8):
+        self.url = url
+        self.minConnections = minConnections
+        self.maxConnections = maxConnections
+        self.pool = None
+
+    async def open(self):
+        try:
+            import asyncpg
+        except ImportError as e:
+            raise RuntimeError('Using a PostgreSQL database requires the asyncpg package, install it with "pip install asyncpg"') from e
+
+        # Each connection prepares every statement once and reuses it from its statement cache afterwards
+        self.pool = await asyncpg.create_pool(self.url, min_size=self.minConnections, max_size=self.maxConnections)
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute("SELECT pg_advisory_xact_lock($1)", _MIGRATION_LOCK_ID)
+                await conn.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)")
+                previousVersion = await conn.fetchval("SELECT version FROM schema_version")
+                if previousVersion is None:
+                    await conn.execute("INSERT INTO schema_version (version) VALUES (0)")
+                    previousVersion = 0
+                if previousVersion > len(MIGRATIONS):
+                    raise RuntimeError(f'The database has schema version {previousVersion}, but this version of the bot only knows {len(MIGRATIONS)}, update the bot')
+                if previousVersion < len(MIGRATIONS):
+                    for migration in MIGRATIONS[previousVersion:]:
+                        for statement in migration:
+                            await conn.execute(statement)
+                    await conn.execute("UPDATE schema_version SET version = $1", len(MIGRATIONS))
+        return previousVersion, len(MIGRATIONS)
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+    async def loadOngoingMatches(self):
+        rows = await self.pool.fetch("SELECT server_id, channel_id, match_data, discord_message FROM ongoing_matches")
+        return [tuple(row) for row in rows]
+
+    async def writeOngoingMatches(self, upserts: list, deletions: list):
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                if deletions:
+                    await conn.executemany("DELETE FROM ongoing_matches WHERE server_id = $1 AND channel_id = $2", deletions)
+                if upserts:
+                    await conn.executemany("""
+                        INSERT INTO ongoing_matches (server_id, channel_id, match_data, discord_message) VALUES ($1, $2, $3, $4)
+                        ON CONFLICT (server_id, channel_id) DO UPDATE SET match_data = excluded.match_data, discord_message = excluded.discord_message
+                    """, upserts)
+
+    async def saveCompletedMatches(self, matches: list):
+        rows = getCompletedMatchRows(matches)
+        if not rows['matches']:
+            return
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.executemany("INSERT INTO matches (match_id, server_id, map, result) VALUES ($1, $2, $3, $4)", rows['matches'])
+                await conn.executemany("INSERT INTO players (player_id) VALUES ($1) ON CONFLICT DO NOTHING", rows['players'])
+                await conn.executemany("INSERT INTO player_matches (player_id, match_id) VALUES ($1, $2)", rows['player_matches'])
+                if rows['rounds']:
+                    await conn.executemany("INSERT INTO rounds (round_num, match_id, site, result) VALUES ($1, $2, $3, $4)", rows['rounds'])
+                    await conn.executemany("INSERT INTO player_rounds (player_id, match_id, round_num, operator) VALUES ($1, $2, $3, $4)", rows['player_rounds'])
+                if rows['player_additional_stats']:
+                    # Increase the counter of each stat by the count, or create it if it doesn't exist
+                    await conn.executemany("""
+                        INSERT INTO player_additional_stats (player_id, stat_type, value) VALUES ($1, $2, $3)
+                        ON CONFLICT(player_id, stat_type) DO UPDATE SET value = player_additional_stats.value + excluded.value
+                    """, rows['player_additional_stats'])
+                await self._applyMatches(conn, [row[0] for row in rows['matches']])
+
+    @staticmethod
+    async def _applyMatches(conn, matchIds: list, sign: int = 1):
+        for statement in statisticsRollups.APPLY_STATEMENTS:
+            await conn.executemany(_toPostgres(statement), [(sign, sign, matchId) for matchId in matchIds])
+        if sign < 0:
+            for statement in statisticsRollups.CLEANUP_STATEMENTS:
+                await conn.executemany(_toPostgres(statement), [(matchId,) for matchId in matchIds])
+
+    async def deleteMatch(self, matchId: str):
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                serverId = await conn.fetchval("SELECT server_id FROM matches WHERE match_id = $1 FOR UPDATE", matchId)
+                if serverId is None:
+                    return None
+                playerIds = [row[0] for row in await conn.fetch("SELECT player_id FROM player_matches WHERE match_id = $1", matchId)]
+                await self._deleteMatches(conn, [matchId])
+        return serverId, playerIds
+
+    async def deleteMatchesWithoutMap(self):
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                matchIds = [row[0] for row in await conn.fetch("SELECT match_id FROM matches WHERE map IS NULL FOR UPDATE")]
+                if matchIds:
+                    await self._deleteMatches(conn, matchIds)
+
+    @classmethod
+    async def _deleteMatches(cls, conn, matchIds: list):
+        await cls._applyMatches(conn, matchIds, -1)
+        # Unlike SQLite, PostgreSQL enforces the foreign keys, so the rows referencing a match go first
+        for table in ['player_rounds', 'rounds', 'player_matches', 'matches']:
+            await conn.execute(f"DELETE FROM {table} WHERE match_id = ANY($1::text[])", matchIds)
+
+    async def rebuildStatistics(self):
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                for statement in statisticsRollups.REBUILD_STATEMENTS:
+                    await conn.execute(statement)
+
+    async def getPlayerStatistics(self, playerId: int, statType: str):
+        return [tuple(row) for row in await self.pool.fetch(_toPostgres(PLAYER_STATISTICS_QUERIES[statType]), playerId)]
+
+    async def getServerStatistics(self, serverId: int, statType: str):
+        return [tuple(row) for row in await self.pool.fetch(_toPostgres(SERVER_STATISTICS_QUERIES[statType]), serverId)]
@@ -1,7 +1,9 @@
+import functools
+import metrics
 import random
 import re
+import unicodedata
 import uuid
-from fuzzywuzzy import process
 from dataclasses import dataclass
 
 @dataclass
@@ -48,11 +50,111 @@ class RainbowData:
         'UnknownMap': ['FIRST', 'SECOND', 'THIRD', 'FOURTH']
     }
 
+    # Stable integer ids of the maps. New maps must be added directly above 'UnknownMap', which always has the id -1
+    mapIds = {map: (i if map != 'UnknownMap' else -1) for i, map in enumerate(maps)}
+    mapsById = {mapId: map for map, mapId in mapIds.items()}
+
+    # The 1-indexed index of each operator, negated for defenders. These ids are stored in the database, so new operators must be appended to the lists
+    operatorIds = {**{op: i + 1 for i, op in enumerate(attackers)}, **{op: -(i + 1) for i, op in enumerate(defenders)}}
+
+    # Names players commonly use for operators that are not just a prefix of the operator's name
+    operatorAliases = {
+        'Montagne': ['monty'],
+        'Blackbeard': ['bb'],
+        'Tachanka': ['lord', 'chanka', 'lordtachanka'],
+        'Thunderbird': ['tb'],
+        'Jäger': ['jaeger'],
+        'Nøkk': ['noekk'],
+        'Capitão': ['captain']
+    }
+
+    # Sets of operators are stored as integer bitsets: attacker id n is bit n - 1, defender id -n is bit 64 + n - 1
+    operatorBits = {**{i + 1: 1 << i for i in range(len(attackers))}, **{-(i + 1): 1 << (64 + i) for i in range(len(defenders))}}
+    attackerMask = (1 << len(attackers)) - 1
+    defenderMask = ((1 << len(defenders)) - 1) << 64
+
+    @staticmethod
+    def getOperatorName(operatorId: int):
+        """Returns the name of the operator with the given id."""
+        return RainbowData.attackers[operatorId - 1] if operatorId > 0 else RainbowData.defenders[-operatorId - 1]
+
+    @staticmethod
+    @functools.lru_cache(maxsize=4096)
+    def getOperatorIdsInMask(mask: int):
+        """Returns the ids of all operators in the given bitset, attackers first, in the order of the operator lists."""
+        return tuple(operatorId for operatorId, bit in RainbowData.operatorBits.items() if mask & bit)
+
+_mapsByLowercaseName = {map.lower(): map for map in RainbowData.maps}
+
+@functools.lru_cache(maxsize=1024)
+def resolveMap(mapName: str):
+    """Returns the canonical name of the map the user input refers to, or None if it does not refer to any map."""
+    if mapName in RainbowData.maps:
+        return mapName
+    exactMatch = _mapsByLowercaseName.get(mapName.strip().lower())
+    if exactMatch is not None:
+        return exactMatch
+
+    # fuzzywuzzy is only imported once it is needed, as importing it slows down the startup
+    from fuzzywuzzy import process
+    with metrics.timed('fuzzy_match_seconds', kind='map'):
+        best_match, score = process.extractOne(mapName, RainbowData.maps.keys())
+    if score > 70:
+        return best_match
+    return None
+
+# Letters that are not split into a base letter and a diacritic by unicode normalization
+_transliterations = str.maketrans({'ø': 'o', 'æ': 'ae', 'œ': 'oe', 'ß': 'ss', 'ł': 'l', 'đ': 'd'})
+
+def _normalizeName(name: str):
+    """Lowercases a name and removes diacritics and non-alphanumeric characters, e.g. "Nøkk" becomes "nokk"."""
+    name = unicodedata.normalize('NFKD', name.lower().translate(_transliterations))
+    return ''.join(c for c in name if c.isalnum() and not unicodedata.combining(c))
+
+def _buildOperatorIndex():
+    """Maps every normalized operator name and alias to its operator id, and every prefix of at least two letters to the ids of all operators starting with it."""
+    names, prefixes = {}, {}
+    for op, operatorId in RainbowData.operatorIds.items():
+        for name in [_normalizeName(op)] + RainbowData.operatorAliases.get(op, []):
+            names[name] = operatorId
+            for length in range(2, len(name) + 1):
+                prefixes.setdefault(name[:length], set()).add(operatorId)
+    return names, {prefix: frozenset(ids) for prefix, ids in prefixes.items()}
+
+_operatorIdsByName, _operatorIdsByPrefix = _buildOperatorIndex()
+_allOperatorIds = frozenset(RainbowData.operatorIds.values())
+
+@functools.lru_cache(maxsize=4096)
+def _resolveOperatorToken(token: str, candidateIds: frozenset):
+    operatorId = _operatorIdsByName.get(token)
+    if operatorId is not None:
+        return operatorId if operatorId in candidateIds else None
+
+    # A prefix is only used if it is unambiguous among the candidates
+    prefixMatches = _operatorIdsByPrefix.get(token, frozenset()) & candidateIds
+    if len(prefixMatches) == 1:
+        return next(iter(prefixMatches))
+
+    if not candidateIds:
+        return None
+    from fuzzywuzzy import process
+    with metrics.timed('fuzzy_match_seconds', kind='operator'):
+        _, score, operatorId = process.extractOne(token, {operatorId: _normalizeName(RainbowData.getOperatorName(operatorId)) for operatorId in candidateIds})
+    return operatorId if score >= 75 else None
+
+def resolveOperators(inputNames: list, candidateIds=None):
+    """Resolves a list of user inputs to operator ids, restricted to the given candidate ids (all operators by default). Inputs that do not refer to any candidate resolve to None."""
+    candidateIds = frozenset(candidateIds) if candidateIds is not None else _allOperatorIds
+    return [_resolveOperatorToken(token, candidateIds) if token else None for token in map(_normalizeName, inputNames)]
+
 class RainbowMatch:
+    __slots__ = ('matchId', 'bannedMask', 'map', 'sites', 'playingOnSide', 'currRound', 'rounds', 'scores', 'players', 'playersString', 'playerStats')
+
     def __init__(self, existingMatch=None):
         if existingMatch:
             self.matchId = existingMatch['matchId']
-            self.bannedOperators = existingMatch['bannedOperators']
+            # Matches saved before bans were stored as a bitset have a list of operator names instead
+            self.bannedMask = existingMatch['bannedMask'] if 'bannedMask' in existingMatch else sum({RainbowData.operatorBits[RainbowData.operatorIds[op]] for op in existingMatch['bannedOperators']})
             self.map = existingMatch['map']
             self.sites = existingMatch['sites']
             self.playingOnSide = existingMatch['playingOnSide']
@@ -64,7 +166,7 @@ class RainbowMatch:
             self.playerStats = existingMatch['playerStats']
         else:
             self.matchId = str(uuid.uuid4())
-            self.bannedOperators = []
+            self.bannedMask = 0
             self.map = None
             self.sites = self._resetSites()
             self.playingOnSide = None
@@ -75,6 +177,15 @@ class RainbowMatch:
             self.playersString = ''
             self.playerStats = []
 
+    def toDict(self):
+        """Returns the state of the match as a JSON-serializable dictionary, as accepted by the constructor."""
+        return {attribute: getattr(self, attribute) for attribute in self.__slots__}
+
+    @property
+    def bannedOperators(self):
+        """The names of all banned operators."""
+        return [RainbowData.getOperatorName(operatorId) for operatorId in RainbowData.getOperatorIdsInMask(self.bannedMask)]
+
     def _getOperators(self):
         """Returns a dictionary with the list of attacker and defender operators."""
         return {
@@ -86,16 +197,22 @@ class RainbowMatch:
         if map is None:
             map = 'UnknownMap'
 
-        maps = RainbowData.maps
+        canonicalMap = resolveMap(map)
+        if canonicalMap is not None:
+            return [canonicalMap, RainbowData.maps[canonicalMap]]
+        return [None, RainbowData.maps['UnknownMap']]
+
+    def _getSites(self):
+        """Returns the site names of the current map. The current map is always a canonical map name or None, so no resolving is needed."""
+        return RainbowData.maps[self.map if self.map is not None else 'UnknownMap']
 
-        best_match, score = process.extractOne(map, maps.keys())
-        if score > 70:
-            return [best_match, maps[best_match]]
-        return [None, maps['UnknownMap']]
+    def getMapId(self):
+        """Returns the stable integer id of the current map, or None if no map is set."""
+        return RainbowData.mapIds[self.map] if self.map is not None else None
 
     def _resetSites(self):
         """Resets the sites for the current map."""
-        return list(range(len(self._getMap(self.map)[1])))
+        return list(range(len(self._getSites())))
 
     def setPlayers(self, playerNames):
         """Sets the players in the current match."""
@@ -153,43 +270,29 @@ class RainbowMatch:
 
     def banOperators(self, inputString, ban=True):
         """Removes the given operators from the list of available operators, and returns the sanitized list of operators."""
-        attackers, defenders = self._getOperators().values()
         input_names = re.split(r'\W+\s*', inputString)
 
         if not input_names or all(name == '' for name in input_names):
             return []
 
-        sanitized_names = []
-        for name in input_names:
-            match, score = process.extractOne(name, attackers + defenders) if ban else process.extractOne(name, self.bannedOperators)
-            if score >= 75:
-                sanitized_names.append(match)
-            else:
-                sanitized_names.append(None)
+        operatorIds = resolveOperators(input_names, None if ban else RainbowData.getOperatorIdsInMask(self.bannedMask))
 
-        for op in sanitized_names:
+        for operatorId in operatorIds:
+            if operatorId is None:
+                continue
             if ban:
-                if op in attackers:
-                    self.bannedOperators.append(op)
-                elif op in defenders:
-                    self.bannedOperators.append(op)
+                self.bannedMask |= RainbowData.operatorBits[operatorId]
             else:
-                if op in self.bannedOperators:
-                    self.bannedOperators.remove(op)
+                self.bannedMask &= ~RainbowData.operatorBits[operatorId]
 
-        return sanitized_names
+        return [RainbowData.getOperatorName(operatorId) if operatorId is not None else None for operatorId in operatorIds]
     
-    def swapOperator(self, player, newOperator):
-        """Swaps the operator a given player is playing in the current round. The player and new operator are assumed to have been validated already."""
-        attackers, defenders = self._getOperators().values()
+    def swapOperator(self, player, newOperatorId):
+        """Swaps the operator a given player is playing in the current round. The player and new operator id are assumed to have been validated already."""
         playerIndex = next((i for i, p in enumerate(self.players) if p['id'] == player.id), None)
+        self.rounds[-1]["operators"][playerIndex] = newOperatorId
 
-        if newOperator in attackers:
-            self.rounds[-1]["operators"][playerIndex] = attackers.index(newOperator) + 1
-        else:
-            self.rounds[-1]["operators"][playerIndex] = -(defenders.index(newOperator) + 1)
-
-        return [attackers[abs(op) - 1] if op > 0 else defenders[abs(op) - 1] for op in self.rounds[-1]["operators"]], self.rounds[-1]["backupOperators"]
+        return [RainbowData.getOperatorName(op) for op in self.rounds[-1]["operators"]], self.rounds[-1]["backupOperators"]
 
     def setMap(self, map):
         """Sets the map for the current match. Returns True if the map has been set successfully."""
@@ -197,23 +300,23 @@ class RainbowMatch:
         if not mapMapping:
             return False
 
-        self.map = mapMapping[0]
-        if len(self._getMap(map)[1]) < len(self.sites):
+        self.map, sites = mapMapping
+        if len(sites) < len(self.sites):
             for site in self.sites:
-                if site >= len(self._getMap(map)[1]):
+                if site >= len(sites):
                     self.sites.remove(site)
         return True
     
     def setupRound(self):
         """Starts a new round, returning the chosen operators and site."""
         siteIndex, playedSite = self.getRandomSite() if self.playingOnSide == "defense" else (None, None)
-        playedOperators = self.getRandomOperators()
-        attackers, defenders = self._getOperators().values()
+        playedOperatorIds = self.getRandomOperatorIds()
+        playedOperators = [RainbowData.getOperatorName(operatorId) for operatorId in playedOperatorIds]
 
         self.rounds.append({
             "site": siteIndex,
             # The 1-indexed index of the current operator, negated if it is a defender
-            "operators": [(attackers.index(op) + 1) if self.playingOnSide == "attack" else -(defenders.index(op) + 1) for op in playedOperators[:len(self.players)]],
+            "operators": playedOperatorIds[:len(self.players)],
             "backupOperators": playedOperators[len(self.players):],
             "result": None,
             "playerStats": {}
@@ -223,7 +326,7 @@ class RainbowMatch:
     def getRandomSite(self):
         """Returns a choice of site that should be played."""
         siteIndex = random.choice(self.sites)
-        return siteIndex, self._getMap(self.map)[1][siteIndex]
+        return siteIndex, self._getSites()[siteIndex]
     
     def trySetSite(self, siteIndex):
         """Attempts to set a new site for the current round. Returns the name of the new site if successful, or None if the site is invalid."""
@@ -231,17 +334,17 @@ class RainbowMatch:
         siteIndex -= 1
         if siteIndex in self.sites:
             self.rounds[-1]["site"] = siteIndex
-            return self._getMap(self.map)[1][siteIndex]
+            return self._getSites()[siteIndex]
         return None
     
     def getCurrentSiteName(self):
         """Returns the name of the site currently being played."""
-        return self._getMap(self.map)[1][self.rounds[-1]["site"]] if self.rounds else None
+        return self._getSites()[self.rounds[-1]["site"]] if self.rounds else None
 
-    def getRandomOperators(self):
-        """Returns a random list of operators for the specified side, excluding any banned operators."""
-        attackers, defenders = self._getOperators().values()
-        available_operators = [op for op in (attackers if self.playingOnSide == "attack" else defenders) if op not in self.bannedOperators]
+    def getRandomOperatorIds(self):
+        """Returns a random list of operator ids for the specified side, excluding any banned operators."""
+        sideMask = RainbowData.attackerMask if self.playingOnSide == "attack" else RainbowData.defenderMask
+        available_operators = RainbowData.getOperatorIdsInMask(sideMask & ~self.bannedMask)
         return random.sample(available_operators, k=min(5, len(available_operators)))
 
     def resolveRound(self, result, overtimeSide):
@@ -0,0 +1,76 @@
+"""Plans the Discord API calls that bring the reactions of a message to an expected state.
+Discord shows reactions in the order they were first added and offers no way to reorder them, so a reaction in the wrong position has to be cleared and added again, together with all reactions after it."""
+
+# Operations of a plan:
+# ('clearAll',): removes all reactions from the message
+# ('clearEmoji', emoji): removes all reactions with the emoji
+# ('removeUser', emoji, userId): removes the reaction of a single user
+# ('add', emoji): adds the reaction of the bot
+CLEAR_ALL = 'clearAll'
+CLEAR_EMOJI = 'clearEmoji'
+REMOVE_USER = 'removeUser'
+ADD = 'add'
+
+def _removalCost(removals: list, numCurrent: int):
+    if not removals:
+        return 0
+    return 1 if len(removals) == numCurrent else len(removals)
+
+def planReactions(current: list, expected):
+    """Returns the shortest list of operations that turns the current reactions into the expected ones, where each operation is one API call.
+    current holds (emoji, botReacted, otherUserIds) tuples in display order, expected is the ordered list of emojis the bot should have reacted with alone, or None if there should be no reactions at all."""
+    if expected is None or not expected:
+        return [(CLEAR_ALL,)] if current else []
+
+    currentEmojis = [emoji for emoji, _, _ in current]
+    unexpected = [emoji for emoji in currentEmojis if emoji not in expected]
+    kept = [reaction for reaction in current if reaction[0] in expected]
+
+    # The kept reactions that are already in their expected position
+    numInPlace = 0
+    while numInPlace < len(kept) and kept[numInPlace][0] == expected[numInPlace]:
+        numInPlace += 1
+
+    # Keep the first cut reactions in place, fixing up their users, and clear and re-add all others.
+    # Keeping fewer than possible is cheaper if a reaction has many users that would otherwise need to be removed one by one
+    bestCut, bestCost = None, None
+    fixCost = 0
+    for cut in range(numInPlace + 1):
+        if cut > 0:
+            _, botReacted, otherUserIds = kept[cut - 1]
+            fixCost += (0 if botReacted else 1) + len(otherUserIds)
+        removals = unexpected + [emoji for emoji, _, _ in kept[cut:]]
+        cost = fixCost + _removalCost(removals, len(current)) + len(expected) - cut
+        if bestCost is None or cost <= bestCost:
+            bestCut, bestCost = cut, cost
+
+    plan = []
+    removals = unexpected + [emoji for emoji, _, _ in kept[bestCut:]]
+    if removals and len(removals) == len(current):
+        plan.append((CLEAR_ALL,))
+    else:
+        plan += [(CLEAR_EMOJI, emoji) for emoji in reversed(removals)]
+    for emoji, botReacted, otherUserIds in kept[:bestCut]:
+        if not botReacted:
+            plan.append((ADD, emoji))
+        plan += [(REMOVE_USER, emoji, userId) for userId in sorted(otherUserIds)]
+    plan += [(ADD, emoji) for emoji in expected[bestCut:]]
+    return plan
+
+def applyPlan(current: list, plan: list):
+    """Returns the reactions after executing the plan on the current reactions, in the same form as the current reactions. Used to check plans."""
+    reactions = [(emoji, botReacted, set(otherUserIds)) for emoji, botReacted, otherUserIds in current]
+    for op in plan:
+        if op[0] == CLEAR_ALL:
+            reactions = []
+        elif op[0] == CLEAR_EMOJI:
+            reactions = [reaction for reaction in reactions if reaction[0] != op[1]]
+        elif op[0] == REMOVE_USER:
+            next(reaction for reaction in reactions if reaction[0] == op[1])[2].discard(op[2])
+        elif op[0] == ADD:
+            index = next((i for i, reaction in enumerate(reactions) if reaction[0] == op[1]), None)
+            if index is None:
+                reactions.append((op[1], True, set()))
+            else:
+                reactions[index] = (op[1], True, reactions[index][2])
+    return [reaction for reaction in reactions if reaction[1] or reaction[2]]
@@ -0,0 +1,30 @@
+def getShardId(guildId: int, shardCount: int):
+    """Returns the shard Discord sends the events of a guild to."""
+    return (guildId >> 22) % shardCount
+
+def parseShardCount(value: str):
+    """Parses the SHARD_COUNT setting: None if the bot is not sharded, 'auto' to use the number of shards recommended by Discord, or a fixed number of shards."""
+    if not value:
+        return None
+    if value.lower() == 'auto':
+        return 'auto'
+    shardCount = int(value)
+    if shardCount < 1:
+        raise ValueError(f'SHARD_COUNT must be at least 1, got {shardCount}')
+    return shardCount
+
+def parseShardIds(value: str, shardCount):
+    """Parses the SHARD_IDS setting, a comma-separated list of shard ids and ranges such as "0-3,8", into a sorted list. Returns None if all shards should run in this process."""
+    if not value:
+        return None
+    if not isinstance(shardCount, int):
+        raise ValueError('SHARD_IDS requires SHARD_COUNT to be set to a fixed number of shards')
+
+    shardIds = set()
+    for part in value.split(','):
+        start, _, end = part.strip().partition('-')
+        shardIds.update(range(int(start), int(end or start) + 1))
+    invalid = [shardId for shardId in shardIds if not 0 <= shardId < shardCount]
+    if invalid:
+        raise ValueError(f'SHARD_IDS contains shards outside of 0-{shardCount - 1}: {sorted(invalid)}')
+    return sorted(shardIds)
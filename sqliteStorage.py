@@ -0,0 +1,95 @@
+import os
+import sqlite3
+import statisticsRollups
+from database import DatabaseExecutor
+from migrations import MIGRATIONS, getSchemaVersion, migrate
+from storage import MatchStorage, PLAYER_STATISTICS_QUERIES, SERVER_STATISTICS_QUERIES, getCompletedMatchRows
+
+class SqliteStorage(MatchStorage):
+    """Stores everything in a single SQLite file. Several processes on the same machine can share the file."""
+    def __init__(self, path: str):
+        self.path = path
+        self.db = None
+
+    async def open(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self.db = DatabaseExecutor(self.path)
+        return await self.db.write(self._migrate)
+
+    @staticmethod
+    def _migrate(conn: sqlite3.Connection):
+        previousVersion = getSchemaVersion(conn)
+        if previousVersion > len(MIGRATIONS):
+            raise RuntimeError(f'The database has schema version {previousVersion}, but this version of the bot only knows {len(MIGRATIONS)}, update the bot')
+        return previousVersion, migrate(conn)
+
+    async def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    async def loadOngoingMatches(self):
+        return await self.db.fetchall("SELECT server_id, channel_id, match_data, discord_message FROM ongoing_matches")
+
+    async def writeOngoingMatches(self, upserts: list, deletions: list):
+        await self.db.write(self._writeOngoingMatches, upserts, deletions)
+
+    @staticmethod
+    def _writeOngoingMatches(conn: sqlite3.Connection, upserts: list, deletions: list):
+        conn.executemany("DELETE FROM ongoing_matches WHERE server_id = ? AND channel_id = ?", deletions)
+        conn.executemany("INSERT OR REPLACE INTO ongoing_matches (server_id, channel_id, match_data, discord_message) VALUES (?, ?, ?, ?)", upserts)
+
+    async def saveCompletedMatches(self, matches: list):
+        await self.db.write(self._writeCompletedMatches, getCompletedMatchRows(matches))
+
+    @staticmethod
+    def _writeCompletedMatches(conn: sqlite3.Connection, rows: dict):
+        conn.executemany("INSERT INTO matches (match_id, server_id, map, result) VALUES (?, ?, ?, ?)", rows['matches'])
+        conn.executemany("INSERT OR IGNORE INTO players (player_id) VALUES (?)", rows['players'])
+        conn.executemany("INSERT INTO player_matches (player_id, match_id) VALUES (?, ?)", rows['player_matches'])
+        conn.executemany("INSERT INTO rounds (round_num, match_id, site, result) VALUES (?, ?, ?, ?)", rows['rounds'])
+        conn.executemany("INSERT INTO player_rounds (player_id, match_id, round_num, operator) VALUES (?, ?, ?, ?)", rows['player_rounds'])
+        # Increase the counter of each stat by the count, or create it if it doesn't exist
+        conn.executemany("""
+            INSERT INTO player_additional_stats (player_id, stat_type, value) VALUES (?, ?, ?)
+            ON CONFLICT(player_id, stat_type) DO UPDATE SET value = player_additional_stats.value + excluded.value
+        """, rows['player_additional_stats'])
+        statisticsRollups.applyMatches(conn, [row[0] for row in rows['matches']])
+
+    async def deleteMatch(self, matchId: str):
+        return await self.db.write(self._deleteMatch, matchId)
+
+    @classmethod
+    def _deleteMatch(cls, conn: sqlite3.Connection, matchId: str):
+        match = conn.execute("SELECT server_id FROM matches WHERE match_id = ?", (matchId,)).fetchone()
+        if match is None:
+            return None
+        playerIds = [row[0] for row in conn.execute("SELECT player_id FROM player_matches WHERE match_id = ?", (matchId,)).fetchall()]
+        cls._deleteMatches(conn, [matchId])
+        return match[0], playerIds
+
+    async def deleteMatchesWithoutMap(self):
+        await self.db.write(self._deleteMatchesWithoutMap)
+
+    @classmethod
+    def _deleteMatchesWithoutMap(cls, conn: sqlite3.Connection):
+        matchIds = [row[0] for row in conn.execute("SELECT match_id FROM matches WHERE map IS NULL").fetchall()]
+        cls._deleteMatches(conn, matchIds)
+
+    @staticmethod
+    def _deleteMatches(conn: sqlite3.Connection, matchIds: list):
+        statisticsRollups.applyMatches(conn, matchIds, -1)
+        for matchId in matchIds:
+            conn.execute("DELETE FROM matches WHERE match_id = ?", (matchId,))
+            conn.execute("DELETE FROM player_matches WHERE match_id = ?", (matchId,))
+            conn.execute("DELETE FROM rounds WHERE match_id = ?", (matchId,))
+            conn.execute("DELETE FROM player_rounds WHERE match_id = ?", (matchId,))
+
+    async def rebuildStatistics(self):
+        await self.db.write(statisticsRollups.rebuild)
+
+    async def getPlayerStatistics(self, playerId: int, statType: str):
+        return await self.db.fetchall(PLAYER_STATISTICS_QUERIES[statType], (playerId,))
+
+    async def getServerStatistics(self, serverId: int, statType: str):
+        return await self.db.fetchall(SERVER_STATISTICS_QUERIES[statType], (serverId,))
@@ -0,0 +1,34 @@
+import time
+
+class StartupProfile:
+    """Records how long each phase of the startup took, from the first import of this module until the bot is ready for the first time."""
+    def __init__(self):
+        self.start = self._last = time.perf_counter()
+        # (phase, seconds) in the order the phases ended
+        self.phases = []
+        self.finished = False
+
+    def mark(self, phase: str):
+        """Ends the phase that has been running since the previous mark."""
+        if self.finished:
+            return
+        now = time.perf_counter()
+        self.phases.append((phase, now - self._last))
+        self._last = now
+
+    def finish(self, phase: str):
+        """Ends the last phase. Returns whether this was the first call, as later calls are ignored."""
+        if self.finished:
+            return False
+        self.mark(phase)
+        self.finished = True
+        return True
+
+    def getReport(self):
+        lines = ['Startup profile:']
+        lines += [f'    {phase:<32} {seconds * 1000:8.0f} ms' for phase, seconds in self.phases]
+        lines.append(f'    {"total":<32} {(self._last - self.start) * 1000:8.0f} ms')
+        return '\n'.join(lines)
+
+# Shared by all modules, bot.py imports this module first so the profile includes the time spent importing everything else
+startupProfile = StartupProfile()
@@ -0,0 +1,68 @@
+import time
+from collections import OrderedDict
+
+class StatisticsCache:
+    """A bounded LRU cache of statistics reports, keyed by ('player', playerId) or ('server', serverId).
+    Reports only change when a match is saved or removed, so entries are invalidated for the players and server of that match instead of expiring."""
+    def __init__(self, maxEntries: int, playerMaxAge: float = None):
+        self.maxEntries = maxEntries
+        # Player statistics include matches on all servers, which other processes of a sharded bot may save without this process knowing. Their reports expire after this many seconds
+        self.playerMaxAge = playerMaxAge
+        # Key -> (report, time after which it must not be used anymore, or None)
+        self._entries = OrderedDict()
+        # Increased by every invalidation, so a report computed while its data changed is not stored
+        self._epoch = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+    def get(self, key: tuple):
+        """Returns the cached report, or None if there is none."""
+        entry = self._entries.get(key)
+        if entry is not None and (entry[1] is None or entry[1] > time.monotonic()):
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+        if entry is not None:
+            del self._entries[key]
+        self.misses += 1
+        return None
+
+    def getEpoch(self):
+        """Returns a token to take before reading the data of a report, and to pass to put() with the report."""
+        return self._epoch
+
+    def put(self, key: tuple, report, epoch: int):
+        """Caches a report, unless any statistics were invalidated since the epoch was taken."""
+        if epoch != self._epoch or self.maxEntries <= 0:
+            return
+        expires = time.monotonic() + self.playerMaxAge if key[0] == 'player' and self.playerMaxAge is not None else None
+        self._entries[key] = (report, expires)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxEntries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidateMatch(self, serverId: int, playerIds: list):
+        """Drops the reports affected by saving or removing a match of the server with the given players."""
+        self._epoch += 1
+        for key in [('server', serverId)] + [('player', playerId) for playerId in playerIds]:
+            if self._entries.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        self._epoch += 1
+        self.invalidations += len(self._entries)
+        self._entries.clear()
+
+    def getMetrics(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hitRate': self.hits / lookups if lookups else 0.0,
+            'invalidations': self.invalidations,
+            'evictions': self.evictions
+        }
@@ -0,0 +1,126 @@
+import sqlite3
+
+# Rows in the map statistics tables with this site hold the match results on the map, instead of the results of single rounds
+MATCH_SITE = -1
+# Rows in the map statistics tables with this site hold the results of rounds played on attack
+ATTACK_SITE = -2
+
+# Written in SQL that SQLite and PostgreSQL both understand, so every storage backend keeps the counters with the same statements
+_WINS = 'SUM(CASE WHEN {0}.result = 1 THEN 1 ELSE 0 END) AS wins'
+_LOSSES = 'SUM(CASE WHEN {0}.result = 1 THEN 0 ELSE 1 END) AS losses'
+
+# The key columns of each table holding win/loss counters
+ROLLUP_KEYS = {
+    'player_map_statistics': ['player_id', 'map', 'site'],
+    'player_operator_statistics': ['player_id', 'operator'],
+    'server_map_statistics': ['server_id', 'map', 'site'],
+    'server_operator_statistics': ['server_id', 'operator']
+}
+
+# The queries aggregating the counters of each table from the raw tables, for all matches that pass the {filter}
+_ROLLUP_QUERIES = {
+    'player_map_statistics': [
+        f"""
+            SELECT player_matches.player_id AS player_id, COALESCE(matches.map, '') AS map, {MATCH_SITE} AS site, {_WINS.format('matches')}, {_LOSSES.format('matches')}
+            FROM player_matches
+            JOIN matches ON player_matches.match_id = matches.match_id
+            WHERE {{filter}}
+            GROUP BY 1, 2, 3
+        """,
+        f"""
+            SELECT player_rounds.player_id AS player_id, COALESCE(matches.map, '') AS map, COALESCE(rounds.site, {ATTACK_SITE}) AS site, {_WINS.format('rounds')}, {_LOSSES.format('rounds')}
+            FROM player_rounds
+            JOIN rounds ON player_rounds.match_id = rounds.match_id AND player_rounds.round_num = rounds.round_num
+            JOIN matches ON player_rounds.match_id = matches.match_id
+            WHERE {{filter}}
+            GROUP BY 1, 2, 3
+        """
+    ],
+    'player_operator_statistics': [
+        f"""
+            SELECT player_rounds.player_id AS player_id, player_rounds.operator AS operator, {_WINS.format('rounds')}, {_LOSSES.format('rounds')}
+            FROM player_rounds
+            JOIN rounds ON player_rounds.match_id = rounds.match_id AND player_rounds.round_num = rounds.round_num
+            JOIN matches ON player_rounds.match_id = matches.match_id
+            WHERE {{filter}}
+            GROUP BY 1, 2
+        """
+    ],
+    'server_map_statistics': [
+        f"""
+            SELECT matches.server_id AS server_id, COALESCE(matches.map, '') AS map, {MATCH_SITE} AS site, {_WINS.format('matches')}, {_LOSSES.format('matches')}
+            FROM matches
+            WHERE {{filter}}
+            GROUP BY 1, 2, 3
+        """,
+        f"""
+            SELECT matches.server_id AS server_id, COALESCE(matches.map, '') AS map, COALESCE(rounds.site, {ATTACK_SITE}) AS site, {_WINS.format('rounds')}, {_LOSSES.format('rounds')}
+            FROM rounds
+            JOIN matches ON rounds.match_id = matches.match_id
+            WHERE {{filter}}
+            GROUP BY 1, 2, 3
+        """
+    ],
+    'server_operator_statistics': [
+        f"""
+            SELECT matches.server_id AS server_id, player_rounds.operator AS operator, {_WINS.format('rounds')}, {_LOSSES.format('rounds')}
+            FROM player_rounds
+            JOIN rounds ON player_rounds.match_id = rounds.match_id AND player_rounds.round_num = rounds.round_num
+            JOIN matches ON player_rounds.match_id = matches.match_id
+            WHERE {{filter}}
+            GROUP BY 1, 2
+        """
+    ]
+}
+
+# The statements adding (sign 1) or subtracting (sign -1) the results of one match to or from the counters, each taking the parameters (sign, sign, matchId)
+APPLY_STATEMENTS = [
+    f"""
+        INSERT INTO {table} ({', '.join(ROLLUP_KEYS[table])}, wins, losses)
+        SELECT {', '.join(ROLLUP_KEYS[table])}, ? * wins, ? * losses FROM ({query.format(filter='matches.match_id = ?')}) AS rollup WHERE true
+        ON CONFLICT({', '.join(ROLLUP_KEYS[table])}) DO UPDATE SET wins = {table}.wins + excluded.wins, losses = {table}.losses + excluded.losses
+    """
+    for table, queries in _ROLLUP_QUERIES.items() for query in queries
+]
+
+# The statements removing the counters that no longer belong to any match after subtracting one, each taking the parameter (matchId,)
+CLEANUP_STATEMENTS = [
+    f"DELETE FROM {table} WHERE player_id IN (SELECT player_id FROM player_matches WHERE match_id = ?) AND wins = 0 AND losses = 0"
+    for table in ['player_map_statistics', 'player_operator_statistics']
+] + [
+    f"DELETE FROM {table} WHERE server_id = (SELECT server_id FROM matches WHERE match_id = ?) AND wins = 0 AND losses = 0"
+    for table in ['server_map_statistics', 'server_operator_statistics']
+]
+
+# The statements regenerating all counters from the raw tables
+REBUILD_STATEMENTS = [f"DELETE FROM {table}" for table in _ROLLUP_QUERIES] + [
+    f"INSERT INTO {table} ({', '.join(ROLLUP_KEYS[table])}, wins, losses) {query.format(filter='true')}"
+    for table, queries in _ROLLUP_QUERIES.items() for query in queries
+]
+
+def createRollupTables(conn: sqlite3.Connection):
+    """Creates the tables holding the win/loss counters for the statistics."""
+    for table, keys in ROLLUP_KEYS.items():
+        columns = ', '.join(f'{key} {"TEXT" if key == "map" else "INTEGER"} NOT NULL' for key in keys)
+        conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                {columns},
+                wins INTEGER NOT NULL,
+                losses INTEGER NOT NULL,
+                PRIMARY KEY({', '.join(keys)})
+            ) WITHOUT ROWID
+        """)
+
+def applyMatches(conn: sqlite3.Connection, matchIds: list, sign: int = 1):
+    """Adds (sign 1) or subtracts (sign -1) the results of the given matches to or from the counters. The matches must still be in the raw tables."""
+    for matchId in matchIds:
+        for statement in APPLY_STATEMENTS:
+            conn.execute(statement, (sign, sign, matchId))
+        if sign < 0:
+            for statement in CLEANUP_STATEMENTS:
+                conn.execute(statement, (matchId,))
+
+def rebuild(conn: sqlite3.Connection):
+    """Regenerates all counters from the raw tables."""
+    for statement in REBUILD_STATEMENTS:
+        conn.execute(statement)
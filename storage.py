@@ -0,0 +1,117 @@
+import abc
+from statisticsRollups import ATTACK_SITE
+
+# The queries behind each statistic, written in SQL that all storage backends understand. Each takes the id of the player or server as its only parameter
+PLAYER_STATISTICS_QUERIES = {
+    # Returns the wins and losses of matches this player played on each map, and of the rounds played on each site of the map (None for attack)
+    'maps': f"""
+        SELECT NULLIF(map, ''), NULLIF(site, {ATTACK_SITE}), wins, losses
+        FROM player_map_statistics
+        WHERE player_id = ?
+    """,
+    # Returns a list of all additional statistics for this player, such as interrogations or aces
+    'additionalStatistics': """
+        SELECT stat_type, value
+        FROM player_additional_stats
+        WHERE player_id = ?
+    """,
+    # Returns the wins and losses of rounds this player played, for each operator
+    'operators': """
+        SELECT operator, wins, losses
+        FROM player_operator_statistics
+        WHERE player_id = ?
+    """
+}
+
+SERVER_STATISTICS_QUERIES = {
+    # Returns the wins and losses of matches played on this server on each map, and of the rounds played on each site of the map (None for attack)
+    'maps': f"""
+        SELECT NULLIF(map, ''), NULLIF(site, {ATTACK_SITE}), wins, losses
+        FROM server_map_statistics
+        WHERE server_id = ?
+    """,
+    # Returns the wins and losses of each operator played in matches on this server
+    'operators': """
+        SELECT operator, wins, losses
+        FROM server_operator_statistics
+        WHERE server_id = ?
+    """
+}
+
+def getCompletedMatchRows(matches: list):
+    """Converts a list of (serverId, match) tuples of completed matches into the rows that need to be inserted into each table."""
+    rows = {'matches': [], 'players': [], 'player_matches': [], 'rounds': [], 'player_rounds': [], 'player_additional_stats': {}}
+    for serverId, match in matches:
+        matchId = match.matchId
+        didWin = match.scores['blue'] > match.scores['red']
+        rows['matches'].append((matchId, serverId, match.map, int(didWin)))
+
+        for player in match.players:
+            rows['players'].append((player['id'],))
+            rows['player_matches'].append((player['id'], matchId))
+
+        for roundNumber, round in enumerate(match.rounds):
+            rows['rounds'].append((roundNumber, matchId, round['site'], round['result']))
+            for playerIndex, player in enumerate(match.players):
+                rows['player_rounds'].append((player['id'], matchId, roundNumber, round['operators'][playerIndex]))
+
+            # Sum up additional statistics first, so each counter is only updated once
+            for statType, players in round['playerStats'].items():
+                for playerId, count in players.items():
+                    key = (int(playerId), statType)
+                    rows['player_additional_stats'][key] = rows['player_additional_stats'].get(key, 0) + count
+
+    rows['player_additional_stats'] = [(playerId, statType, count) for (playerId, statType), count in rows['player_additional_stats'].items()]
+    return rows
+
+class MatchStorage(abc.ABC):
+    """Stores the ongoing and completed matches and the statistics computed from them. Each storage backend implements all of these coroutines."""
+    @abc.abstractmethod
+    async def open(self):
+        """Connects to the database and brings its schema up to date. Returns the schema version before and after."""
+
+    @abc.abstractmethod
+    async def close(self):
+        """Waits for all pending work to finish and closes all connections."""
+
+    @abc.abstractmethod
+    async def loadOngoingMatches(self):
+        """Returns all saved ongoing matches as (serverId, channelId, matchData, discordMessage) rows."""
+
+    @abc.abstractmethod
+    async def writeOngoingMatches(self, upserts: list, deletions: list):
+        """Saves the (serverId, channelId, matchData, discordMessage) rows and deletes the ongoing matches of the (serverId, channelId) keys, in a single transaction."""
+
+    @abc.abstractmethod
+    async def saveCompletedMatches(self, matches: list):
+        """Saves a list of (serverId, match) tuples of completed matches and adds them to the statistics, in a single transaction."""
+
+    @abc.abstractmethod
+    async def deleteMatch(self, matchId: str):
+        """Removes all data associated with a completed match and subtracts it from the statistics.
+        Returns the (serverId, playerIds) of the match, whose statistics changed, or None if there was no such match."""
+
+    @abc.abstractmethod
+    async def deleteMatchesWithoutMap(self):
+        """Removes all completed matches that were saved without a map, which only happens in debug mode."""
+
+    @abc.abstractmethod
+    async def rebuildStatistics(self):
+        """Regenerates the win/loss counters used for statistics from all saved matches."""
+
+    @abc.abstractmethod
+    async def getPlayerStatistics(self, playerId: int, statType: str):
+        """Returns the rows of PLAYER_STATISTICS_QUERIES[statType] for the player, as tuples."""
+
+    @abc.abstractmethod
+    async def getServerStatistics(self, serverId: int, statType: str):
+        """Returns the rows of SERVER_STATISTICS_QUERIES[statType] for the server, as tuples."""
+
+def createStorage(database: str):
+    """Returns the storage backend for the database, which is either a postgresql:// URL or the path of a SQLite file."""
+    if database.startswith(('postgres://', 'postgresql://')):
+        # Only import the backend that is used, so its driver is not needed otherwise
+        from postgresStorage import PostgresStorage
+        return PostgresStorage(database)
+    from sqliteStorage import SqliteStorage
+    return SqliteStorage(database)